@@ -1,23 +1,38 @@
-
-from autogenv2 import manager
-from autogenv2 import autopaths
-from autogenv2 import autorunner
-from autogenv2 import autoutil
-from autogenv2 import bundler
-from autogenv2 import convertermanager
-from autogenv2 import crystalmanager
-#from autogenv2 import pyscfmanager
-from autogenv2 import qwalkmanager
-from autogenv2 import submitter
+''' Submodules are imported the first time they're used (PEP 562), so `import autogenv2` stays cheap.
+`from autogenv2 import crystalmanager` and `autogenv2.crystalmanager` work as before.
+'''
+import importlib
 
 __all__=[
-    "autogen_tools",
+    "manager",
     "autopaths",
     "autorunner",
     "autoutil",
     "bundler",
+    "campaign",
     "convertermanager",
     "crystalmanager",
+    "daemon",
+    "dag",
+    "ledger",
+    "pilot",
+    "prerun",
     "qwalkmanager",
-    "submitter"
+    "resultcache",
+    "sentinels",
+    "serialize",
+    "sidecar",
+    "statestore",
+    "submitter",
+    "walltimes"
   ]
+
+def __getattr__(name):
+  if name in __all__:
+    module=importlib.import_module('autogenv2.'+name)
+    globals()[name]=module
+    return module
+  raise AttributeError("module 'autogenv2' has no attribute '%s'"%name)
+
+def __dir__():
+  return sorted(set(globals())|set(__all__))
@@ -1,11 +1,46 @@
 from __future__ import print_function
 import os
 import sys
-import numpy as np
 import subprocess as sub
 import shutil
 import autogenv2
 from autogenv2 import submitter
+from autogenv2 import sentinels
+
+####################################################
+def walltime_seconds(walltime):
+  ''' Seconds in a walltime like '48:00:00', '30:00', or '1-12:00:00' (days-hours:minutes:seconds).'''
+  days=0
+  if '-' in walltime:
+    days,walltime=walltime.split('-')
+  seconds=0
+  for part in walltime.split(':'):
+    seconds=seconds*60+int(part)
+  return int(days)*86400+seconds
+
+####################################################
+def format_walltime(seconds):
+  ''' Walltime like '48:00:00' from seconds.'''
+  seconds=int(seconds)
+  return "%02d:%02d:%02d"%(seconds//3600,seconds%3600//60,seconds%60)
+
+####################################################
+def task_line(line,sentinel=None,nodes=None,cores=None):
+  ''' Line of a job script for a task, writing sentinel files if a sentinel is given (see sentinels).
+  Sentinels left by an earlier run are removed, and the nodes and cores of the task are noted for the runtime ledger.
+  The time of submission is noted when the job is submitted (see sentinels.submitted).'''
+  if sentinel is None:
+    return line
+  sentinels.clear(sentinel)
+  sentinels.queued(sentinel,nodes,cores)
+  return sentinels.wrap(line,sentinel)
+
+####################################################
+def task_cores(nn,np):
+  ''' Cores of a task on nn nodes with np processes per node (None for 'allprocs').'''
+  if np=='allprocs':
+    return None
+  return nn*np
 
 ####################################################
 class RunnerLocal:
@@ -23,16 +58,18 @@ class RunnerLocal:
     return 'done'
 
   #-------------------------------------
-  def add_task(self,exestr):
+  def add_task(self,exestr,sentinel=None):
     ''' Accumulate executable commands.
     Args: 
       exestr (str): executible statement. Will be prepended with appropriate mpirun. 
+      sentinel (str): write sentinel files for the task with this prefix (see sentinels).
     '''
 
     if self.np=='allprocs':
-      self.exelines.append("mpirun {exe}".format(exe=exestr))
+      line="mpirun {exe}".format(exe=exestr)
     else:
-      self.exelines.append("mpirun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr))
+      line="mpirun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr)
+    self.exelines.append(task_line(line,sentinel,self.nn,task_cores(self.nn,self.np)))
 
   #-------------------------------------
   def add_command(self,cmdstr):
@@ -43,17 +80,22 @@ class RunnerLocal:
     self.exelines.append(cmdstr)
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,path=None):
+    ''' Submit series of commands.
+    Args:
+      jobname (str): not used, since nothing is queued.
+      path (str): directory to run the commands in (default: current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
 
     if len(self.exelines)==0:
       return ''
     
+    sentinels.submitted(self.exelines)
     try:
       for line in self.exelines:
-        result = sub.check_output(line,shell=True)
+        result = sub.check_output(line,shell=True,cwd=path)
         print(self.__class__.__name__,": executed %s"%line)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error: {0}".format(err))
@@ -63,7 +105,89 @@ class RunnerLocal:
     return ''
 
 ####################################################
-class RunnerPBS:
+class QueueSubmission:
+  ''' Submission of job scripts to a queue, shared by the queue runners.
+  Runners define write_script(jobname,path,depend), which writes the job script into path 
+  and returns its file name (None if there's nothing to run).'''
+  submit_command=['qsub']
+  depend_directive="#PBS -W depend=afterok:%s"
+
+  #-------------------------------------
+  def submit(self,jobname=None,path=None,**script_args):
+    ''' Submit series of commands.
+    Args:
+      jobname (str): name to appear in the queue.
+      path (str): directory the job runs in, and where its script is written (default: current directory).
+      depend (list): queue ids of jobs that must finish successfully before this job starts (passed to write_script).
+    '''
+    if path is None:
+      path=os.getcwd()
+    qsubfile=self.write_script(jobname,path,**script_args)
+    if qsubfile is None:
+      #print(self.__class__.__name__,": All tasks completed or queued.")
+      return
+    try:
+      result = sub.check_output(self.submit_command+[qsubfile],stderr=sub.STDOUT,cwd=path)
+      self._submitted(result.decode())
+    except sub.CalledProcessError as err:
+      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
+
+    # Remove exelines so the runner is ready for the next go.
+    self.exelines=[]
+    return qsubfile
+
+  #-------------------------------------
+  async def asubmit(self,jobname=None,path=None,**script_args):
+    ''' Asynchronous version of submit, which doesn't block an asyncio event loop while the job is submitted.'''
+    import asyncio
+    if path is None:
+      path=os.getcwd()
+    qsubfile=self.write_script(jobname,path,**script_args)
+    if qsubfile is None:
+      return
+    proc=await asyncio.create_subprocess_exec(*(self.submit_command+[qsubfile]),cwd=path,
+        stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.STDOUT)
+    output,_=await proc.communicate()
+    if proc.returncode==0:
+      self._submitted(output.decode())
+    else:
+      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(output.decode().strip()))
+
+    # Remove exelines so the runner is ready for the next go.
+    self.exelines=[]
+    return qsubfile
+
+  #-------------------------------------
+  def dependency(self,depend):
+    ''' Directives holding the job until the jobs in depend have finished successfully.'''
+    if depend is None or len(depend)==0:
+      return []
+    return [self.depend_directive%':'.join(depend)]
+
+  #-------------------------------------
+  def job_id(self,output):
+    ''' Job id from the output of the submit command, e.g. '4819103' from '4819103.bw'.'''
+    return output.split()[0].split('.')[0]
+
+  #-------------------------------------
+  def queue_cache(self):
+    ''' Cache of the queue listing that should know about jobs this runner submits.'''
+    return submitter.qstat_cache()
+
+  #-------------------------------------
+  def queue_index(self):
+    ''' Jobs in the queue, as submitter.QueueIndex (None if the queue couldn't be listed).'''
+    return self.queue_cache().index(column=4)
+
+  #-------------------------------------
+  def _submitted(self,output):
+    sentinels.submitted(self.exelines)
+    self.queueid.append(self.job_id(output))
+    self.queue_cache().submitted(self.queueid[-1])
+    print(self.__class__.__name__,": Submitted as %s"%self.queueid)
+
+####################################################
+class RunnerPBS(QueueSubmission):
   ''' Object that can accumulate jobs to run and run them together in one submission. '''
   def __init__(self,queue='batch',
                     walltime='48:00:00',
@@ -113,20 +237,27 @@ class RunnerPBS:
     return ret
 
   #-------------------------------------
-  def add_task(self,exestr):
+  def add_task(self,exestr,sentinel=None):
     ''' Accumulate executable commands.
     Args: 
       exestr (str): executible statement. Will be prepended with appropriate mpirun. 
+      sentinel (str): write sentinel files for the task with this prefix (see sentinels).
     '''
 
     if self.np=='allprocs':
-      self.exelines.append("mpirun {exe}".format(exe=exestr))
+      line="mpirun {exe}".format(exe=exestr)
     else:
-      self.exelines.append("mpirun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr))
+      line="mpirun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr)
+    self.exelines.append(task_line(line,sentinel,self.nn,task_cores(self.nn,self.np)))
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def write_script(self,jobname,path,depend=None):
+    ''' Write the job script for the accumulated commands into path.
+    Args:
+      depend (list): queue ids of jobs to wait for (see dependency).
+    Returns:
+      str: name of the script, or None if there's nothing to run.
+    '''
     if jobname is None:
       jobname=self.jobname
 
@@ -148,24 +279,16 @@ class RunnerPBS:
         "#PBS -j oe ",
         "#PBS -N %s "%jobname,
         "#PBS -o %s "%jobout,
-        "cd %s"%os.getcwd(),
+      ] + self.dependency(depend) + [
+        "cd %s"%path,
       ] + self.prefix + self.exelines + self.postfix
     qsubfile=jobname+".qsub"
-    with open(qsubfile,'w') as f:
+    with open(os.path.join(path,qsubfile),'w') as f:
       f.write('\n'.join(qsub))
-    try:
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
-      print(self.__class__.__name__,": Submitted as %s"%self.queueid)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
-
-    # Remove exelines so the runner is ready for the next go.
-    self.exelines=[]
     return qsubfile
 
 ####################################################
-class RunnerBW:
+class RunnerBW(QueueSubmission):
   ''' Object that can accumulate jobs to run and run them together in one submission. '''
   def __init__(self,queue='normal',
                     account='batr',
@@ -201,7 +324,11 @@ class RunnerBW:
 
   #-------------------------------------
   def check_status(self,qstat=None):
-    return submitter.check_BW_stati(self.queueid)
+    return submitter.check_BW_stati(self.queueid,qstat=qstat)
+
+  #-------------------------------------
+  def queue_index(self):
+    return self.queue_cache().index(column=-2)
 
   def add_command(self,cmdstr):
     ''' Accumulate commands that don't get an MPI command.
@@ -211,16 +338,18 @@ class RunnerBW:
     self.exelines.append(cmdstr)
 
   #-------------------------------------
-  def add_task(self,exestr):
+  def add_task(self,exestr,sentinel=None):
     ''' Accumulate executable commands.
     Args: 
       exestr (str): executible statement. Will be prepended with appropriate aprun. 
+      sentinel (str): write sentinel files for the task with this prefix (see sentinels).
     '''
 
     if self.np=='allprocs':
-      self.exelines.append("aprun {exe}".format(exe=exestr))
+      line="aprun {exe}".format(exe=exestr)
     else:
-      self.exelines.append("aprun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr))
+      line="aprun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr)
+    self.exelines.append(task_line(line,sentinel,self.nn,task_cores(self.nn,self.np)))
 
   #-------------------------------------
   def release_commands(self):
@@ -230,8 +359,13 @@ class RunnerBW:
     return ret
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def write_script(self,jobname,path,depend=None):
+    ''' Write the job script for the accumulated commands into path.
+    Args:
+      depend (list): queue ids of jobs to wait for (see dependency).
+    Returns:
+      str: name of the script, or None if there's nothing to run.
+    '''
     if jobname is None:
       jobname=self.jobname
 
@@ -249,20 +383,124 @@ class RunnerBW:
         "#PBS -j oe ",
         "#PBS -N %s "%jobname,
         "#PBS -o %s "%jobout,
-        "cd %s"%os.getcwd(),
+      ] + self.dependency(depend) + [
+        "cd %s"%path,
       ] + self.prefix + self.exelines + self.postfix
     qsubfile=jobname+".qsub"
-    with open(qsubfile,'w') as f:
+    with open(os.path.join(path,qsubfile),'w') as f:
       f.write('\n'.join(qsub))
-    try:
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
-      print(self.__class__.__name__,": Submitted as %s"%self.queueid)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
+    return qsubfile
 
-    # Remove exelines so the runner is ready for the next go.
+####################################################
+class RunnerSlurm(QueueSubmission):
+  ''' Object that can accumulate jobs to run and run them together in one Slurm submission. '''
+  def __init__(self,queue='normal',
+                    walltime='48:00:00',
+                    jobname='AGRunner',
+                    np='allprocs',nn=1,
+                    account=None,
+                    prefix=None,
+                    postfix=None
+                    ):
+    ''' Note: exelines are prefixed by appropriate srun commands.
+    Args:
+      queue (str): Slurm partition.
+      account (str): account to charge (default: the user's default account).
+    '''
+    self.exelines=[]
+    self.np=np
+    self.nn=nn
+    self.account=account
+    self.jobname=jobname
+    self.queue=queue
+    self.walltime=walltime
+    if prefix is None: self.prefix=[]
+    else:              self.prefix=prefix
+    if postfix is None: self.postfix=[]
+    else:               self.postfix=postfix
+    self.queueid=[]
+
+  submit_command=['sbatch','--parsable']
+  depend_directive="#SBATCH --dependency=afterok:%s"
+
+  #-------------------------------------
+  def check_status(self,qstat=None):
+    return submitter.check_slurm_stati(self.queueid,qstat=qstat)
+
+  #-------------------------------------
+  def job_id(self,output):
+    ''' Job id from the output of sbatch --parsable ("jobid" or "jobid;cluster").'''
+    return output.split()[0].split(';')[0]
+
+  #-------------------------------------
+  def queue_cache(self):
+    return submitter.slurm_cache()
+
+  #-------------------------------------
+  def queue_index(self):
+    return self.queue_cache().index(self.queueid)
+
+  #-------------------------------------
+  def add_command(self,cmdstr):
+    ''' Accumulate commands that don't get an MPI command.
+    Args: 
+      cmdstr (str): executible statement. 
+    '''
+    self.exelines.append(cmdstr)
+
+  #-------------------------------------
+  def release_commands(self):
+    ''' Return the commands given to the runner and delete them so they aren't run again. '''
+    ret=[line for line in self.exelines]
     self.exelines=[]
+    return ret
+
+  #-------------------------------------
+  def add_task(self,exestr,sentinel=None):
+    ''' Accumulate executable commands.
+    Args: 
+      exestr (str): executible statement. Will be prepended with appropriate srun. 
+      sentinel (str): write sentinel files for the task with this prefix (see sentinels).
+    '''
+
+    if self.np=='allprocs':
+      line="srun {exe}".format(exe=exestr)
+    else:
+      line="srun -n {tnp} {exe}".format(tnp=self.nn*self.np,exe=exestr)
+    self.exelines.append(task_line(line,sentinel,self.nn,task_cores(self.nn,self.np)))
+
+  #-------------------------------------
+  def write_script(self,jobname,path,depend=None):
+    ''' Write the job script for the accumulated commands into path.
+    Args:
+      depend (list): queue ids of jobs to wait for (see dependency).
+    Returns:
+      str: name of the script, or None if there's nothing to run.
+    '''
+    if jobname is None:
+      jobname=self.jobname
+
+    if len(self.exelines)==0:
+      return
+
+    jobout=jobname+'.sbatch.out'
+    sbatch=[
+        "#!/bin/bash",
+        "#SBATCH --partition=%s"%self.queue,
+        "#SBATCH --nodes=%i"%self.nn,
+        "#SBATCH --time=%s"%self.walltime,
+        "#SBATCH --job-name=%s"%jobname,
+        "#SBATCH --output=%s"%jobout,
+      ]
+    if self.np!='allprocs':
+      sbatch.append("#SBATCH --ntasks-per-node=%d"%self.np)
+    if self.account is not None:
+      sbatch.append("#SBATCH --account=%s"%self.account)
+    sbatch+=self.dependency(depend)
+    sbatch+=["cd %s"%path] + self.prefix + self.exelines + self.postfix
+    qsubfile=jobname+".sbatch"
+    with open(os.path.join(path,qsubfile),'w') as f:
+      f.write('\n'.join(sbatch))
     return qsubfile
 
 ####################################################
@@ -288,7 +526,7 @@ class FakeRunner:
     pass
 
   #-------------------------------------
-  def add_task(self,exestr):
+  def add_task(self,exestr,sentinel=None):
     pass
 
   #-------------------------------------
@@ -296,7 +534,7 @@ class FakeRunner:
     return False
 
   #-------------------------------------
-  def submit(self,jobname=None):
+  def submit(self,jobname=None,path=None):
     ''' Submit series of commands.'''
     return ''
 
@@ -313,12 +551,13 @@ class PySCFRunnerLocal:
     return 'done'
 
   #-------------------------------------
-  def add_task(self,exestr):
+  def add_task(self,exestr,sentinel=None):
     ''' Accumulate executable commands.
     Args: 
       exestr (str): executible statement. Will be prepended with appropriate mpirun. 
+      sentinel (str): write sentinel files for the task with this prefix (see sentinels).
     '''
-    self.exelines.append(exestr)
+    self.exelines.append(task_line(exestr,sentinel,nodes=1))
 
   #-------------------------------------
   def script(self,scriptfile):
@@ -336,18 +575,20 @@ class PySCFRunnerLocal:
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
+  def submit(self,jobname=None,ppath=None,path=None):
     ''' Submit series of commands.
-    Note: jobname is not used because it doesn't submit anything.'''
+    Note: jobname is not used because it doesn't submit anything.
+    path (str) is the directory to run the commands in (default: current directory).'''
     sys.path=ppath+sys.path
 
     if len(self.exelines)==0:
       #print(self.__class__.__name__,": All tasks completed or queued.")
       return ''    
 
+    sentinels.submitted(self.exelines)
     try:
       for line in self.exelines:
-        result = sub.check_output(line,shell=True)
+        result = sub.check_output(line,shell=True,cwd=path)
         print(self.__class__.__name__,": executed %s"%line)
     except sub.CalledProcessError as err:
       print(self.__class__.__name__,": Error: {0}".format(err))
@@ -383,12 +624,13 @@ class PySCFRunnerPBS(RunnerPBS):
     self.queueid=[]
 
   #-------------------------------------
-  def add_task(self,exestr):
+  def add_task(self,exestr,sentinel=None):
     ''' Accumulate executable commands.
     Args: 
       exestr (str): executible statement. Will be prepended with appropriate mpirun. 
+      sentinel (str): write sentinel files for the task with this prefix (see sentinels).
     '''
-    self.exelines.append(exestr)
+    self.exelines.append(task_line(exestr,sentinel,self.nn,task_cores(self.nn,self.np)))
 
   #-------------------------------------
   def script(self,scriptfile):
@@ -411,14 +653,28 @@ class PySCFRunnerPBS(RunnerPBS):
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
+  def submit(self,jobname=None,ppath=None,path=None,depend=None):
     ''' Submit any accumulated tasks.
 
     Args:
       jobname (str): name to appear in the queue.
       ppath (list): python path needed for the run (default: current path).
+      path (str): directory the job runs in, and where its script is written (default: current directory).
+      depend (list): queue ids of jobs that must finish successfully before this job starts.
+    '''
+    return QueueSubmission.submit(self,jobname,path,ppath=ppath,depend=depend)
+
+  #-------------------------------------
+  async def asubmit(self,jobname=None,ppath=None,path=None,depend=None):
+    ''' Asynchronous version of submit.'''
+    return await QueueSubmission.asubmit(self,jobname,path,ppath=ppath,depend=depend)
+
+  #-------------------------------------
+  def write_script(self,jobname,path,ppath=None,depend=None):
+    ''' Write the job script for the accumulated commands into path.
+    Returns:
+      str: name of the script, or None if there's nothing to run.
     '''
-      
     if ppath is None: ppath=sys.path
 
     if len(self.exelines)==0: 
@@ -443,23 +699,16 @@ class PySCFRunnerPBS(RunnerPBS):
          "#PBS -j oe",
          "#PBS -N %s"%self.jobname,
          "#PBS -o %s"%jobout,
+       ] + self.dependency(depend) + [
          "cd ${PBS_O_WORKDIR}",
          "export OMP_NUM_THREADS=%d"%(self.nn*self.np),
          "export PYTHONPATH=%s"%(':'.join(ppath)),
          "cwd=`pwd`"
        ] + self.prefix + self.exelines + self.postfix
     qsubfile=jobname+".qsub"
-    with open(qsubfile,'w') as f:
+    with open(os.path.join(path,qsubfile),'w') as f:
       f.write('\n'.join(qsublines))
-    try: 
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
-      print(self.__class__.__name__,": Submitted as %s"%self.queueid)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
-
-    # Clear out the lines to set up for the next job.
-    self.exelines=[]
+    return qsubfile
 
 # TODO Specialize a runner for running QWalk jobs in the same directory together. 
 # Should just have to specialize the run command.
@@ -1,13 +1,51 @@
 #!/usr/bin/env python3
 ''' Simple utilities for interacting with autogen runs.'''
 
-import pickle as pkl
+import os
 import sys
+import json
+import glob
+import time
 import argparse
+from autogenv2 import serialize
+from autogenv2.manager import Manager, write_status, status_is_current
+
+def load_manager(pickle):
+  ''' Load a saved manager ([name].pkl or [name].state.json), including any arrays stored next to it.'''
+  with open(pickle,'rb') as inpf:
+    return serialize.load_state(inpf,os.path.join(os.path.dirname(pickle),'autogen_arrays/'))
+
+def save_manager(pickle,man):
+  ''' Save a manager back to its file, in the same format, with its status record (see manager.ManagerStub).'''
+  fmt='json' if pickle.endswith('.state.json') else 'pickle'
+  with open(pickle+'.tmp','wb') as outf:
+    serialize.dump_state(man,outf,os.path.join(os.path.dirname(pickle),'autogen_arrays/'),fmt)
+  os.replace(pickle+'.tmp',pickle)
+  path,name=manager_name(pickle)
+  write_status(os.path.join(path,name+'.status'),dict(man.status_record(),changed=time.time()))
+
+def manager_name(pickle):
+  ''' Directory and name of a manager from the file it's saved in.'''
+  path,fn=os.path.split(pickle)
+  for ext in ('.state.json','.pkl','.status'):
+    if fn.endswith(ext):
+      fn=fn[:-len(ext)]
+  return path or './',fn
 
 def get_info(pickle):
   print("Info about %s..."%pickle)
-  man=pkl.load(open(pickle,'rb'))
+  path,name=manager_name(pickle)
+  # A state file saved by something other than the manager (or an older autogenv2) is newer than its status.
+  if status_is_current(os.path.join(path,name+'.status'),pickle):
+    stub=Manager.load_stub(path,name)
+    print("  Completed: {}".format(stub.completed))
+    print("  Last status: {}".format(stub.last_status))
+    print("  Queue id: {}".format([qid for qid in stub.queueid if qid not in (stub.pqueueid or [])]))
+    if stub.pqueueid is not None:
+      print("  Properties queue id: {}".format(stub.pqueueid))
+    return
+
+  man=load_manager(pickle)
 
   print("  Queue id: {}".format(man.runner.queueid))
   try:
@@ -23,17 +61,176 @@ def set_attribute(pickle,attr,val):
     val: value of attribute to set.
   '''
   print("Setting %s in %s..."%(attr,pickle))
-  man=pkl.load(open(pickle,'rb'))
+  man=load_manager(pickle)
   man.__dict__[attr]=val
-  pkl.dump(man,open(pickle,'wb'))
+  save_manager(pickle,man)
 
 def set_queueid(pickle,queueid):
-  man=pkl.load(open(pickle,'rb'))
+  man=load_manager(pickle)
   man.runner.queueid.append(str(queueid))
-  pkl.dump(man,open(pickle,'wb'))
+  save_manager(pickle,man)
+
+def migrate(root):
+  ''' Convert the manager pickles under root to the versioned format (see serialize.migrate).'''
+  written=serialize.migrate(root)
+  print("Migrated %d managers."%len(written))
+
+def find_managers(roots):
+  ''' Find the saved managers under some directories.
+  Args:
+    roots (list): directories to search (recursively); shell-style globs are expanded.
+  Returns:
+    list: (directory, names of managers saved there) for each directory with managers.
+  '''
+  found=[]
+  pending=[]
+  for root in roots:
+    pending+=sorted(glob.glob(root)) if glob.has_magic(root) else [root]
+  while len(pending)>0:
+    dirpath=pending.pop()
+    names=[]
+    try:
+      entries=list(os.scandir(dirpath))
+    except (FileNotFoundError,NotADirectoryError):
+      continue
+    for entry in entries:
+      if entry.is_dir(follow_symlinks=False):
+        pending.append(entry.path)
+      elif entry.name.endswith(('.status','.state.json','.pkl')):
+        name=manager_name(entry.name)[1]
+        if name not in names: names.append(name)
+    if len(names)>0:
+      found.append((dirpath,names))
+  return found
+
+def scan_directory(dirpath,names):
+  ''' Status records of the managers saved in a directory.
+  Managers without an up to date status file (saved by an older autogenv2, or changed by hand) are loaded instead.
+  Returns:
+    list: status record (dict) for each manager, see manager.ManagerStub.
+  '''
+  records=[]
+  for name in names:
+    statusfile=os.path.join(dirpath,name+'.status')
+    statefiles=[fn for fn in (os.path.join(dirpath,name+ext) for ext in ('.state.json','.pkl')) if os.path.exists(fn)]
+    if os.path.exists(statusfile) and (len(statefiles)==0 or status_is_current(statusfile,statefiles[0])):
+      with open(statusfile,'r') as inpf:
+        record=json.load(inpf)
+      if record.get('changed') is None: record['changed']=os.path.getmtime(statusfile)
+      records.append(record)
+      continue
+    for ext in ('.state.json','.pkl'):
+      statefile=os.path.join(dirpath,name+ext)
+      if not os.path.exists(statefile):
+        continue
+      try:
+        man=load_manager(statefile)
+      except Exception as err:
+        records.append({'name':name,'path':dirpath,'error':str(err)})
+        break
+      # Other pickles can live next to managers.
+      if getattr(man,'pickle',None)!=name+'.pkl':
+        break
+      record=man.status_record()
+      record['changed']=os.path.getmtime(statefile)
+      records.append(record)
+      break
+  return records
+
+def _scan_task(task):
+  return scan_directory(*task)
+
+def parse_time(text):
+  ''' Time from the command line: seconds since the epoch, a date ('2024-05-01' or '2024-05-01T13:00'),
+  or an age like '30m', '6h', or '2d'.'''
+  units={'s':1,'m':60,'h':3600,'d':86400}
+  if text[-1] in units:
+    return time.time()-float(text[:-1])*units[text[-1]]
+  try:
+    return float(text)
+  except ValueError:
+    pass
+  for fmt in ('%Y-%m-%dT%H:%M:%S','%Y-%m-%dT%H:%M','%Y-%m-%d'):
+    try:
+      return time.mktime(time.strptime(text,fmt))
+    except ValueError:
+      pass
+  raise ValueError("Can't read time '%s'."%text)
+
+def scan(roots=('./',),only_active=False,changed_since=None,jobs=None,store=None):
+  ''' Read the status of every manager under some directories, using a process pool.
+  Args:
+    roots (list): directories to search (recursively); shell-style globs are expanded.
+    only_active (bool): skip managers that are done or out of restarts.
+    changed_since (float): skip managers whose status hasn't changed since this time.
+    jobs (int): number of processes (default: number of CPUs).
+    store (str): read the managers in this StateStore database instead of searching directories.
+  Returns:
+    list: status record (dict) for each manager, see manager.ManagerStub.
+  '''
+  if store is not None:
+    from autogenv2 import statestore
+    records=statestore.open_store(store).records()
+  else:
+    tasks=find_managers(roots)
+    if jobs==1 or len(tasks)<2:
+      results=map(_scan_task,tasks)
+    else:
+      from concurrent.futures import ProcessPoolExecutor
+      with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results=list(pool.map(_scan_task,tasks,chunksize=max(1,len(tasks)//(4*(jobs or os.cpu_count() or 1)))))
+    records=[record for result in results for record in result]
+
+  if only_active:
+    records=[record for record in records if record.get('terminal') is None]
+  if changed_since is not None:
+    records=[record for record in records if (record.get('changed') or 0)>=changed_since]
+  return sorted(records,key=lambda record:(record.get('path',''),record.get('name','')))
+
+def format_scan(records):
+  ''' Table of status records from scan.'''
+  lines=["{:<40} {:<18} {:<20} {:>8} {:<20} {}".format('manager','class','status','restarts','queue ids','energy')]
+  for record in records:
+    if 'error' in record:
+      status='unreadable'
+    else:
+      status=record.get('terminal') or record.get('last_status') or ''
+    if record.get('energy') is None:
+      energy=''
+    elif record.get('energy_err') is None:
+      energy="%.6f"%record['energy']
+    else:
+      energy="%.6f +/- %.6f"%(record['energy'],record['energy_err'])
+    lines.append("{:<40} {:<18} {:<20} {:>8} {:<20} {}".format(
+      os.path.join(record.get('path',''),record.get('name','')),record.get('manager',''),status,
+      record.get('restarts',''),','.join(record.get('queueid',[])),energy))
+  return '\n'.join(lines)
 
 if __name__=='__main__':
 
+  if len(sys.argv)>1 and sys.argv[1]=='scan':
+    parser=argparse.ArgumentParser("Autogen untilities: status of all the managers in a campaign.")
+    parser.add_argument('roots',type=str,nargs='*',default=['./'],help='Directories (or globs) to search recursively.')
+    parser.add_argument('--only-active',action='store_true',help='Skip managers that are done or out of restarts.')
+    parser.add_argument('--changed-since',type=parse_time,default=None,
+        help='Only managers whose status changed since this time (date, epoch seconds, or age like 6h).')
+    parser.add_argument('-j','--jobs',type=int,default=None,help='Number of processes.')
+    parser.add_argument('--store',type=str,default=None,help='Read this StateStore database instead.')
+    parser.add_argument('--json',action='store_true',help='Print JSON instead of a table.')
+    args=parser.parse_args(sys.argv[2:])
+    records=scan(args.roots,args.only_active,args.changed_since,args.jobs,args.store)
+    if args.json:
+      print(json.dumps(records,indent=1))
+    else:
+      print(format_scan(records))
+    sys.exit()
+
+  if len(sys.argv)>1 and sys.argv[1]=='migrate':
+    parser=argparse.ArgumentParser("Autogen untilities: convert manager pickles to the versioned format.")
+    parser.add_argument('root',type=str,nargs='?',default='./',help='Directory to convert (recursively).')
+    migrate(parser.parse_args(sys.argv[2:]).root)
+    sys.exit()
+
   parser=argparse.ArgumentParser("Autogen untilities.")
   parser.add_argument('manager',type=str,help='Pickle file to look at.')
   parser.add_argument('-q','--queueid',default=-1,help='Append this queueid to runner.')
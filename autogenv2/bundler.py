@@ -1,10 +1,117 @@
-import numpy as np
 import subprocess as sub
 import os
+import math
+from autogenv2 import submitter, pilot, walltimes, sentinels
+from autogenv2.autorunner import walltime_seconds, format_walltime
+
+class Column:
+  ''' Nodes of a bundle running a series of managers one after the other.'''
+  def __init__(self,width):
+    self.width=width
+    self.time=0
+    self.mgrs=[]
+
+  def add(self,mgr,seconds):
+    self.mgrs.append(mgr)
+    self.time+=seconds
+
+class Bundle:
+  ''' Managers packed into one allocation, as columns of nodes side by side.
+  The columns run at the same time, each on its own nodes.
+  Attributes:
+    columns (list): Column for each group of nodes.
+    busy (float): node-seconds the managers are expected to use.
+  '''
+  def __init__(self,npb,max_time):
+    self.npb=npb
+    self.max_time=max_time
+    self.columns=[]
+    self.busy=0
+
+  def nodes(self):
+    return sum(column.width for column in self.columns)
+
+  def walltime(self):
+    ''' Seconds the bundle asks for: its longest column, rounded up to minutes.'''
+    longest=max([column.time for column in self.columns],default=0)
+    return min(60*math.ceil(longest/60.),self.max_time)
+
+  def utilization(self):
+    ''' Expected fraction of the bundle's node-hours the managers use; 0 for a bundle that asks for none.'''
+    total=self.nodes()*self.walltime()
+    if total==0:
+      return 0.0
+    return self.busy/float(total)
+
+  def managers(self):
+    return [mgr for column in self.columns for mgr in column.mgrs]
+
+  def place(self,mgr,nn,seconds):
+    ''' Put a manager in the first column of its width with time left, or in a new column if there are nodes left.
+    Returns:
+      bool: whether it fit.
+    '''
+    if seconds>self.max_time:
+      return False
+    for column in self.columns:
+      if column.width==nn and column.time+seconds<=self.max_time:
+        column.add(mgr,seconds)
+        self.busy+=nn*seconds
+        return True
+    # A manager needing more nodes than a bundle has gets a bundle to itself.
+    if self.nodes()+nn<=self.npb or len(self.columns)==0:
+      self.columns.append(Column(nn))
+      self.columns[-1].add(mgr,seconds)
+      self.busy+=nn*seconds
+      return True
+    return False
+
+def pack_bundles(items,npb,max_time):
+  ''' Pack managers into bundles of at most npb nodes and max_time seconds, first-fit decreasing.
+  The biggest managers (in nodes, then time) are placed first, each into the first bundle it fits in.
+  Args:
+    items (list): (manager, nodes, expected seconds) for each manager.
+    npb (int): nodes per bundle.
+    max_time (float): seconds a bundle may run.
+  Returns:
+    tuple: list of Bundle, and list of managers that can't fit in a bundle.
+  '''
+  bundles=[]
+  left_out=[]
+  for mgr,nn,seconds in sorted(items,key=lambda item:(-item[1],-item[2])):
+    if seconds>max_time:
+      left_out.append(mgr)
+      continue
+    for bundle in bundles:
+      if bundle.place(mgr,nn,seconds):
+        break
+    else:
+      bundles.append(Bundle(npb,max_time))
+      bundles[-1].place(mgr,nn,seconds)
+  return bundles,left_out
+
+def packing_report(bundles,left_out=()):
+  ''' Table of the bundles with their expected utilization.'''
+  lines=["%6s %8s %9s %10s %6s"%('bundle','managers','nodes','walltime','used')]
+  busy=0
+  total=0
+  for bidx,bundle in enumerate(bundles):
+    lines.append("%6d %8d %9d %10s %5.0f%%"%(bidx,len(bundle.managers()),bundle.nodes(),
+      format_walltime(bundle.walltime()),100*bundle.utilization()))
+    busy+=bundle.busy
+    total+=bundle.nodes()*bundle.walltime()
+  if total>0:
+    lines.append("Expected to use %.0f%% of %.1f node-hours."%(100*busy/total,total/3600.))
+  for mgr in left_out:
+    lines.append("%s doesn't fit in a bundle's walltime; submitted on its own."%mgr.logname)
+  return '\n'.join(lines)
 
 class Bundler:
   ''' Class for handling the bundling of several jobs of approximately the same 
   length, but possibly in different locations. ''' 
+  script_ext=".qsub"
+  flavor="pbs"
+  jobid_variable="$PBS_JOBID"
   def __init__(self,queue='normal',
                     walltime='48:00:00',
                     jobname='AGBundler',
@@ -12,9 +119,13 @@ class Bundler:
                     mode='xe',
                     account='batr',
                     prefix=None,
-                    postfix=None
+                    postfix=None,
+                    pilot=None,
+                    pilots=1
                     ):
-    ''' npb is the number of nodes desired per bundle. '''
+    ''' npb is the number of nodes desired per bundle. 
+    With walltime='auto', bundles ask for the walltimes predicted for their managers (see walltimes).
+    With a pilot directory, managers are queued there as tasks, and up to pilots jobs of npb nodes run them (see pilot).'''
     self.npb=npb
     self.ppn=ppn
     self.jobname=jobname
@@ -26,65 +137,300 @@ class Bundler:
     else:              self.prefix=prefix
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
+    if pilot is None: self.pilot=None
+    else:             self.pilot=os.path.abspath(pilot)
+    self.pilots=pilots
     self.queueid=[]
 
-  def submit(self,mgrs,jobname=None):
+  def submit(self,mgrs,jobname=None,depend=None):
     ''' Submit a list of managers in bundles.
     Args:
       mgrs (list): list of managers to submit.
       jobname (str): what will appear in qstat.
+      depend (list): queue ids of jobs that must finish successfully before the bundles start.
+    Returns:
+      list: managers longer than a bundle's walltime, which were submitted on their own by their runners instead.
     '''
     print(self.__class__.__name__,"Submitting bundles of jobs.")
     if jobname is None: jobname=self.jobname
+    # A pilot could start chained managers before what they depend on is done.
+    if self.pilot is not None and (depend is None or len(depend)==0):
+      mgrs=self._submit_pilots(mgrs,jobname)
+      if len(mgrs)==0:
+        return []
+
+    bundles,left_out=self.pack(mgrs)
+    print(packing_report(bundles,left_out))
 
-    assign=np.cumsum([mgr.runner.nn for mgr in mgrs])
-    assign=((assign-0.1)//self.npb).astype(int)
+    for mgr in left_out:
+      mgr.submit(depend=depend)
 
-    print(assign)
+    for bidx,bundle in enumerate(bundles):
+      self._submit_bundle(bundle.managers(),"%s_%d"%(jobname,bidx),nn=bundle.nodes(),depend=depend,
+          walltime=format_walltime(bundle.walltime()),
+          columns=[(column.width,column.mgrs) for column in bundle.columns])
+    return left_out
 
-    for bidx in range(assign[-1]+1):
-      self._submit_bundle(np.array(mgrs)[assign==bidx],"%s_%d"%(jobname,bidx))
+  def pack(self,mgrs):
+    ''' Pack managers into bundles of npb nodes and the bundler's walltime, without submitting them.
+    Each manager is expected to take its runner's walltime (or the predicted one, see walltimes).
+    Returns:
+      tuple: list of Bundle, and list of managers that don't fit in a bundle.
+    '''
+    items=[(mgr,mgr.runner.nn,walltimes.requested_seconds(mgr)) for mgr in mgrs]
+    return pack_bundles(items,self.npb,self.max_seconds())
+
+  def max_seconds(self):
+    ''' Longest a bundle may run.'''
+    if self.walltime==walltimes.AUTO:
+      return walltime_seconds(walltimes.FALLBACK)
+    return walltime_seconds(self.walltime)
 
-  def _submit_bundle(self,mgrs,jobname=None,nn=None):
+  def _submit_pilots(self,mgrs,jobname):
+    ''' Queue managers as tasks in the pilot directory, and submit pilot jobs to run them, up to pilots at a time.
+    Returns:
+      list: managers too big for a pilot, left for regular bundles.
+    '''
+    queued=[]
+    too_big=[]
+    for mgr in mgrs:
+      seconds=walltimes.requested_seconds(mgr)
+      if mgr.runner.nn>self.npb or seconds>self.max_seconds()-pilot.MARGIN:
+        too_big.append(mgr)
+        continue
+      lines=mgr.release_commands()
+      if len(lines)>0:
+        pilot.enqueue(self.pilot,mgr,lines,seconds)
+        sentinels.submitted(lines)
+        queued.append(mgr)
+    if len(queued)==0:
+      return too_big
+
+    live=[]
+    for queueid in pilot.pilots(self.pilot):
+      if self._active(queueid):
+        live.append(queueid)
+      else:
+        os.remove(os.path.join(self.pilot,'pilots',queueid))
+    for pidx in range(len(live),self.pilots):
+      queueid=self._submit_pilot("%s_pilot"%jobname)
+      if queueid is not None:
+        live.append(queueid)
+    print("%d tasks queued in %s for pilots %s."%(len(queued),self.pilot,' '.join(live)))
+
+    for mgr in queued:
+      for queueid in live:
+        mgr.update_queueid(queueid)
+    return too_big
+
+  def _submit_pilot(self,jobname):
+    ''' Submit one pilot job.
+    Returns:
+      str: queue id, or None if the submission failed.
+    '''
+    cwd=os.getcwd()
+    hostfile=os.path.join(cwd,jobname+".nodes")
+    seconds=self._pilot_seconds()
+    qsublines=self._header(jobname,self.npb,format_walltime(seconds))+["cd %s"%cwd]+self.prefix+self._node_list(hostfile)+[
+        pilot.pilot_command(self.pilot,hostfile,seconds,self.flavor,self.jobid_variable)
+      ]+self.postfix
+    qsubfile=jobname+self.script_ext
+    with open(qsubfile,'w') as f:
+      f.write('\n'.join(qsublines))
+    queueid=self._queue_submit(qsubfile)
+    if queueid is not None:
+      with open(os.path.join(self.pilot,'pilots',queueid),'w') as f:
+        f.write(jobname+'\n')
+    return queueid
+
+  def _pilot_seconds(self):
+    ''' Walltime of a pilot. With walltime='auto', enough for the queued tasks to run on npb nodes, plus the margin.'''
+    if self.walltime!=walltimes.AUTO:
+      return walltime_seconds(self.walltime)
+    tasks=pilot.ready_tasks(self.pilot)
+    longest=max([task['seconds'] for task in tasks],default=0)
+    spread=sum([task['nodes']*task['seconds'] for task in tasks])/float(self.npb)
+    return min(60*math.ceil((max(longest,spread)+pilot.MARGIN)/60.),self.max_seconds())
+
+  def _active(self,queueid):
+    ''' Whether a job is queued or running.'''
+    return submitter.check_PBS_stati([queueid])=='running'
+
+  def _submit_bundle(self,mgrs,jobname=None,nn=None,depend=None,walltime=None,columns=None):
     ''' Submit a set of runners that require the correct number of nodes.
     This is usually called by submit, after it determines the break-up of jobs.
+    Each column runs in the background on its own slice of the bundle's nodes, its managers one after the other.
+    The exit code of each manager's commands is written to jobname.exit, and the bundle fails if any of them did.
     Args: 
       mgrs (list): list of managers ready for submission. 
       jobname (str): what appears in qstat.
       nn (int): number of nodes to be used for all jobs (default:sum of nn in each manager).
+      depend (list): queue ids of jobs that must finish successfully before this bundle starts.
+      walltime (str): walltime of the bundle (default: the longest a bundle may run).
+      columns (list): (nodes, managers) for each column (default: each manager in its own column).
     '''
-    if nn is None:      nn=sum([mgr.runner.nn for mgr in mgrs])
+    if columns is None: columns=[(mgr.runner.nn,[mgr]) for mgr in mgrs]
+    if nn is None:      nn=sum([width for width,cmgrs in columns])
     if jobname is None: jobname=self.jobname
     cwd=os.getcwd()
+    hostfile=os.path.join(cwd,jobname+".nodes")
+    exitfile=os.path.join(cwd,jobname+".exit")
+
+    if walltime is None: walltime=format_walltime(self.max_seconds())
+    qsublines=self._header(jobname,nn,walltime)+self._dependency(depend)+[
+        "cd %s"%cwd
+      ] + self.prefix + self._node_list(hostfile) + [": > %s"%exitfile]
+    offset=0
+    for cidx,(width,cmgrs) in enumerate(columns):
+      group=[]
+      for mgr in cmgrs:
+        # This might be better without an error-out.
+        lines=mgr.release_commands()
+        if len(lines)>0:
+          group+=["cd %s"%mgr.path]+lines+['echo "$? %s" >> %s'%(mgr.logname,exitfile)]
+      if len(group)>0:
+        qsublines+=["("]+["  "+line for line in self._pin(hostfile,cidx,offset,width)+group]+[") &"]
+      offset+=width
+    qsublines+=["wait","cat %s"%exitfile]+self.postfix+[
+        "awk '$1!=0 {failed=1} END {exit failed}' %s"%exitfile
+      ]
+
+    qsubfile=jobname+self.script_ext
+    with open(qsubfile,'w') as f:
+      f.write('\n'.join(qsublines))
+    queueid=self._queue_submit(qsubfile)
+    if queueid is None:
+      return
+    sentinels.submitted(qsublines)
+
+    for mgr in mgrs:
+      mgr.update_queueid(queueid)
+
+  def _node_list(self,hostfile):
+    ''' Lines writing the bundle's nodes to hostfile, one per line.'''
+    return ["sort -u $PBS_NODEFILE > %s"%hostfile]
 
-    qsublines=[
+  def _pin(self,hostfile,cidx,offset,width):
+    ''' Lines making the launchers of a column run on its own nodes: width nodes from offset in hostfile.'''
+    slice="%s.%d"%(hostfile,cidx)
+    return ["sed -n '%d,%dp' %s > %s"%(offset+1,offset+width,hostfile,slice)]+self.launchers(slice,width)
+
+  @staticmethod
+  def launchers(slice,width):
+    ''' Lines making the launchers run on the width nodes listed in the file slice.
+    The launchers are wrapped in shell functions, so the runners' command lines don't change.
+    '''
+    return [
+        'mpirun() { command mpirun --hostfile %s "$@"; }'%slice,
+        'aprun() { command aprun -L $(sed \'s/^nid0*//\' %s | paste -sd,) "$@"; }'%slice,
+      ]
+
+  def _header(self,jobname,nn,walltime):
+    ''' Scheduler directives for a bundle of nn nodes.'''
+    return [
+        "#!/bin/bash",
         "#PBS -q %s"%self.queue,
         "#PBS -l nodes=%i:ppn=%i:%s"%(nn,self.ppn,self.mode),
-        "#PBS -l walltime=%s"%self.walltime,
+        "#PBS -l walltime=%s"%walltime,
         "#PBS -j oe ",
         "#PBS -A %s"%self.account,
         "#PBS -N %s "%jobname,
         "#PBS -o %s.out "%jobname,
-        "cd %s"%cwd
-      ] + self.prefix
-    for mgr in mgrs:
-      # This might be better without an error-out.
-      lines=mgr.release_commands()
-      if len(lines)>0:
-        qsublines+=["cd %s"%mgr.path]+lines+["cd %s"%cwd]
-    qsublines+=["wait"]+self.postfix
+      ]
 
-    qsubfile=jobname+".qsub"
-    with open(qsubfile,'w') as f:
-      f.write('\n'.join(qsublines))
+  def _dependency(self,depend):
+    ''' Directives holding the bundle until the jobs in depend have finished successfully.'''
+    if depend is None or len(depend)==0:
+      return []
+    return ["#PBS -W depend=afterok:%s"%':'.join(depend)]
+
+  def _queue_submit(self,qsubfile):
+    ''' Submit a bundle script.
+    Returns:
+      str: queue id, or None if the submission failed.
+    '''
     try:
       result=sub.check_output("qsub %s"%(qsubfile),shell=True)
       queueid=result.decode().split()[0].split('.')[0]
+      submitter.qstat_cache().submitted(queueid)
       print("Submitted as %s"%queueid)
+      return queueid
     except sub.CalledProcessError:
       print("Error submitting job. Check queue settings.")
+      return None
+
+class SlurmBundler(Bundler):
+  ''' Bundler for machines running Slurm.
 
+  Calling track before stepping the managers lets all of their status checks share one Slurm query:
+    bundler.track(mgrs)
+    for mgr in mgrs: mgr.nextstep()
+    bundler.submit([mgr for mgr in mgrs if ...])
+  '''
+  script_ext=".sbatch"
+  flavor="slurm"
+  jobid_variable="$SLURM_JOB_ID"
+  def __init__(self,queue='normal',
+                    walltime='48:00:00',
+                    jobname='AGBundler',
+                    npb=16,ppn=32,
+                    account=None,
+                    prefix=None,
+                    postfix=None,
+                    pilot=None,
+                    pilots=1
+                    ):
+    ''' npb is the number of nodes desired per bundle. queue is the Slurm partition.'''
+    Bundler.__init__(self,queue=queue,walltime=walltime,jobname=jobname,npb=npb,ppn=ppn,
+        mode=None,account=account,prefix=prefix,postfix=postfix,pilot=pilot,pilots=pilots)
+
+  def track(self,mgrs):
+    ''' Have the next Slurm query cover the jobs of all these managers.'''
+    queueids=[]
     for mgr in mgrs:
-      mgr.update_queueid(queueid)
+      for attr in ('runner','prunner'):
+        queueids+=getattr(getattr(mgr,attr,None),'queueid',[])
+    submitter.slurm_cache().track(queueids)
 
+  def _node_list(self,hostfile):
+    return ["scontrol show hostnames $SLURM_JOB_NODELIST > %s"%hostfile]
 
+  @staticmethod
+  def launchers(slice,width):
+    return [
+        'srun() { command srun --exclusive --nodes=%d --nodelist=$(paste -sd, %s) "$@"; }'%(width,slice),
+      ]
+
+  def _header(self,jobname,nn,walltime):
+    header=[
+        "#!/bin/bash",
+        "#SBATCH --partition=%s"%self.queue,
+        "#SBATCH --nodes=%i"%nn,
+        "#SBATCH --ntasks-per-node=%i"%self.ppn,
+        "#SBATCH --time=%s"%walltime,
+        "#SBATCH --job-name=%s"%jobname,
+        "#SBATCH --output=%s.out"%jobname,
+      ]
+    if self.account is not None:
+      header.append("#SBATCH --account=%s"%self.account)
+    return header
+
+  def _active(self,queueid):
+    submitter.slurm_cache().track([queueid])
+    return submitter.check_slurm_stati([queueid])=='running'
+
+  def _dependency(self,depend):
+    if depend is None or len(depend)==0:
+      return []
+    return ["#SBATCH --dependency=afterok:%s"%':'.join(depend)]
+
+  def _queue_submit(self,qsubfile):
+    try:
+      result=sub.check_output("sbatch --parsable %s"%(qsubfile),shell=True)
+      queueid=result.decode().split()[0].split(';')[0]
+      submitter.slurm_cache().submitted(queueid)
+      print("Submitted as %s"%queueid)
+      return queueid
+    except sub.CalledProcessError:
+      print("Error submitting job. Check queue settings.")
+      return None
@@ -0,0 +1,189 @@
+''' Stepping many managers at once.
+
+A Campaign steps its managers concurrently with a pool of threads, so the slow parts of the steps
+(qsub calls, reading outputs, saving managers) overlap.
+Each sweep shares one queue listing (see submitter.QstatCache) and one commit per StateStore.
+A manager whose step raises an error is reported, and doesn't stop the others.
+From asyncio code, asweep steps the managers with Manager.astep instead.
+
+Usage:
+  campaign=Campaign(managers,workers=16)
+  print(campaign.sweep())
+'''
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from autogenv2 import submitter
+
+######################################################################
+def manager_state(mgr):
+  ''' Short description of where a manager is: 'done', 'exhausted', its last status, or 'new'.'''
+  return mgr.terminal_state() or mgr.last_status or 'new'
+
+######################################################################
+class SweepReport:
+  ''' What happened in one sweep.
+  Attributes:
+    transitions (dict): number of managers for each (state before, state after) pair (see manager_state).
+    errors (list): (logname, error, traceback) for each manager whose step raised.
+    active (int): number of managers that still have work to do.
+    blocked (dict): logname of each failed manager -> lognames of managers waiting on it (see dag.Scheduler).
+    elapsed (float): seconds the sweep took.
+  '''
+  def __init__(self):
+    self.transitions={}
+    self.errors=[]
+    self.active=0
+    self.blocked={}
+    self.elapsed=0.0
+
+  def add(self,before,after):
+    self.transitions[(before,after)]=self.transitions.get((before,after),0)+1
+
+  def __str__(self):
+    lines=["Sweep took %.1f s, %d managers still active."%(self.elapsed,self.active)]
+    for (before,after),count in sorted(self.transitions.items()):
+      if before==after:
+        lines.append("  %5d %s"%(count,before))
+      else:
+        lines.append("  %5d %s -> %s"%(count,before,after))
+    for logname,error,trace in self.errors:
+      lines.append("  Error in %s: %s"%(logname,error))
+    for logname,stuck in sorted(self.blocked.items()):
+      lines.append("  %d managers blocked by %s"%(len(stuck),logname))
+    return '\n'.join(lines)
+
+######################################################################
+class Campaign:
+  ''' Set of managers stepped together.'''
+  def __init__(self,managers,workers=8):
+    '''
+    Args:
+      managers (list): managers to step.
+      workers (int): number of managers stepped at the same time.
+    '''
+    self.managers=list(managers)
+    self.workers=workers
+
+  #------------------------------------------------
+  def sweep(self,managers=None):
+    ''' Step every manager once.
+    Args:
+      managers (list): only step these managers (default: all of them).
+    Returns:
+      SweepReport: summary of the sweep.
+    '''
+    if managers is None:
+      managers=self.managers
+    start=time.time()
+    with ExitStack() as stack:
+      self._hold_sweep(stack,managers)
+      with ThreadPoolExecutor(max_workers=self.workers) as pool:
+        results=list(pool.map(self._step,managers))
+    return self._report(results,start)
+
+  #------------------------------------------------
+  async def asweep(self,concurrency=None):
+    ''' Step every manager once with Manager.astep, from a running asyncio event loop.
+    Args:
+      concurrency (int): number of managers stepped at the same time (default: workers).
+    Returns:
+      SweepReport: summary of the sweep.
+
+    Usage:
+      report=asyncio.run(campaign.asweep())
+    '''
+    import asyncio
+    start=time.time()
+    semaphore=asyncio.Semaphore(concurrency or self.workers)
+    with ExitStack() as stack:
+      self._hold_sweep(stack)
+      results=await asyncio.gather(*[self._astep(mgr,semaphore) for mgr in self.managers])
+    return self._report(results,start)
+
+  #------------------------------------------------
+  def _hold_sweep(self,stack,managers=None):
+    ''' One queue listing and one commit per store for the whole sweep.
+    Args:
+      managers (list): managers the sweep steps (default: all of them).
+    '''
+    if managers is None:
+      managers=self.managers
+    stack.enter_context(submitter.qstat_cache().sweep())
+    slurmids=self._slurm_queueids(managers)
+    if len(slurmids)>0:
+      submitter.slurm_cache().track(slurmids)
+      stack.enter_context(submitter.slurm_cache().sweep())
+    stores=[]
+    for mgr in managers:
+      if mgr.store is not None and all(mgr.store is not store for store in stores):
+        stores.append(mgr.store)
+    for store in stores:
+      stack.enter_context(store.sweep())
+
+  #------------------------------------------------
+  def _report(self,results,start):
+    report=SweepReport()
+    for before,after,error in results:
+      report.add(before,after)
+      if error is not None:
+        report.errors.append(error)
+      if after not in ('done','exhausted'):
+        report.active+=1
+    report.elapsed=time.time()-start
+    return report
+
+  #------------------------------------------------
+  def run(self,interval=300,max_sweeps=None):
+    ''' Sweep until every manager is done (or out of restarts).
+    Args:
+      interval (float): seconds to wait between sweeps.
+      max_sweeps (int): stop after this many sweeps (default: no limit).
+    Returns:
+      SweepReport: report of the last sweep.
+    '''
+    sweeps=0
+    while True:
+      report=self.sweep()
+      sweeps+=1
+      print(report)
+      if report.active==0 or max_sweeps is not None and sweeps>=max_sweeps:
+        return report
+      time.sleep(interval)
+
+  #------------------------------------------------
+  def _step(self,mgr):
+    ''' Step one manager, catching any error.
+    Returns:
+      tuple: state before, state after, and (logname, error, traceback) or None.
+    '''
+    before=manager_state(mgr)
+    try:
+      mgr.nextstep()
+    except Exception as err:
+      return before,'error',(mgr.logname,repr(err),traceback.format_exc())
+    return before,manager_state(mgr),None
+
+  #------------------------------------------------
+  async def _astep(self,mgr,semaphore):
+    ''' Asynchronous version of _step.'''
+    async with semaphore:
+      before=manager_state(mgr)
+      try:
+        await mgr.astep()
+      except Exception as err:
+        return before,'error',(mgr.logname,repr(err),traceback.format_exc())
+      return before,manager_state(mgr),None
+
+  #------------------------------------------------
+  def _slurm_queueids(self,managers):
+    ''' Queue ids of all the Slurm jobs of some managers, so one Slurm query covers the sweep.'''
+    from autogenv2.autorunner import RunnerSlurm
+    queueids=[]
+    for mgr in managers:
+      for attr in ('runner','prunner'):
+        runner=mgr.__dict__.get(attr)
+        if isinstance(runner,RunnerSlurm):
+          queueids+=runner.queueid
+    return queueids
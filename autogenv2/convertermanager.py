@@ -1,30 +1,31 @@
 import autogenv2
-from autogenv2.manager import resolve_status, update_attributes, Manager
+from autogenv2.manager import resolve_status, update_attributes, stepping, working_directory, Manager
 from autogenv2.autopaths import paths
 import qwalk_objects
 from qwalk_objects.crystal2qmc import pack_objects
 import os
-import pickle as pkl
 import shutil as sh
 
 class ConverterManager(Manager):
   """ Internal class managing process of running a DFT job though crystal.
   Has authority over file names associated with this task.""" 
-  def __init__(self,spin=0,realonly=True,maxbands=(None,None),name='converter',path=None):
+  def __init__(self,spin=0,realonly=True,maxbands=(None,None),name='converter',path=None,store=None):
     ''' CrystalManager manages the writing of a Crystal input file, it's running, and keeping track of the results.
       Args:
         name (str): identifier for this job. This names the files associated with run.
         path (str): where to operate the jobs in.
+        store (StateStore): where to save the manager (None implies its own pickle file in path).
     '''
     # Where to save self.
     self.name=name
     self.pickle="%s.pkl"%self.name
+    self.store=store
 
     # Ensure path is set up correctly.
     if path is None:
       path=os.getcwd()
-    if path[-1]!='/': path+='/'
-    self.path=path
+    # Absolute, so the manager's files don't depend on the working directory.
+    self.path=os.path.abspath(path)+'/'
 
     self.logname="%s@%s"%(self.__class__.__name__,self.path+self.name)
 
@@ -37,17 +38,10 @@ class ConverterManager(Manager):
     self.system = None
     self.orbitals = None
     self.completed = False
+    self.last_status = None
 
-    # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
-      #print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
-      self.recover(old)
-
-    # Update the file.
-    if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    # Handle old results if present, and save.
+    self._boot()
 
   #------------------------------------------------
   def recover(self,other):
@@ -56,29 +50,30 @@ class ConverterManager(Manager):
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
 
     update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['path','logname','name'],
-        take_keys=['restarts','completed','system','orbitals','bundle_ready','scriptfile'])
+        skip_keys=['path','logname','name','store'],
+        take_keys=['restarts','completed','last_status','system','orbitals','bundle_ready','scriptfile'])
 
   #----------------------------------------
+  @stepping
   def nextstep(self,qstat=None):
     ''' Determine and perform the next step in the calculation.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self._reload()
+    if self.terminal_state() is not None:
+      return
 
     print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
 
     if self.system is None or self.orbitals is None:
       print(self.logname,": converting solutions to qwalk.")
-      self.system, self.orbitals = pack_objects(spin=self.spin,maxbands=self.maxbands,realonly=self.realonly)
+      # The converter reads the CRYSTAL outputs from the working directory.
+      with working_directory(self.path):
+        self.system, self.orbitals = pack_objects(spin=self.spin,maxbands=self.maxbands,realonly=self.realonly)
       self.completed = True
     else:
       self.completed = True
+    self.last_status = 'done'
 
-    # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+    self.update_pickle()
 
   #----------------------------------------
   def status(self):
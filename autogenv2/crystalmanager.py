@@ -1,18 +1,17 @@
 import numpy as np
-from autogenv2.manager import resolve_status, update_attributes, Manager
+from autogenv2.manager import resolve_status, update_attributes, stepping, Manager
 from autogenv2.autorunner import RunnerPBS
 from autogenv2.autopaths import paths
 from qwalk_objects.crystal import CrystalReader
 from qwalk_objects.propertiesreader import PropertiesReader
 import os
-import pickle as pkl
 import shutil as sh
 
 class CrystalManager(Manager):
   """ Internal class managing process of running a DFT job though crystal.
   Has authority over file names associated with this task.""" 
   def __init__(self,writer,runner,creader=None,name='crystal_run',path=None, preader=None,prunner=None,
-      bundle=False,max_restarts=2):
+      bundle=False,max_restarts=2,store=None,cache=None):
     ''' CrystalManager manages the writing of a Crystal input file, it's running, and keeping track of the results.
     Args:
       writer (PySCFWriter): writer for input.
@@ -24,16 +23,19 @@ class CrystalManager(Manager):
       name (str): identifier for this job. This names the files associated with run.
       bundle (bool): Whether you'll use a bundling tool to run these jobs.
       max_restarts (int): maximum number of times you'll allow restarting before giving up (and manually intervening).
+      store (StateStore): where to save the manager (None implies its own pickle file in path).
+      cache (ResultCache): reuse results of runs with identical input (None implies always run).
     '''
     # Where to save self.
     self.name=name
     self.pickle="%s.pkl"%self.name
+    self.store=store
 
     # Ensure path is set up correctly.
     if path is None:
       path=os.getcwd()
-    if path[-1]!='/': path+='/'
-    self.path=path
+    # Absolute, so the manager's files don't depend on the working directory.
+    self.path=os.path.abspath(path)+'/'
 
     self.logname="%s@%s"%(self.__class__.__name__,self.path+self.name)
 
@@ -57,22 +59,18 @@ class CrystalManager(Manager):
     self.propoutfn=self.propinpfn+'.o'
     self.restarts=0
     self.completed=False
+    self.last_status=None
     self.bundle=bundle
+    self.cache=cache
+    self.cache_key=None
+    self.recorded_tasks={}
 
     # Smart error detection.
     self.max_restarts=max_restarts
     self.savebroy=[]
 
-    # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
-      print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
-      self.recover(old)
-
-    # Update the file.
-    if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    # Handle old results if present, and save.
+    self._boot()
 
   #------------------------------------------------
   def recover(self,other):
@@ -82,9 +80,10 @@ class CrystalManager(Manager):
 
     update_attributes(copyto=self,copyfrom=other,
         skip_keys=['writer','runner','creader','preader','prunner','savebroy',
-                   'path','logname','name',
+                   'path','logname','name','store','cache',
                    'max_restarts','bundle'],
-        take_keys=['restarts','completed','qwalk_orbs','qwalk_sys','bundle_ready','scriptfile'])
+        take_keys=['restarts','completed','last_status','cache_key','qwalk_orbs','qwalk_sys','bundle_ready','scriptfile',
+                   'recorded_tasks'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
@@ -109,66 +108,87 @@ class CrystalManager(Manager):
       self.writer.completed=False
 
   #----------------------------------------
+  @stepping
   def nextstep(self,qstat=None):
     ''' Determine and perform the next step in the calculation.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self._reload()
+    if self.terminal_state() is not None:
+      return
 
     print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
+    self.record_runtimes()
 
     # Generate input files.
+    # Relative guess files are relative to the manager's path.
     if not self.writer.completed:
       if self.writer.guess_fort is not None:
-        sh.copy(self.writer.guess_fort,'fort.20')
+        sh.copy(os.path.join(self.path,self.writer.guess_fort),self.path+'fort.20')
       if self.writer.guess_fort13 is not None:
-        sh.copy(self.writer.guess_fort,'in.fort.13') # save copy in case it's overwritten.
-        sh.copy(self.writer.guess_fort,'fort.13')
-      with open(self.crysinpfn,'w') as f:
-        self.writer.write_crys_input(self.crysinpfn)
-      with open(self.propinpfn,'w') as f:
-        self.writer.write_prop_input(self.propinpfn)
+        sh.copy(os.path.join(self.path,self.writer.guess_fort),self.path+'in.fort.13') # save copy in case it's overwritten.
+        sh.copy(os.path.join(self.path,self.writer.guess_fort),self.path+'fort.13')
+      with open(self.path+self.crysinpfn,'w') as f:
+        self.writer.write_crys_input(self.path+self.crysinpfn)
+      with open(self.path+self.propinpfn,'w') as f:
+        self.writer.write_prop_input(self.path+self.propinpfn)
 
     # Check on the CRYSTAL run
-    status=resolve_status(self.runner,self.creader,self.crysoutfn,qstat=qstat)
+    status=resolve_status(self.runner,self.creader,self.path+self.crysoutfn,qstat=qstat,sentinel=self.path+self.crysoutfn)
     print(self.logname,": status= %s"%(status))
 
+    if status=="not_started" and self._fetch_cached(self.cache_inputs(),paths['Pcrystal']):
+      status="ready_for_analysis"
+
     if status=="not_started":
       self.runner.add_command("cp %s INPUT"%self.crysinpfn)
-      self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+      self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn),sentinel=self.path+self.crysoutfn)
 
     elif status=="ready_for_analysis":
       #This is where we (eventually) do error correction and resubmits
-      status=self.creader.collect(self.crysoutfn)
+      status=self.creader.collect(self.path+self.crysoutfn)
       print(self.logname,": status %s"%status)
       if status=='killed':
         if self.restarts >= self.max_restarts:
           print(self.logname,": restarts exhausted (%d previous restarts). Human intervention required."%self.restarts)
+          status='exhausted'
         else:
           print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
           self.writer.restart=True
-          sh.copy(self.crysinpfn,"%d.%s"%(self.restarts,self.crysinpfn))
-          sh.copy(self.crysoutfn,"%d.%s"%(self.restarts,self.crysoutfn))
-          sh.copy('fort.79',"%d.fort.79"%(self.restarts))
+          sh.copy(self.path+self.crysinpfn,self.path+"%d.%s"%(self.restarts,self.crysinpfn))
+          sh.copy(self.path+self.crysoutfn,self.path+"%d.%s"%(self.restarts,self.crysoutfn))
+          sh.copy(self.path+'fort.79',self.path+"%d.fort.79"%(self.restarts))
           self.writer.guess_fort='./fort.79'
-          sh.copy(self.writer.guess_fort,'fort.20')
-          self.writer.write_crys_input(self.crysinpfn)
+          sh.copy(os.path.join(self.path,self.writer.guess_fort),self.path+'fort.20')
+          self.writer.write_crys_input(self.path+self.crysinpfn)
           self.runner.add_command("cp %s INPUT"%self.crysinpfn)
-          self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+          self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn),sentinel=self.path+self.crysoutfn)
           self.restarts+=1
+      elif self.creader.completed:
+        self._store_cached()
 
     # Ready for bundler or else just submit the jobs as needed.
     if not self.bundle:
-      qsubfile=self.runner.submit()
+      qsubfile=self._submit(self.runner)
 
     self.completed=self.creader.completed
+    self.last_status=status
+
+    self.update_pickle()
 
-    # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+  #----------------------------------------
+  def cache_inputs(self):
+    ''' Input files that determine the result of the crystal run.'''
+    inputs=[self.crysinpfn]
+    if self.writer.guess_fort is not None: inputs.append('fort.20')
+    if self.writer.guess_fort13 is not None: inputs.append('fort.13')
+    return inputs
+
+  #----------------------------------------
+  def cache_outputs(self):
+    ''' Outputs of the crystal run kept by the result cache.'''
+    return {'output':self.crysoutfn,'fort.9':'fort.9','fort.98':'fort.98'}
 
   #----------------------------------------
+  @stepping
   def collect(self):
     ''' Call the collect routine for readers.'''
     print(self.logname,": collecting results.")
@@ -177,32 +197,42 @@ class CrystalManager(Manager):
     self.update_pickle()
 
   #------------------------------------------------
+  def collect_finished(self):
+    ''' Done for exporting: the CRYSTAL run is completed and its properties run has finished.
+    The properties output is read into memory, without rerunning or saving (see Manager.collect_finished).'''
+    if not self.completed:
+      return False
+    status=resolve_status(self.prunner,self.preader,self.path+self.propoutfn,sentinel=self.path+self.propoutfn)
+    if status=='ready_for_analysis':
+      self.preader.collect(self.path+self.propoutfn)
+    return bool(self.preader.completed)
+
+  #------------------------------------------------
+  @stepping
   def ready_properties(self):
     ''' Run properties for WF exporting.
     Returns:
       bool: whether it was successful.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self._reload()
 
     ready=False
 
     if not self.completed:
       return False
-
-    cwd=os.getcwd()
-    os.chdir(self.path)
+    self.record_runtimes()
 
     # Check on the properties run
-    status=resolve_status(self.prunner,self.preader,self.propoutfn)
+    status=resolve_status(self.prunner,self.preader,self.path+self.propoutfn,sentinel=self.path+self.propoutfn)
     print(self.logname,": properties status= %s"%(status))
     if status=='not_started':
       ready=False
       self.prunner.add_command("cp %s INPUT"%self.propinpfn)
-      self.prunner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn))
+      self.prunner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn),sentinel=self.path+self.propoutfn)
 
       if not self.bundle:
-        qsubfile=self.prunner.submit()
+        qsubfile=self._submit(self.prunner)
     elif status=='ready_for_analysis':
-      self.preader.collect(self.propoutfn)
+      self.preader.collect(self.path+self.propoutfn)
 
     if self.preader.completed:
       ready=True
@@ -211,11 +241,19 @@ class CrystalManager(Manager):
       ready=False
       print(self.logname,": properties run incomplete.")
 
-    os.chdir(cwd)
     self.update_pickle()
 
     return ready
 
+  #----------------------------------------
+  def energy(self):
+    ''' Total energy from the CRYSTAL output, if it's been read.'''
+    return getattr(self.creader,'output',{}).get('total_energy'),None
+
+  #----------------------------------------
+  def task_sentinels(self):
+    return [self.path+self.crysoutfn,self.path+self.propoutfn]
+
   #----------------------------------------
   def export_record(self):
     ''' Combine input and results into convenient dict.'''
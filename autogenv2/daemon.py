@@ -0,0 +1,256 @@
+''' Long-running driver for a campaign.
+
+The daemon steps each manager only when it's due for a check, instead of stepping everything every few minutes.
+A manager whose state just changed is checked again soon. A manager whose state doesn't change, whatever it is
+(queued, running, or failing to submit), is checked less and less often,
+but a running task is checked again around when its walltime runs out (see sentinels), and a job far back in the queue is checked less often than one about to start.
+After every wake, the daemon writes a heartbeat file with a summary of the campaign.
+
+Usage:
+  python -m autogenv2.daemon [directories] [--store autogen.db] [--dag]
+or from a script:
+  Daemon(Campaign(managers)).run()
+'''
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+from autogenv2 import sentinels, walltimes
+from autogenv2.campaign import Campaign, manager_state
+
+# Number of jobs ahead in the queue that add one min_interval to the time between checks.
+QUEUE_STEP=20
+
+######################################################################
+def running_since(mgr):
+  ''' When the manager's running task started, from its sentinels, or None if no task is running.'''
+  started=None
+  for sentinel in mgr.task_sentinels():
+    if sentinels.state(sentinel)=='started':
+      info=sentinels.read(sentinel)
+      if info is not None and (started is None or info['start']>started):
+        started=info['start']
+  return started
+
+######################################################################
+def queue_position(mgr):
+  ''' Number of jobs waiting ahead of the manager's job, or None if it isn't waiting in a queue.'''
+  runner=mgr.__dict__.get('runner')
+  if not hasattr(runner,'queue_index') or len(runner.queueid)==0:
+    return None
+  index=runner.queue_index()
+  if index is None:
+    return None
+  return index.position(runner.queueid[-1])
+
+######################################################################
+class Daemon:
+  ''' Steps the managers of a campaign as they come due.'''
+  def __init__(self,campaign,heartbeat='autogen_daemon.json',min_interval=60,max_interval=3600):
+    '''
+    Args:
+      campaign (Campaign): managers to step (a dag.Scheduler follows their dependencies).
+      heartbeat (str): file to write the status of the daemon to after every wake.
+      min_interval (float): seconds until the next check of a manager whose state just changed.
+      max_interval (float): longest time between checks of an unfinished manager.
+    '''
+    self.campaign=campaign
+    self.heartbeat=heartbeat
+    self.min_interval=min_interval
+    self.max_interval=max_interval
+    # Time of the next check, and time since the last one, for each manager.
+    self.due={}
+    self.interval={}
+    self.wakes=0
+    self._stop=threading.Event()
+    now=time.time()
+    for mgr in campaign.managers:
+      if mgr.terminal_state() is None:
+        self.due[self._key(mgr)]=now
+        self.interval[self._key(mgr)]=min_interval
+
+  #------------------------------------------------
+  def _key(self,mgr):
+    return mgr.path+mgr.name
+
+  #------------------------------------------------
+  def due_managers(self,now=None):
+    ''' Managers due for a check.'''
+    if now is None:
+      now=time.time()
+    return [mgr for mgr in self.campaign.managers if self.due.get(self._key(mgr),float('inf'))<=now]
+
+  #------------------------------------------------
+  def wake(self):
+    ''' Step the managers that are due, and plan their next checks.
+    Returns:
+      SweepReport: report of the sweep (None if nothing was due).
+    '''
+    due=self.due_managers()
+    report=None
+    if len(due)>0:
+      before=dict((self._key(mgr),manager_state(mgr)) for mgr in self.campaign.managers)
+      report=self.campaign.sweep(due)
+      now=time.time()
+      stepped=set(self._key(mgr) for mgr in due)
+      for mgr in self.campaign.managers:
+        key=self._key(mgr)
+        changed=manager_state(mgr)!=before[key]
+        if key in stepped or changed:
+          self.plan(mgr,changed,now)
+    self.wakes+=1
+    self.write_heartbeat(report)
+    return report
+
+  #------------------------------------------------
+  def plan(self,mgr,changed,now):
+    ''' Set when a manager is checked next.
+    Args:
+      mgr (Manager): manager just checked.
+      changed (bool): whether its state changed in the check.
+      now (float): time of the check.
+    '''
+    key=self._key(mgr)
+    if mgr.terminal_state() is not None:
+      self.due.pop(key,None)
+      self.interval.pop(key,None)
+      self._wake_downstream(key,now)
+      return
+
+    graph=getattr(self.campaign,'graph',None)
+    if graph is not None and not graph.ready(key):
+      # Woken up when what it waits for is done (see _wake_downstream).
+      self.interval[key]=self.max_interval
+      self.due[key]=now+self.max_interval
+      return
+
+    if changed:
+      interval=self.min_interval
+    else:
+      interval=min(2*self.interval.get(key,self.min_interval),self.max_interval)
+
+    started=running_since(mgr)
+    walltime=getattr(mgr.__dict__.get('runner'),'walltime',None)
+    if started is not None and isinstance(walltime,str):
+      # Check again by the time the task has to be done.
+      remaining=started+walltimes.requested_seconds(mgr)-now
+      interval=min(interval,max(remaining,self.min_interval))
+    elif started is None:
+      position=queue_position(mgr)
+      if position is not None:
+        interval=min(max(interval,self.min_interval*(1+position//QUEUE_STEP)),self.max_interval)
+
+    self.interval[key]=interval
+    self.due[key]=now+interval
+
+  #------------------------------------------------
+  def _wake_downstream(self,key,now):
+    ''' Managers waiting on a finished manager are due right away (for a dag.Scheduler).'''
+    graph=getattr(self.campaign,'graph',None)
+    if graph is None:
+      return
+    for down in graph.downstream.get(key,()):
+      if down in self.due:
+        self.due[down]=now
+        self.interval[down]=self.min_interval
+
+  #------------------------------------------------
+  def write_heartbeat(self,report=None):
+    ''' Write the state of the daemon to the heartbeat file.'''
+    if self.heartbeat is None:
+      return
+    states={}
+    for mgr in self.campaign.managers:
+      state=manager_state(mgr)
+      states[state]=states.get(state,0)+1
+    beat={
+        'pid':os.getpid(),
+        'host':socket.gethostname(),
+        'time':time.time(),
+        'wakes':self.wakes,
+        'managers':len(self.campaign.managers),
+        'active':len(self.due),
+        'states':states,
+        'next_wake':min(self.due.values()) if len(self.due)>0 else None,
+        'last_sweep':None if report is None else str(report),
+        'errors':[] if report is None else [(logname,error) for logname,error,trace in report.errors],
+      }
+    with open(self.heartbeat+'.tmp','w') as outf:
+      json.dump(beat,outf,indent=1)
+    os.replace(self.heartbeat+'.tmp',self.heartbeat)
+
+  #------------------------------------------------
+  def run(self,max_wakes=None):
+    ''' Wake as managers come due, until they're all done (or out of restarts), or the daemon is stopped.
+    Args:
+      max_wakes (int): stop after this many wakes (default: no limit).
+    '''
+    while not self._stop.is_set():
+      report=self.wake()
+      if report is not None:
+        print(report)
+      if len(self.due)==0 or max_wakes is not None and self.wakes>=max_wakes:
+        break
+      self._stop.wait(max(min(self.due.values())-time.time(),0))
+
+  #------------------------------------------------
+  def stop(self,*args):
+    ''' Stop running after the current wake. Also a signal handler.'''
+    self._stop.set()
+
+######################################################################
+def load_managers(roots=('./',),store=None):
+  ''' Load all the managers saved under some directories, or in a store.'''
+  from autogenv2.autoutil import find_managers
+  from autogenv2.manager import Manager
+  if store is not None:
+    found=[(record['path'],[record['name']]) for record in store.records()]
+  else:
+    found=find_managers(roots)
+  managers=[]
+  for path,names in found:
+    for name in names:
+      try:
+        mgr=Manager.load(path,name,store)
+      except Exception as err:
+        print("Couldn't load %s in %s: %s"%(name,path,err))
+        continue
+      # Other pickles can live next to managers.
+      if isinstance(mgr,Manager) and getattr(mgr,'pickle',None)==name+'.pkl':
+        managers.append(mgr)
+  return managers
+
+######################################################################
+if __name__=='__main__':
+  parser=argparse.ArgumentParser("Step the managers of a campaign as they come due.")
+  parser.add_argument('roots',type=str,nargs='*',default=['./'],help='Directories (or globs) to search for managers.')
+  parser.add_argument('--store',type=str,default=None,help='Step the managers in this StateStore database instead.')
+  parser.add_argument('--dag',action='store_true',help='Follow the dependencies between managers (see dag.Scheduler).')
+  parser.add_argument('--chain',action='store_true',help='With --dag, queue waiting jobs behind the jobs they wait for.')
+  parser.add_argument('-j','--workers',type=int,default=8,help='Number of managers stepped at the same time.')
+  parser.add_argument('--min-interval',type=float,default=60,help='Seconds until managers whose state changed are checked again.')
+  parser.add_argument('--max-interval',type=float,default=3600,help='Longest time between checks of a manager.')
+  parser.add_argument('--heartbeat',type=str,default='autogen_daemon.json',help='Heartbeat file.')
+  args=parser.parse_args()
+
+  store=None
+  if args.store is not None:
+    from autogenv2 import statestore
+    store=statestore.open_store(args.store)
+  managers=load_managers(args.roots,store)
+  if args.dag:
+    from autogenv2.dag import Scheduler
+    campaign=Scheduler(managers,workers=args.workers,chain=args.chain)
+  else:
+    campaign=Campaign(managers,workers=args.workers)
+  print("Daemon %d: %d managers."%(os.getpid(),len(campaign.managers)))
+
+  daemon=Daemon(campaign,args.heartbeat,args.min_interval,args.max_interval)
+  signal.signal(signal.SIGTERM,daemon.stop)
+  signal.signal(signal.SIGINT,daemon.stop)
+  daemon.run()
+  sys.exit(0)
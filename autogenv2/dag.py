@@ -0,0 +1,300 @@
+''' Dependencies between managers, and stepping them in order.
+
+The dependencies are found from the managers themselves:
+  - a QWalkManager depends on the managers in its trial function (slater and jastrow managers).
+  - a ConverterManager depends on the CrystalManager in the same directory, whose outputs it converts.
+
+A Scheduler only steps managers whose dependencies are done, most critical first,
+and reports which parts of the graph are stuck behind a failed manager.
+
+Usage:
+  scheduler=Scheduler(managers,workers=16)
+  scheduler.run()
+'''
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from autogenv2.manager import Manager
+from autogenv2.campaign import Campaign, manager_state
+
+# Managers reachable through more levels of attributes than this aren't counted as dependencies.
+MAX_DEPTH=4
+
+######################################################################
+def node_key(mgr):
+  ''' Managers built separately for the same files are the same node.'''
+  return mgr.path+mgr.name
+
+######################################################################
+def referenced_managers(obj,depth=MAX_DEPTH):
+  ''' Managers held by obj, through its attributes, lists, and dicts.'''
+  found=[]
+  seen=set()
+  def visit(item,depth):
+    if id(item) in seen:
+      return
+    seen.add(id(item))
+    if isinstance(item,Manager):
+      found.append(item)
+      return
+    if depth==0:
+      return
+    if isinstance(item,dict):
+      children=item.values()
+    elif isinstance(item,(list,tuple,set)):
+      children=item
+    elif hasattr(item,'__dict__'):
+      children=item.__dict__.values()
+    else:
+      return
+    for child in children:
+      visit(child,depth-1)
+  visit(obj,depth)
+  return found
+
+######################################################################
+def upstream_managers(mgr,managers=()):
+  ''' Managers that mgr needs to be done before it can do its work.
+  Args:
+    mgr (Manager): manager to check.
+    managers (list): other managers, to find those in the same directory.
+  Returns:
+    list: managers mgr depends on.
+  '''
+  upstream=referenced_managers(mgr.__dict__.get('trialfunc'))
+  # No ConverterManager can exist unless its module (which needs qwalk_objects) was imported.
+  if 'autogenv2.convertermanager' not in sys.modules:
+    return upstream
+  from autogenv2.convertermanager import ConverterManager
+  from autogenv2.crystalmanager import CrystalManager
+  if isinstance(mgr,ConverterManager):
+    upstream+=[other for other in managers if isinstance(other,CrystalManager) and other.path==mgr.path]
+  return upstream
+
+######################################################################
+class ManagerGraph:
+  ''' Dependency graph of a set of managers.
+  Managers found as dependencies are added to the graph, even if they weren't in the list.
+  Attributes:
+    nodes (dict): node_key -> manager.
+    upstream (dict): node_key -> set of node_keys it depends on.
+    downstream (dict): node_key -> set of node_keys depending on it.
+  '''
+  def __init__(self,managers):
+    self.nodes={}
+    self.upstream={}
+    self.downstream={}
+    pending=list(managers)
+    while len(pending)>0:
+      mgr=pending.pop(0)
+      key=node_key(mgr)
+      if key in self.nodes:
+        continue
+      self.nodes[key]=mgr
+      pending+=upstream_managers(mgr)
+    # Managers in the same directory are only known once all the managers are found.
+    everyone=list(self.nodes.values())
+    for key,mgr in self.nodes.items():
+      self.upstream[key]=set(node_key(other) for other in upstream_managers(mgr,everyone))-set([key])
+      self.downstream.setdefault(key,set())
+      for up in self.upstream[key]:
+        self.downstream.setdefault(up,set()).add(key)
+
+  #------------------------------------------------
+  def order(self):
+    ''' Node keys with every node after the nodes it depends on.
+    Raises:
+      ValueError: if the dependencies have a cycle.
+    '''
+    remaining=dict((key,len(up)) for key,up in self.upstream.items())
+    ready=sorted(key for key,count in remaining.items() if count==0)
+    order=[]
+    while len(ready)>0:
+      key=ready.pop(0)
+      order.append(key)
+      for down in sorted(self.downstream[key]):
+        remaining[down]-=1
+        if remaining[down]==0:
+          ready.append(down)
+    if len(order)<len(self.nodes):
+      raise ValueError("Dependency cycle among: %s"%', '.join(sorted(set(self.nodes)-set(order))))
+    return order
+
+  #------------------------------------------------
+  def critical_path(self,cost=None):
+    ''' Length of the longest chain of unfinished work starting at each node.
+    Stepping the nodes with the longest chains first gets the whole graph done soonest.
+    Args:
+      cost (function): cost(manager) of a node (default: 1 for each unfinished manager).
+    Returns:
+      dict: node_key -> cost of the node plus its most costly chain of downstream nodes.
+    '''
+    if cost is None:
+      cost=lambda mgr: 0 if mgr.terminal_state() is not None else 1
+    length={}
+    for key in reversed(self.order()):
+      length[key]=cost(self.nodes[key])+max([length[down] for down in self.downstream[key]],default=0)
+    return length
+
+  #------------------------------------------------
+  def ready(self,key):
+    ''' Whether all the managers the node depends on are done.'''
+    return all(self.nodes[up].completed for up in self.upstream[key])
+
+  #------------------------------------------------
+  def blocked(self):
+    ''' Parts of the graph that can't finish because a manager they depend on failed for good.
+    Returns:
+      dict: logname of each exhausted manager -> lognames of the unfinished managers depending on it.
+    '''
+    blocked={}
+    for key,mgr in self.nodes.items():
+      if mgr.terminal_state()!='exhausted':
+        continue
+      stuck=[]
+      pending=list(self.downstream[key])
+      seen=set(pending)
+      while len(pending)>0:
+        down=pending.pop(0)
+        if not self.nodes[down].completed:
+          stuck.append(self.nodes[down].logname)
+        for further in self.downstream[down]:
+          if further not in seen:
+            seen.add(further)
+            pending.append(further)
+      if len(stuck)>0:
+        blocked[mgr.logname]=sorted(stuck)
+    return blocked
+
+######################################################################
+class Scheduler(Campaign):
+  ''' Campaign that only steps managers whose dependencies are done.
+  Managers are started in order of their critical path (see ManagerGraph.critical_path), and managers
+  that become ready during a sweep are stepped in the same sweep.
+  '''
+  def __init__(self,managers,workers=8,cost=None,chain=False):
+    '''
+    Args:
+      managers (list): managers to step. Their dependencies are stepped too.
+      workers (int): number of managers stepped at the same time.
+      cost (function): cost(manager) of each node, for the critical path (see ManagerGraph.critical_path).
+      chain (bool): queue waiting managers behind the jobs they wait for (see chain_waiting).
+    '''
+    self.graph=ManagerGraph(managers)
+    Campaign.__init__(self,self.graph.nodes.values(),workers=workers)
+    self.cost=cost
+    self.chain=chain
+
+  #------------------------------------------------
+  def runnable(self,skip=(),only=None):
+    ''' Keys of the managers with work to do whose dependencies are done, most critical first.
+    Args:
+      skip (set): keys to leave out.
+      only (set): only consider these keys (default: all).
+    '''
+    length=self.graph.critical_path(self.cost)
+    keys=[key for key,mgr in self.graph.nodes.items()
+        if key not in skip and (only is None or key in only) and mgr.terminal_state() is None and self.graph.ready(key)]
+    keys.sort(key=lambda key:(-length[key],key))
+    return keys
+
+  #------------------------------------------------
+  def sweep(self,managers=None):
+    ''' Step every manager that can make progress once.
+    Args:
+      managers (list): only step these managers, and those they let start (default: all of them).
+    Returns:
+      SweepReport: summary of the sweep, including the managers still waiting on others and blocked ones.
+    '''
+    start=time.time()
+    only=None if managers is None else set(node_key(mgr) for mgr in managers)
+    stepped=set()
+    results=[]
+    with ExitStack() as stack:
+      self._hold_sweep(stack)
+      with ThreadPoolExecutor(max_workers=self.workers) as pool:
+        # Stepping a manager can finish it, readying the ones that depend on it.
+        while True:
+          keys=self.runnable(skip=stepped,only=only)
+          if len(keys)==0:
+            break
+          stepped.update(keys)
+          results+=pool.map(self._step,[self.graph.nodes[key] for key in keys])
+          only=self._let_start(only,keys)
+      if self.chain:
+        self.chain_waiting()
+
+    return self._scheduled_report(results,stepped,start)
+
+  #------------------------------------------------
+  async def asweep(self,concurrency=None):
+    ''' Asynchronous version of sweep (see Campaign.asweep).'''
+    import asyncio
+    start=time.time()
+    semaphore=asyncio.Semaphore(concurrency or self.workers)
+    stepped=set()
+    results=[]
+    with ExitStack() as stack:
+      self._hold_sweep(stack)
+      while True:
+        keys=self.runnable(skip=stepped)
+        if len(keys)==0:
+          break
+        stepped.update(keys)
+        results+=await asyncio.gather(*[self._astep(self.graph.nodes[key],semaphore) for key in keys])
+      if self.chain:
+        await asyncio.get_running_loop().run_in_executor(None,self.chain_waiting)
+    return self._scheduled_report(results,stepped,start)
+
+  #------------------------------------------------
+  def _let_start(self,only,keys):
+    ''' Add the managers depending on the finished managers among keys to only.'''
+    if only is None:
+      return None
+    for key in keys:
+      if self.graph.nodes[key].completed:
+        only|=self.graph.downstream[key]
+    return only
+
+  #------------------------------------------------
+  def chain_waiting(self):
+    ''' Queue the managers waiting on jobs in the queue behind those jobs, with afterok dependencies.
+    Only managers that can chain (see QWalkManager.chain) are queued, behind managers that can chain;
+    other dependencies have to be done.
+    Returns:
+      list: keys of the managers queued.
+    '''
+    chained=[]
+    for key in self.graph.order():
+      mgr=self.graph.nodes[key]
+      if not hasattr(mgr,'chain') or mgr.terminal_state() is not None or mgr.last_status=='chained' \
+          or self.graph.ready(key):
+        continue
+      depend=[]
+      for up in self.graph.upstream[key]:
+        upmgr=self.graph.nodes[up]
+        if upmgr.completed:
+          continue
+        if not hasattr(upmgr,'chain') or upmgr.runner.check_status()!='running' or len(upmgr.runner.queueid)==0:
+          break
+        depend.append(upmgr.runner.queueid[-1])
+      else:
+        if mgr.chain(depend):
+          chained.append(key)
+    return chained
+
+  #------------------------------------------------
+  def _scheduled_report(self,results,stepped,start):
+    ''' Report of a sweep, counting the managers that weren't stepped.'''
+    report=self._report(results,start)
+    for key,mgr in self.graph.nodes.items():
+      if key not in stepped:
+        state=manager_state(mgr)
+        if mgr.terminal_state() is None:
+          report.active+=1
+          if not self.graph.ready(key):
+            state='waiting'
+        report.add(state,state)
+    report.blocked=self.graph.blocked()
+    return report
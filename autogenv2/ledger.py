@@ -0,0 +1,200 @@
+''' Append-only record of how long each task took, and on how many nodes.
+
+When a manager steps, each of its tasks that finished since its last step is added to the ledger as one JSON line:
+  {"manager": "QWalkManager", "name": "dmc", "path": "/scratch/si/", "stage": "qw_dmc.o", "task": 0, "restarts": 0,
+   "system_size": 16, "settings": {"writer": "DMCWriter", "nblock": 16, "timestep": 0.01},
+   "submitted": ..., "start": ..., "end": ..., "exit_code": 0, "host": "nid01234",
+   "nodes": 4, "cores": 128, "node_hours": 9.6}
+These records are what the walltime estimator learns from (see walltimes).
+The times come from the task's sentinel files (see sentinels), so tasks run by bundles and pilots are recorded too.
+The submitted time is when the task's job reached the queue (or the pilot queue), so start-submitted is the wait in the queue.
+
+The ledger is the file in $AUTOGEN_LEDGER if it's set, next to the manager's state store if it has one,
+or autogen_ledger.jsonl in the manager's path.
+
+Usage:
+  python -m autogenv2.ledger [ledger files or directories] [--by manager system_size restarts]
+'''
+import os
+import json
+import argparse
+from autogenv2 import sentinels
+
+LEDGER_NAME="autogen_ledger.jsonl"
+
+######################################################################
+def ledger_file(mgr):
+  ''' Ledger a manager's tasks are recorded in.'''
+  if os.environ.get('AUTOGEN_LEDGER'):
+    return os.environ['AUTOGEN_LEDGER']
+  if mgr.store is not None:
+    return mgr.store.dbfile+'.ledger.jsonl'
+  return mgr.path+LEDGER_NAME
+
+######################################################################
+def append(fn,records):
+  ''' Add records to the end of a ledger file.
+  Each record is written in one call to a file opened for appending, so processes can share a ledger.'''
+  if len(records)==0:
+    return
+  with open(fn,'a') as outf:
+    outf.write(''.join(json.dumps(record,sort_keys=True)+'\n' for record in records))
+
+######################################################################
+def count_atoms(writer):
+  ''' Number of atoms in the input of a writer (None if it can't be told).
+  Reads an xyz string (PySCF) or a structure with sites (CRYSTAL), times the size of the supercell.'''
+  natoms=None
+  xyz=getattr(writer,'xyz',None)
+  struct=getattr(writer,'struct',None)
+  if isinstance(xyz,str):
+    natoms=len([line for line in xyz.replace(';','\n').split('\n') if len(line.split())>=4])
+  elif isinstance(struct,dict) and 'sites' in struct:
+    natoms=len(struct['sites'])
+  if natoms is None:
+    return None
+  cells=supercell_cells(getattr(writer,'supercell',None))
+  if cells is not None:
+    natoms*=cells
+  return natoms
+
+######################################################################
+def supercell_cells(supercell):
+  ''' Number of primitive cells in a 3x3 supercell matrix (None if it isn't one).'''
+  try:
+    (a,b,c),(d,e,f),(g,h,i)=supercell
+    return int(round(abs(a*(e*i-f*h)-b*(d*i-f*g)+c*(d*h-e*g))))
+  except (TypeError,ValueError):
+    return None
+
+######################################################################
+# Writer settings that change how long a run takes.
+SETTINGS=('kmesh','supercell','nblock','timestep')
+
+def writer_settings(writer):
+  ''' Class of a writer and the settings of it that change how long a run takes.'''
+  if writer is None:
+    return {}
+  settings={'writer':writer.__class__.__name__}
+  for name in SETTINGS:
+    value=getattr(writer,name,None)
+    if value is not None:
+      # Plain lists and numbers for JSON (settings can be numpy arrays).
+      settings[name]=json.loads(json.dumps(value,default=lambda obj:obj.tolist() if hasattr(obj,'tolist') else str(obj)))
+  return settings
+
+######################################################################
+def system_size(mgr):
+  ''' Number of atoms in a manager's system, from its writer or the managers it depends on (None if unknown).'''
+  from autogenv2.dag import upstream_managers
+  size=count_atoms(mgr.__dict__.get('writer'))
+  if size is not None:
+    return size
+  for other in upstream_managers(mgr):
+    size=system_size(other)
+    if size is not None:
+      return size
+  return None
+
+######################################################################
+def node_hours(record):
+  ''' Node-hours used by a recorded task (None if its nodes aren't known).'''
+  if record.get('nodes') is None:
+    return None
+  return record['nodes']*(record['end']-record['start'])/3600.
+
+######################################################################
+def record_tasks(mgr):
+  ''' Add the tasks of a manager that finished since they were last recorded to its ledger.
+  Returns:
+    list: records added.
+  '''
+  if mgr.__dict__.get('recorded_tasks') is None:
+    mgr.recorded_tasks={}
+  records=[]
+  size=None
+  for task,sentinel in enumerate(mgr.task_sentinels()):
+    if sentinels.state(sentinel)!='finished':
+      continue
+    info=sentinels.read(sentinel)
+    if info is None or mgr.recorded_tasks.get(sentinel)==info['end']:
+      continue
+    if size is None:
+      size=system_size(mgr)
+    record={
+        'manager':mgr.__class__.__name__,
+        'name':mgr.name,
+        'path':mgr.path,
+        'stage':os.path.relpath(sentinel,mgr.path),
+        'task':task,
+        'restarts':mgr.restarts,
+        'system_size':size,
+        'settings':writer_settings(mgr.__dict__.get('writer')),
+      }
+    for field in ('submitted','start','end','exit_code','host','nodes','cores'):
+      record[field]=info.get(field)
+    record['node_hours']=node_hours(record)
+    records.append(record)
+    mgr.recorded_tasks[sentinel]=info['end']
+  append(ledger_file(mgr),records)
+  return records
+
+######################################################################
+def read_ledger(sources=('./',)):
+  ''' Records of ledger files, or of all the ledgers under directories.'''
+  files=[]
+  for source in sources:
+    if os.path.isdir(source):
+      for dirpath,dirnames,filenames in os.walk(source):
+        files+=[os.path.join(dirpath,fn) for fn in filenames if fn==LEDGER_NAME or fn.endswith('.ledger.jsonl')]
+    else:
+      files.append(source)
+  records=[]
+  for fn in sorted(files):
+    with open(fn,'r') as inpf:
+      for line in inpf:
+        line=line.strip()
+        if line!='':
+          records.append(json.loads(line))
+  return records
+
+######################################################################
+def summarize(records,by=('manager','system_size','restarts')):
+  ''' Totals of the recorded tasks, grouped by some fields.
+  Args:
+    records (list): ledger records (see read_ledger).
+    by (tuple): fields to group by.
+  Returns:
+    dict: values of the fields -> {'tasks', 'failed', 'node_hours', 'hours', 'queue_hours'},
+      where hours are the summed run times and queue_hours the summed waits between submission and start.
+  '''
+  summary={}
+  for record in records:
+    key=tuple(record.get(field) for field in by)
+    group=summary.setdefault(key,{'tasks':0,'failed':0,'node_hours':0.0,'hours':0.0,'queue_hours':0.0})
+    group['tasks']+=1
+    if record.get('exit_code')!=0:
+      group['failed']+=1
+    group['node_hours']+=record.get('node_hours') or 0.0
+    group['hours']+=(record['end']-record['start'])/3600.
+    if record.get('submitted') is not None:
+      group['queue_hours']+=max(record['start']-record['submitted'],0)/3600.
+  return summary
+
+######################################################################
+def format_summary(summary,by=('manager','system_size','restarts')):
+  ''' Table of summarize.'''
+  lines=[' '.join("%-16s"%field for field in by)+" %6s %6s %11s %10s %10s"%(
+    'tasks','failed','node-hours','mean hours','mean queue')]
+  for key,group in sorted(summary.items(),key=lambda item:-item[1]['node_hours']):
+    lines.append(' '.join("%-16s"%(value,) for value in key)+" %6d %6d %11.2f %10.2f %10.2f"%(
+      group['tasks'],group['failed'],group['node_hours'],group['hours']/group['tasks'],group['queue_hours']/group['tasks']))
+  return '\n'.join(lines)
+
+######################################################################
+if __name__=='__main__':
+  parser=argparse.ArgumentParser("Summarize the runtime ledger.")
+  parser.add_argument('sources',type=str,nargs='*',default=['./'],help='Ledger files, or directories to search for them.')
+  parser.add_argument('--by',type=str,nargs='+',default=['manager','system_size','restarts'],help='Fields to group by.')
+  args=parser.parse_args()
+  print(format_summary(summarize(read_ledger(args.sources),args.by),args.by))
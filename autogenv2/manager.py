@@ -1,44 +1,333 @@
-import numpy as np
 import os 
+import json
+import time
+import threading
+import functools
 import pickle as pkl
+from contextlib import contextmanager
+from autogenv2 import statestore
+from autogenv2 import sidecar
+from autogenv2 import serialize
+from autogenv2 import sentinels
+
+######################################################################
+_lock_creation=threading.Lock()
+
+def stepping(method):
+  ''' Decorator for manager methods that change the manager, so only one thread at a time works on it.
+  Managers are also stepped by the managers that depend on them (through trial functions), 
+  so this is needed even if each manager is only stepped by one thread.'''
+  @functools.wraps(method)
+  def locked(self,*args,**kwargs):
+    with self.step_lock():
+      return method(self,*args,**kwargs)
+  return locked
 
 ######################################################################
 class Manager:
   ''' Skeleton for managers.'''
-  def __init__(name='AGmanager',path='./'):
+  # Managers saved before there were state stores don't have this attribute.
+  store=None
+  # Stamp of the saved state this manager is up to date with (not saved).
+  _stamp=None
+  # Last status record written to disk (not saved).
+  _record=None
+  # Format of the state file, 'pickle' or 'json' (not saved).
+  _format=None
+  # Lock held while the manager is being stepped (not saved).
+  _lock=None
+  # Submissions left to astep, while it is stepping the manager (not saved).
+  _deferred=None
+  # Managers read by another manager's job (see prerun) are never saved, stepped, or submitted from there (not saved).
+  _readonly=False
+  # (inode, mtime) of the prerun file merged in and not saved yet (see merge_prerun) (not saved).
+  _prerun_seen=None
+  # Defaults for managers that don't restart, or were saved before these existed.
+  restarts=0
+  max_restarts=None
+  last_status=None
+  cache=None
+  cache_key=None
+  # Sentinel -> end time of the tasks already in the runtime ledger (see ledger).
+  recorded_tasks=None
+
+  def __init__(self,name='AGmanager',path=None,store=None):
+    '''
+    Args:
+      name (str): identifier for this job. This names the files associated with run.
+      path (str): directory where this manager is free to store information.
+      store (StateStore): where to save the manager (None implies its own pickle file in path).
+    '''
     # Where to save self.
     self.name=name
     self.pickle="%s.pkl"%self.name
+    self.store=store
 
     # Ensure path is set up correctly.
     if path is None:
       path=os.getcwd()
-    if path[-1]!='/': path+='/'
-    self.path=path
+    # Absolute, so the manager's files don't depend on the working directory.
+    self.path=os.path.abspath(path)+'/'
 
     self.logname="%s@%s"%(self.__class__.__name__,self.path+self.name)
 
-    # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
+    self.completed=False
+    self.last_status=None
+
+    self._boot()
+
+  #----------------------------------------
+  def __getstate__(self):
+    ''' The state store is saved by its file name so the manager can be pickled.'''
+    state=self.__dict__.copy()
+    state.pop('_stamp',None)
+    state.pop('_record',None)
+    state.pop('_format',None)
+    state.pop('_lock',None)
+    state.pop('_deferred',None)
+    state.pop('_readonly',None)
+    state.pop('_prerun_seen',None)
+    if state.get('store') is not None:
+      state['store']=state['store'].dbfile
+    return state
+
+  #----------------------------------------
+  def __setstate__(self,state):
+    if state.get('store') is not None:
+      state['store']=statestore.open_store(state['store'])
+    self.__dict__.update(state)
+
+  #----------------------------------------
+  def to_state(self):
+    ''' State of the manager for the versioned format (see serialize).'''
+    return self.__getstate__()
+
+  #----------------------------------------
+  @classmethod
+  def from_state(cls,state):
+    ''' Rebuild a manager from to_state.'''
+    mgr=cls.__new__(cls)
+    mgr.__setstate__(state)
+    return mgr
+
+  #----------------------------------------
+  def step_lock(self):
+    ''' Lock held while this manager is being stepped (see stepping).'''
+    if self._lock is None:
+      with _lock_creation:
+        if self._lock is None:
+          self._lock=threading.RLock()
+    return self._lock
+
+  #----------------------------------------
+  def _boot(self):
+    ''' Recover old results if present, then save the manager.'''
+    old=self.load_saved()
+    if old is not None:
       print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
       self.recover(old)
+      self._record=old.status_record()
 
-    # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.update_pickle()
+
+  #----------------------------------------
+  def load_saved(self):
+    ''' Load the last saved version of this manager.
+    Returns:
+      Manager: saved manager, or None if this manager was never saved.
+    '''
+    if self.store is not None:
+      return self.store.load(self)
+    if not os.path.exists(self.statefile()):
+      return None
+    with open(self.statefile(),'rb') as inpf:
+      return serialize.load_state(inpf,self.arraydir())
+
+  #----------------------------------------
+  def statefile(self):
+    ''' File this manager is saved in, when it isn't kept in a store.
+    Managers that have been migrated to the versioned format (see serialize) stay in that format.'''
+    jsonfile=self.path+"%s.state.json"%self.name
+    if self._format is None:
+      if os.path.exists(jsonfile):                 self._format='json'
+      elif os.path.exists(self.path+self.pickle):  self._format='pickle'
+      else:                                        self._format=serialize.DEFAULT_FORMAT
+    if self._format=='json':
+      return jsonfile
+    return self.path+self.pickle
+
+  #----------------------------------------
+  def arraydir(self):
+    ''' Directory where large arrays of this manager are kept, outside of its saved state.'''
+    if self.store is not None:
+      return self.store.arraydir
+    return self.path+'autogen_arrays/'
+
+  #----------------------------------------
+  def saved_stamp(self):
+    ''' Stamp that changes whenever the saved state of this manager is rewritten.
+    Returns:
+      Stamp to compare with, or None if the manager was never saved.
+    '''
+    if self.store is not None:
+      return self.store.stamp(self)
+    try:
+      stat=os.stat(self.statefile())
+    except FileNotFoundError:
+      return None
+    return (stat.st_ino,stat.st_size,stat.st_mtime_ns)
+
+  #----------------------------------------
+  def _reload(self):
+    ''' Update with any changes saved since this manager last saved or loaded.
+    If nothing else has saved this manager in the meantime, there's nothing to update.
+    Then merge in what this manager's job left for it (see merge_prerun).
+    A read-only manager keeps what it has in memory.'''
+    if self._readonly:
+      return
+    stamp=self.saved_stamp()
+    if stamp is None or stamp!=self._stamp:
+      old=self.load_saved()
+      # Without a saved state (removed, or never written), keep this one, which the next save writes back.
+      if old is not None:
+        self.recover(old)
+        self._stamp=stamp
+        self._record=old.status_record()
+    self.merge_prerun()
+
+  #----------------------------------------
+  def prerun_file(self):
+    ''' File where the prerun hook of this manager's job leaves what it made (see autogenv2.prerun).'''
+    return self.path+"%s.prerun.json"%self.name
+
+  #----------------------------------------
+  def prerun_results(self):
+    ''' What prepare_inputs changed in this manager, as a dictionary that can be written as JSON.
+    Redefine along with apply_prerun for managers whose inputs can be written by their job (see prerun).'''
+    return {}
+
+  #----------------------------------------
+  def apply_prerun(self,results):
+    ''' Take in the prerun_results of this manager's job.'''
+    pass
+
+  #----------------------------------------
+  def merge_prerun(self):
+    ''' Apply the results the prerun hook of this manager's job left, if any.
+    The job never saves the manager, so the driver is the only one writing its state.
+    The file is removed once the manager is saved with its results.'''
+    try:
+      with open(self.prerun_file()) as inpf:
+        stat=os.fstat(inpf.fileno())
+        results=json.load(inpf)
+    except FileNotFoundError:
+      return
+    seen=(stat.st_ino,stat.st_mtime_ns)
+    if seen==self._prerun_seen:
+      return
+    print(self.logname,": taking in the inputs written by its job.")
+    self.apply_prerun(results)
+    self._prerun_seen=seen
+
+  #----------------------------------------
+  def _forget_prerun(self):
+    ''' Remove the merged prerun file, now that the manager is saved with its results.
+    A file the job wrote again since it was merged is kept for the next merge.'''
+    prerun_file=self.prerun_file()
+    try:
+      stat=os.stat(prerun_file)
+    except FileNotFoundError:
+      stat=None
+    if stat is not None and (stat.st_ino,stat.st_mtime_ns)==self._prerun_seen:
+      os.remove(prerun_file)
+    self._prerun_seen=None
 
   #----------------------------------------
   def nextstep(self,qstat=None):
     ''' Redefine to have the manager do something.'''
     pass
 
+  #----------------------------------------
+  async def astep(self,qstat=None):
+    ''' Version of nextstep for asyncio, so one event loop can step many managers.
+    The queue is listed and the jobs are submitted with asyncio subprocesses. 
+    The rest of the step (writing inputs, reading outputs, saving) runs in the loop's default executor.
+    Don't call nextstep on the manager from another thread while astep is running.'''
+    import asyncio
+    from autogenv2 import walltimes
+    loop=asyncio.get_running_loop()
+    if qstat is None:
+      await self._arefresh_queues()
+    submissions=await loop.run_in_executor(None,self._deferred_step,qstat)
+    if len(submissions)==0:
+      return
+    for runner,kwargs in submissions:
+      with walltimes.requested(self,runner):
+        if hasattr(runner,'asubmit'):
+          await runner.asubmit(path=self.path,**kwargs)
+        else:
+          await loop.run_in_executor(None,functools.partial(runner.submit,path=self.path,**kwargs))
+    await loop.run_in_executor(None,stepping(Manager.update_pickle),self)
+
+  #----------------------------------------
+  def _deferred_step(self,qstat=None):
+    ''' nextstep, leaving the submissions to the caller (see _submit).
+    Returns:
+      list: (runner, keyword arguments) of each submission.
+    '''
+    with self.step_lock():
+      self._deferred=[]
+      try:
+        self.nextstep(qstat=qstat)
+        return self._deferred
+      finally:
+        self._deferred=None
+
+  #----------------------------------------
+  async def _arefresh_queues(self):
+    ''' Bring the queue listings of this manager's runners up to date, without blocking the event loop.'''
+    caches=[]
+    for attr in ('runner','prunner'):
+      runner=self.__dict__.get(attr)
+      if not hasattr(runner,'queue_cache'):
+        continue
+      cache=runner.queue_cache()
+      if hasattr(cache,'track'):
+        cache.track(runner.queueid)
+      if all(cache is not other for other in caches):
+        caches.append(cache)
+    for cache in caches:
+      await cache.arefresh()
+
+  #----------------------------------------
+  def _submit(self,runner,**kwargs):
+    ''' Submit the runner's tasks from this manager's directory. Inside astep, the submission is left to astep.
+    A runner with walltime='auto' asks for the walltime predicted for the manager (see walltimes).'''
+    from autogenv2 import walltimes
+    if self._readonly:
+      return None
+    if self._deferred is not None:
+      if all(runner is not other for other,_ in self._deferred):
+        self._deferred.append((runner,kwargs))
+      return None
+    with walltimes.requested(self,runner):
+      return runner.submit(path=self.path,**kwargs)
+
   #----------------------------------------
   def collect(self):
     ''' Redefine to have manager farm data from its reader.'''
     pass
 
+  #----------------------------------------
+  def collect_finished(self):
+    ''' Read the results of finished tasks into memory, without running, submitting, or saving anything.
+    Redefine for managers whose results another job can use before the driver steps them (see prerun).
+    Returns:
+      bool: whether the manager is done.
+    '''
+    return bool(self.completed)
+
   #----------------------------------------
   def status(self):
     if self.completed:
@@ -46,22 +335,203 @@ class Manager:
     else:
       return 'not_finished'
 
+  #----------------------------------------
+  def terminal_state(self):
+    ''' Whether this manager has anything left to do.
+    Returns:
+      str: 'done' if completed, 'exhausted' if it ran out of restarts, or None if there is still work to do.
+    '''
+    if self.completed:
+      return 'done'
+    if self.last_status=='exhausted' and self.max_restarts is not None and self.restarts>=self.max_restarts:
+      return 'exhausted'
+    return None
+
+  #----------------------------------------
+  def status_record(self):
+    ''' Small summary of the manager, saved alongside its state. See ManagerStub.'''
+    queueid=[]
+    for attr in ('runner','prunner'):
+      for qid in getattr(self.__dict__.get(attr),'queueid',[]):
+        if qid not in queueid: queueid.append(qid)
+    prunner=self.__dict__.get('prunner')
+    energy,energy_err=self.energy()
+    return {
+        'manager':self.__class__.__name__,
+        'name':self.name,
+        'path':self.path,
+        'completed':bool(self.completed),
+        'restarts':self.restarts,
+        'queueid':queueid,
+        'pqueueid':None if prunner is None else list(getattr(prunner,'queueid',[])),
+        'last_status':self.last_status,
+        'terminal':self.terminal_state(),
+        'energy':_plain(energy),
+        'energy_err':_plain(energy_err)
+      }
+
+  #----------------------------------------
+  def energy(self):
+    ''' Redefine to report the energy the manager computes, for status records.
+    Returns:
+      tuple: (energy, error); either is None if not available.
+    '''
+    return None,None
+
+  #----------------------------------------
+  def task_sentinels(self):
+    ''' Redefine to list the sentinel prefixes of the manager's tasks (see sentinels), for schedulers.'''
+    return []
+
+  #----------------------------------------
+  def record_runtimes(self):
+    ''' Add the tasks that finished since the last step to the runtime ledger (see ledger).
+    Call before the sentinels of a finished task are cleared for a rerun.'''
+    from autogenv2 import ledger
+    if self._readonly:
+      return
+    ledger.record_tasks(self)
+
+  #----------------------------------------
+  @staticmethod
+  def load_stub(path,name,store=None):
+    ''' Read the status record of a saved manager without loading the manager.
+    Args:
+      path (str): directory of the manager.
+      name (str): name of the manager.
+      store (StateStore): store the manager is saved in (None implies its own files in path).
+    Returns:
+      ManagerStub: status of the manager, or None if it has no status record.
+    '''
+    if store is not None:
+      records=store.records(path=path,name=name)
+      if len(records)==0:
+        return None
+      return ManagerStub(records[0])
+    if path[-1]!='/': path+='/'
+    try:
+      with open(path+"%s.status"%name,'r') as inpf:
+        return ManagerStub(json.load(inpf))
+    except FileNotFoundError:
+      return None
+
+  #----------------------------------------
+  @staticmethod
+  def load(path,name,store=None):
+    ''' Load a saved manager without constructing it (and so without its writer, runner, etc.).
+    Args:
+      path (str): directory of the manager.
+      name (str): name of the manager.
+      store (StateStore): store the manager is saved in (None implies its own files in path).
+    Returns:
+      Manager: saved manager, or None if it was never saved.
+    '''
+    probe=Manager.__new__(Manager)
+    probe.path=os.path.abspath(path)+'/'
+    probe.name=name
+    probe.pickle="%s.pkl"%name
+    probe.store=store
+    # Stamp first: a save in between makes the manager reload at its first step, rather than miss the save.
+    stamp=probe.saved_stamp()
+    mgr=probe.load_saved()
+    if isinstance(mgr,Manager):
+      # Up to date with what was just loaded, so its first step doesn't load it again.
+      mgr._stamp=stamp
+    return mgr
+
+  #----------------------------------------
+  def cache_outputs(self):
+    ''' Redefine to list the outputs a ResultCache should keep for this manager.
+    Returns:
+      dict: file name in path for each kind of output.
+    '''
+    return {}
+
+  #----------------------------------------
+  def _fetch_cached(self,inputs,exe,path=None):
+    ''' Look for an identical run in the result cache and copy in its outputs if there is one.
+    Args:
+      inputs (list): input files of the run, relative to path.
+      exe (str): executable of the run.
+      path (str): where the run's files are (default: self.path).
+    Returns:
+      bool: whether the outputs were found.
+    '''
+    if self.cache is None:
+      return False
+    if path is None: path=self.path
+    self.cache_key=self.cache.input_key(path,inputs,exe)
+    found=self.cache.fetch(self.cache_key,path,self.cache_outputs())
+    if found:
+      print(self.logname,": found identical run in cache, using its results.")
+    return found
+
+  #----------------------------------------
+  def _store_cached(self,path=None):
+    ''' Add the outputs of this finished run to the result cache.
+    Args:
+      path (str): where the run's files are (default: self.path).
+    '''
+    if self.cache is None or self.cache_key is None:
+      return
+    if path is None: path=self.path
+    self.cache.store(self.cache_key,path,self.cache_outputs())
+
   #------------------------------------------------
   def update_pickle(self):
     ''' If you make direct changes to the internals of the pickle, you need to call this to insure they are saved.'''
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    if self._readonly:
+      return
+    # The status record is only rewritten when it changes.
+    record=self.status_record()
+    changed=record!=self._record
+    if changed:
+      record['changed']=time.time()
+
+    if self.store is not None:
+      self._stamp=self.store.save(self,record if changed else None)
+    else:
+      # Replacing the file gives it a new inode, so other processes can tell it changed.
+      tmpfile=self.statefile()+'.tmp'
+      with open(tmpfile,'wb') as outf:
+        serialize.dump_state(self,outf,self.arraydir(),self._format)
+      os.replace(tmpfile,self.statefile())
+      self._stamp=self.saved_stamp()
+
+      statusfile=self.path+"%s.status"%self.name
+      if changed:
+        write_status(statusfile,record)
+      else:
+        # Still up to date: it's newer than the state file (see status_is_current).
+        try:
+          os.utime(statusfile)
+        except FileNotFoundError:
+          write_status(statusfile,dict(record,changed=time.time()))
+
+    if changed:
+      record.pop('changed')
+      self._record=record
+    if self._prerun_seen is not None:
+      self._forget_prerun()
 
   #----------------------------------------
-  def submit(self):
-    ''' Submit any work and update the manager.'''
-    qsubfile=self.runner.submit()
+  @stepping
+  def submit(self,depend=None):
+    ''' Submit any work and update the manager.
+    Args:
+      depend (list): queue ids of jobs that must finish successfully before this job starts.
+    '''
+    if depend is None or len(depend)==0:
+      qsubfile=self._submit(self.runner)
+    else:
+      qsubfile=self._submit(self.runner,depend=depend)
 
     self.update_pickle()
 
     return qsubfile
 
   #----------------------------------------
+  @stepping
   def release_commands(self):
     ''' Release the runner of any commands it was tasked with and update the manager.'''
     commands=self.runner.release_commands()
@@ -70,6 +540,7 @@ class Manager:
     return commands
 
   #------------------------------------------------
+  @stepping
   def update_queueid(self,qid):
     ''' If a bundler handles the submission, it can update the queue info with this.
     Args:
@@ -87,11 +558,109 @@ class Manager:
       }
 
 ######################################################################
-def resolve_status(runner,reader,outfile,qstat=None):
+class ManagerStub:
+  ''' Status record of a saved manager. 
+  Reading it doesn't require loading the manager, or importing the classes it uses.
+
+  Attributes:
+    manager (str): class of the manager.
+    name (str): name of the manager.
+    path (str): directory of the manager.
+    completed (bool): whether the manager finished successfully.
+    restarts (int): number of restarts so far.
+    queueid (list): queue ids of jobs submitted by the manager.
+    pqueueid (list): queue ids of jobs submitted by its properties runner (None if it has none).
+    last_status (str): status found at the last step.
+    terminal (str): 'done', 'exhausted', or None if the manager still has work to do (see Manager.terminal_state).
+    energy (float): energy found by the manager, if any (see Manager.energy).
+    energy_err (float): error of the energy, if any.
+    changed (float): time the status record last changed.
+  '''
+  fields=('manager','name','path','completed','restarts','queueid','pqueueid','last_status','terminal','energy','energy_err',
+      'changed')
+  def __init__(self,record):
+    for field in self.fields:
+      setattr(self,field,record.get(field))
+
+  def __repr__(self):
+    return "ManagerStub(%s)"%', '.join("%s=%r"%(field,getattr(self,field)) for field in self.fields)
+
+######################################################################
+def write_status(statusfile,record):
+  ''' Write the status record of a manager saved in its own files (see ManagerStub).'''
+  with open(statusfile+'.tmp','w') as outf:
+    json.dump(record,outf)
+  os.replace(statusfile+'.tmp',statusfile)
+
+######################################################################
+def status_is_current(statusfile,statefile):
+  ''' Whether a status file describes the saved state next to it.
+  Every save through Manager.update_pickle leaves the status file newer than the state file;
+  a state file changed some other way is newer than its status file.'''
+  try:
+    return os.stat(statusfile).st_mtime_ns>=os.stat(statefile).st_mtime_ns
+  except FileNotFoundError:
+    return False
+
+######################################################################
+def _plain(value):
+  ''' Float for JSON status records (None stays None).'''
+  if value is None:
+    return None
+  return float(value)
+
+######################################################################
+def load_stubs(root='./',store=None):
+  ''' Read the status records of all the managers saved under a directory, or in a store.
+  Args:
+    root (str): directory to search (recursively).
+    store (StateStore): read all the managers in this store instead.
+  Returns:
+    list: ManagerStub for each manager found.
+  '''
+  if store is not None:
+    return [ManagerStub(record) for record in store.records()]
+  stubs=[]
+  for dirpath,dirnames,filenames in os.walk(root):
+    for fn in filenames:
+      if fn.endswith('.status'):
+        with open(os.path.join(dirpath,fn),'r') as inpf:
+          stubs.append(ManagerStub(json.load(inpf)))
+  return stubs
+
+######################################################################
+_cwd_lock=threading.RLock()
+
+@contextmanager
+def working_directory(path):
+  ''' Run code that only works in the current directory, like external converters, in path.
+  The working directory belongs to the whole process, so only one thread can be inside at a time.
+  Everything else in autogenv2 uses explicit paths and doesn't need this.
+
+  Usage:
+    with working_directory(self.path):
+      system,orbitals=pack_objects()
+  '''
+  with _cwd_lock:
+    cwd=os.getcwd()
+    os.chdir(path)
+    try:
+      yield
+    finally:
+      os.chdir(cwd)
+
+######################################################################
+def resolve_status(runner,reader,outfile,qstat=None,sentinel=None):
   #Check if the reader is done
   if reader.completed:
     return 'done'
 
+  # A task that wrote its end sentinel is finished, whatever the queue says (see sentinels).
+  if sentinel is not None and sentinels.state(sentinel)=='finished':
+    if not os.path.exists(outfile):
+      return 'not_started'
+    return 'ready_for_analysis'
+
   #Check if the job is in the queue or running. If so, we just return that.
   currstat=runner.check_status(qstat=qstat)
   if currstat=='running':
@@ -107,21 +676,29 @@ def resolve_status(runner,reader,outfile,qstat=None):
 
 ######################################################################
 def deep_compare(d1,d2):
-  '''I have to redo dict comparison because numpy will return a bool array when comparing.'''
+  '''I have to redo dict comparison because numpy will return a bool array when comparing.
+  Arrays whose contents can't change (like those mapped in from sidecars) are compared by their content hashes, which are
+  computed once and kept (see sidecar.frozen_key). Other arrays are compared directly.'''
+  if d1 is d2:
+    return True
   if type(d1)!=type(d2):
     return False
   if type(d1)==dict:
     if d1.keys()!=d2.keys():
       return False
-    allsame=True
-    for key in d1.keys():
-      allsame=allsame and deep_compare(d1[key],d2[key])
-    return allsame
-  else:
-    try:
-      return np.array_equal(d1,d2)
-    except TypeError:
-      return d1==d2
+    return all(deep_compare(d1[key],d2[key]) for key in d1.keys())
+  np=sidecar.loaded_numpy()
+  if np is None:
+    return d1==d2
+  if isinstance(d1,np.ndarray) and d1.dtype==d2.dtype:
+    k1=sidecar.frozen_key(d1)
+    k2=None if k1 is None else sidecar.frozen_key(d2)
+    if k2 is not None:
+      return k1==k2
+  try:
+    return np.array_equal(d1,d2)
+  except TypeError:
+    return d1==d2
 
 ######################################################################
 def update_attributes(copyto,copyfrom,skip_keys=[],take_keys=[]):
@@ -0,0 +1,243 @@
+''' Pilot jobs: one allocation running many tasks, pulled from a queue directory as its nodes free up.
+
+A Bundler with a pilot directory (see Bundler.submit) writes the commands of each manager to the directory as a task,
+and submits allocations running this agent. The agent starts tasks on whichever of its nodes are free,
+until no task left fits in the time remaining in the allocation (less a margin).
+Several pilots can pull from the same directory.
+
+Queue directory:
+  ready/[task].json    tasks waiting for a pilot.
+  claimed/[task].json  tasks a pilot is running. A pilot claims a task by renaming it out of ready/, so only one gets it.
+  done/[task].json     finished tasks, with their exit code, nodes and times. The output of the task is in done/[task].log.
+  pilots/[queueid]     pilots queued or running.
+
+Usage: python -m autogenv2.pilot queuedir --hostfile nodes --walltime seconds [--flavor pbs|slurm]
+'''
+import os
+import re
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess as sub
+
+# Python used by the pilot scripts to run the agent.
+PYTHON="python"
+# Seconds left at the end of the allocation, where no task is started.
+MARGIN=600
+SUBDIRS=('ready','claimed','done','pilots')
+
+######################################################################
+def task_id(mgr):
+  ''' Name of the task of a manager in the queue directory.'''
+  return re.sub('[^A-Za-z0-9_.-]','_',os.path.join(mgr.path,mgr.name)).strip('_')
+
+######################################################################
+def queue_dirs(queuedir):
+  for subdir in SUBDIRS:
+    os.makedirs(os.path.join(queuedir,subdir),exist_ok=True)
+
+######################################################################
+def _write_json(fn,obj):
+  ''' Write a file in one rename, so a pilot never reads half of it.'''
+  tmp=os.path.join(os.path.dirname(fn),'.'+os.path.basename(fn)+'.tmp')
+  with open(tmp,'w') as outf:
+    json.dump(obj,outf,indent=1)
+  os.replace(tmp,fn)
+
+######################################################################
+def _read_json(fn):
+  try:
+    with open(fn,'r') as inpf:
+      return json.load(inpf)
+  except (FileNotFoundError,ValueError):
+    return None
+
+######################################################################
+def _remove(fn):
+  try:
+    os.remove(fn)
+  except FileNotFoundError:
+    pass
+
+######################################################################
+def enqueue(queuedir,mgr,commands,seconds):
+  ''' Add the commands of a manager to the queue as a task.
+  A task queued again (e.g. after its pilot ran out of time) replaces the old one.
+  Args:
+    queuedir (str): queue directory.
+    mgr (Manager): manager the commands are for; they're run in its path, on mgr.runner.nn nodes.
+    commands (list): shell lines of the task.
+    seconds (float): time the task may take.
+  Returns:
+    str: task id.
+  '''
+  queue_dirs(queuedir)
+  task=task_id(mgr)
+  for subdir in ('claimed','done'):
+    _remove(os.path.join(queuedir,subdir,task+'.json'))
+  _write_json(os.path.join(queuedir,'ready',task+'.json'),{
+      'task':task,
+      'logname':mgr.logname,
+      'path':mgr.path,
+      'nodes':mgr.runner.nn,
+      'seconds':seconds,
+      'commands':commands,
+      'queued':time.time(),
+    })
+  return task
+
+######################################################################
+def ready_tasks(queuedir):
+  ''' Tasks waiting for a pilot.'''
+  readydir=os.path.join(queuedir,'ready')
+  tasks=[]
+  for fn in sorted(os.listdir(readydir)) if os.path.isdir(readydir) else []:
+    if fn.endswith('.json') and not fn.startswith('.'):
+      task=_read_json(os.path.join(readydir,fn))
+      if task is not None:
+        tasks.append(task)
+  return tasks
+
+######################################################################
+def pilots(queuedir):
+  ''' Queue ids of the pilots queued or running on the directory.'''
+  pilotdir=os.path.join(queuedir,'pilots')
+  return sorted(os.listdir(pilotdir)) if os.path.isdir(pilotdir) else []
+
+######################################################################
+def pilot_command(queuedir,hostfile,walltime,flavor,queueid,margin=MARGIN):
+  ''' Line of a job script running the agent.'''
+  return "%s -m autogenv2.pilot %s --hostfile %s --walltime %d --flavor %s --queueid %s --margin %d"%(
+      PYTHON,queuedir,hostfile,walltime,flavor,queueid,margin)
+
+######################################################################
+class TaskFarm:
+  ''' Agent running the tasks of a queue directory on the nodes of one allocation.'''
+  def __init__(self,queuedir,nodes,deadline,margin=MARGIN,flavor='pbs',poll=10,queueid=None):
+    '''
+    Args:
+      queuedir (str): queue directory.
+      nodes (list): host names of the nodes of the allocation.
+      deadline (float): time the allocation ends.
+      margin (float): seconds before the deadline after which tasks aren't started.
+      flavor (str): 'pbs' or 'slurm', for how tasks are placed on their nodes (see Bundler.launchers).
+      poll (float): seconds between checks of the tasks.
+      queueid (str): queue id of the allocation.
+    '''
+    from autogenv2.bundler import Bundler, SlurmBundler
+    self.queuedir=os.path.abspath(queuedir)
+    self.free=list(nodes)
+    self.deadline=deadline
+    self.margin=margin
+    self.launchers={'pbs':Bundler,'slurm':SlurmBundler}[flavor].launchers
+    self.poll=poll
+    self.queueid=queueid
+    # task id -> (process, nodes, task, start time, log file).
+    self.running={}
+    self.finished=0
+    queue_dirs(self.queuedir)
+
+  #------------------------------------------------
+  def _path(self,subdir,task,ext='.json'):
+    return os.path.join(self.queuedir,subdir,task+ext)
+
+  #------------------------------------------------
+  def fits(self,task,now):
+    ''' Whether the task can start now: there are enough free nodes, and time for it before the margin.'''
+    return task['nodes']<=len(self.free) and now+task['seconds']<=self.deadline-self.margin
+
+  #------------------------------------------------
+  def claim(self,task):
+    ''' Take a ready task for this pilot.
+    Returns:
+      bool: False if another pilot got it first.
+    '''
+    try:
+      os.rename(self._path('ready',task['task']),self._path('claimed',task['task']))
+    except FileNotFoundError:
+      return False
+    return True
+
+  #------------------------------------------------
+  def start(self,task):
+    ''' Run a claimed task in the background on free nodes.'''
+    nodes=self.free[:task['nodes']]
+    self.free=self.free[task['nodes']:]
+    slice=self._path('claimed',task['task'],'.nodes')
+    with open(slice,'w') as outf:
+      outf.write('\n'.join(nodes)+'\n')
+    script=self.launchers(slice,len(nodes))+["cd %s"%task['path']]+task['commands']
+    log=open(self._path('done',task['task'],'.log'),'w')
+    proc=sub.Popen(['bash','-c','\n'.join(script)],stdout=log,stderr=sub.STDOUT)
+    self.running[task['task']]=(proc,nodes,task,time.time(),log)
+    print("Started %s on %s."%(task['logname'],','.join(nodes)))
+
+  #------------------------------------------------
+  def reap(self):
+    ''' Record the tasks that have finished and free their nodes.'''
+    for name,(proc,nodes,task,start,log) in list(self.running.items()):
+      if proc.poll() is None:
+        continue
+      log.close()
+      del self.running[name]
+      self.free+=nodes
+      self.finished+=1
+      task.update({'exit_code':proc.returncode,'hosts':nodes,'start':start,'end':time.time(),'pilot':self.queueid})
+      _write_json(self._path('done',name),task)
+      _remove(self._path('claimed',name))
+      _remove(self._path('claimed',name,'.nodes'))
+      print("Finished %s with exit code %d."%(task['logname'],proc.returncode))
+
+  #------------------------------------------------
+  def step(self):
+    ''' Reap finished tasks, then start the ready tasks that fit, widest and longest first.
+    Returns:
+      int: number of tasks started.
+    '''
+    self.reap()
+    started=0
+    now=time.time()
+    for task in sorted(ready_tasks(self.queuedir),key=lambda task:(-task['nodes'],-task['seconds'])):
+      if self.fits(task,now) and self.claim(task):
+        self.start(task)
+        started+=1
+    return started
+
+  #------------------------------------------------
+  def run(self):
+    ''' Run tasks until none is running and none left can start.'''
+    try:
+      while True:
+        started=self.step()
+        if started==0 and len(self.running)==0:
+          break
+        time.sleep(self.poll)
+    finally:
+      if self.queueid is not None:
+        _remove(os.path.join(self.queuedir,'pilots',self.queueid))
+    left=ready_tasks(self.queuedir)
+    print("Pilot ran %d tasks; %d left in the queue."%(self.finished,len(left)))
+    return self.finished
+
+######################################################################
+if __name__=='__main__':
+  parser=argparse.ArgumentParser("Run the tasks of a queue directory on the nodes of this allocation.")
+  parser.add_argument('queuedir',type=str,help='Queue directory.')
+  parser.add_argument('--hostfile',type=str,required=True,help='Nodes of the allocation, one per line.')
+  parser.add_argument('--walltime',type=float,required=True,help='Seconds from now until the allocation ends.')
+  parser.add_argument('--margin',type=float,default=MARGIN,help="Seconds before the end where tasks aren't started.")
+  parser.add_argument('--flavor',type=str,default='pbs',choices=['pbs','slurm'],help='Queue system of the machine.')
+  parser.add_argument('--queueid',type=str,default=None,help='Queue id of the allocation.')
+  parser.add_argument('--poll',type=float,default=10,help='Seconds between checks of the tasks.')
+  args=parser.parse_args()
+
+  with open(args.hostfile,'r') as inpf:
+    nodes=[line.strip() for line in inpf if line.strip()!='']
+  queueid=None if args.queueid is None else args.queueid.split('.')[0]
+  farm=TaskFarm(args.queuedir,nodes,time.time()+args.walltime,args.margin,args.flavor,args.poll,queueid)
+  # The end of the allocation kills the agent, but it still takes itself off the list of pilots.
+  signal.signal(signal.SIGTERM,lambda *args: sys.exit(1))
+  farm.run()
+  sys.exit(0)
@@ -0,0 +1,76 @@
+''' Hook run at the start of a chained job (see QWalkManager.chain).
+
+A chained job is queued before the jobs making its inputs have finished, so its input file can't be written
+when it's submitted. When the job starts, this checks that the managers it depends on are done, reading the results
+of their finished runs, and writes the input file. Those managers are never stepped or saved from here.
+Neither is the manager itself, which the driver may be saving at the same time: what writing the input changed in it
+goes to its prerun file (see Manager.merge_prerun), which the driver takes in the next time it steps the manager.
+
+Usage: python -m autogenv2.prerun path name [--store dbfile]
+Exits with status 1 if a manager it depends on isn't done or the input can't be written, so the job stops there.
+'''
+import os
+import sys
+import json
+import argparse
+from autogenv2.manager import Manager
+
+# Python used by the job scripts to run the hook.
+PYTHON="python"
+
+######################################################################
+def prerun_command(path,name,store=None):
+  ''' Line of a job script running the hook for a manager, and stopping the job if it fails.'''
+  command="%s -m autogenv2.prerun %s %s"%(PYTHON,path,name)
+  if store is not None:
+    command+=" --store %s"%store.dbfile
+  return command+" || exit 1"
+
+######################################################################
+def prerun(path,name,store=None):
+  ''' Check that the managers a manager depends on are done, then write its input.
+  The managers it depends on are only read: their finished results are collected in memory, and
+  nothing of theirs is stepped, submitted, or saved, which is left to the driver.
+  Nor is the manager saved: what writing its input changed goes to its prerun file, for the driver to merge in.
+  Args:
+    path (str): directory of the manager.
+    name (str): name of the manager.
+    store (StateStore): store the manager is saved in (None implies its own files in path).
+  Returns:
+    bool: whether the input is written; False if one of the managers it depends on isn't done.
+  '''
+  from autogenv2.dag import ManagerGraph, node_key
+  mgr=Manager.load(path,name,store)
+  if mgr is None:
+    print("prerun: no manager %s in %s."%(name,path))
+    return False
+
+  graph=ManagerGraph([mgr])
+  upstream=[graph.nodes[key] for key in graph.order() if key!=node_key(mgr)]
+  for node in upstream:
+    node._reload()
+    node._readonly=True
+  for node in upstream:
+    if not node.collect_finished():
+      print("prerun: %s isn't done (%s)."%(node.logname,node.last_status))
+      return False
+
+  ready=mgr.prepare_inputs()
+  prerun_file=mgr.prerun_file()
+  with open(prerun_file+'.tmp','w') as outf:
+    json.dump(mgr.prerun_results(),outf)
+  os.replace(prerun_file+'.tmp',prerun_file)
+  return ready
+
+######################################################################
+if __name__=='__main__':
+  parser=argparse.ArgumentParser("Write the inputs of a chained job.")
+  parser.add_argument('path',type=str,help='Directory of the manager.')
+  parser.add_argument('name',type=str,help='Name of the manager.')
+  parser.add_argument('--store',type=str,default=None,help='StateStore database the manager is saved in.')
+  args=parser.parse_args()
+  store=None
+  if args.store is not None:
+    from autogenv2 import statestore
+    store=statestore.open_store(args.store)
+  sys.exit(0 if prerun(args.path,args.name,store) else 1)
@@ -1,16 +1,15 @@
 import autogenv2
-from autogenv2.autogen_tools import resolve_status, update_attributes
+from autogenv2.manager import resolve_status, update_attributes, stepping, working_directory, Manager
 from autogenv2.autorunner import PySCFRunnerPBS
 from autogenv2.autopaths import paths
 import qwalk_objects
 from qwalk_objects.autopyscf import PySCFReader,dm_from_chkfile
 import os
 import shutil as sh 
-import pickle as pkl
 import pyscf2qwalk
 
-class PySCFManager:
-  def __init__(self,writer,reader=None,runner=None,name='psycf_run',path=None,bundle=False):
+class PySCFManager(Manager):
+  def __init__(self,writer,reader=None,runner=None,name='psycf_run',path=None,bundle=False,store=None):
     ''' PySCFManager manages the writing of a PySCF input file, it's running, and keep track of the results.
     Args:
       writer (PySCFWriter): writer for input.
@@ -19,16 +18,18 @@ class PySCFManager:
       name (str): identifier for this job. This names the files associated with run.
       path (str): directory where this manager is free to store information.
       bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
+      store (StateStore): where to save the manager (None implies its own pickle file in path).
     '''
     # Where to save self.
     self.name=name
     self.pickle="%s.pkl"%self.name
+    self.store=store
 
     # Ensure path is set up correctly.
     if path is None:
       path=os.getcwd()
-    if path[-1]!='/': path+='/'
-    self.path=path
+    # Absolute, so the manager's files don't depend on the working directory.
+    self.path=os.path.abspath(path)+'/'
 
     self.logname="%s@%s"%(self.__class__.__name__,self.path+self.name)
 
@@ -54,19 +55,13 @@ class PySCFManager:
         'slater':{}
       }
     self.completed=False
+    self.last_status=None
     self.bundle_ready=False
     self.restarts=0
+    self.recorded_tasks={}
 
-    # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
-      print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
-      self.recover(old)
-
-    # Update the file.
-    if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    # Handle old results if present, and save.
+    self._boot()
 
   #------------------------------------------------
   def recover(self,other):
@@ -74,8 +69,8 @@ class PySCFManager:
     # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
     updated=update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','reader', 'path','logname','name','max_restarts','bundle'],
-        take_keys=['restarts','completed','qwfiles'])
+        skip_keys=['writer','runner','reader', 'path','logname','name','max_restarts','bundle','store'],
+        take_keys=['restarts','completed','last_status','qwfiles','recorded_tasks'])
 
     update_attributes(copyto=self.runner,copyfrom=other.runner,
         skip_keys=['queue','walltime','np','nn','jobname'],
@@ -89,39 +84,38 @@ class PySCFManager:
         skip_keys=['max_cycle'],
         take_keys=['completed','dm_generator'])
 
-    # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    
   #------------------------------------------------
+  @stepping
   def nextstep(self,qstat=None):
     ''' Determine and perform the next step in the calculation.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self._reload()
+    if self.terminal_state() is not None:
+      return
 
     print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
+    self.record_runtimes()
 
+    # The driver refers to the checkpoint file relative to the path, where it runs.
     if not self.writer.completed:
-      self.writer.pyscf_input(self.driverfn,self.chkfile)
+      self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
     
-    status=resolve_status(self.runner,self.reader,self.outfile,qstat=qstat)
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,qstat=qstat,sentinel=self.path+self.outfile)
     print(self.logname,": %s status= %s"%(self.name,status))
 
     if status=="not_started":
-      self.runner.add_task("python3 %s > %s"%(self.driverfn,self.outfile))
+      self.runner.add_task("python3 %s > %s"%(self.driverfn,self.outfile),sentinel=self.path+self.outfile)
     elif status=="ready_for_analysis":
-      status=self.reader.collect(self.outfile,self.chkfile)
+      status=self.reader.collect(self.path+self.outfile,self.path+self.chkfile)
       if status=='killed':
         print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
-        sh.copy(self.driverfn,"%d.%s"%(self.restarts,self.driverfn))
-        sh.copy(self.outfile,"%d.%s"%(self.restarts,self.outfile))
-        sh.copy(self.chkfile,"%d.%s"%(self.restarts,self.chkfile))
-        if os.path.exists(self.chkfile):
-          self.writer.dm_generator=dm_from_chkfile("%d.%s"%(self.restarts,self.chkfile))
-        self.writer.pyscf_input(self.driverfn,self.chkfile)
-        self.runner.add_task("/usr/bin/python3 %s > %s"%(self.driverfn,self.outfile))
+        sh.copy(self.path+self.driverfn,self.path+"%d.%s"%(self.restarts,self.driverfn))
+        sh.copy(self.path+self.outfile,self.path+"%d.%s"%(self.restarts,self.outfile))
+        sh.copy(self.path+self.chkfile,self.path+"%d.%s"%(self.restarts,self.chkfile))
+        if os.path.exists(self.path+self.chkfile):
+          self.writer.dm_generator=dm_from_chkfile(self.path+"%d.%s"%(self.restarts,self.chkfile))
+        self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
+        self.runner.add_task("/usr/bin/python3 %s > %s"%(self.driverfn,self.outfile),sentinel=self.path+self.outfile)
         self.restarts+=1
       elif status=='done':
         print(self.logname,": %s status= %s, task complete."%(self.name,status))
@@ -129,50 +123,51 @@ class PySCFManager:
     # Ready for bundler or else just submit the jobs as needed.
     if self.bundle:
       self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile,self.driverfn)
+      self.bundle_ready=self.runner.script(self.path+self.scriptfile,self.driverfn)
     else:
-      qsubfile=self.runner.submit(jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']])
+      qsubfile=self._submit(self.runner,jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']])
 
     self.completed=self.reader.completed
-    # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+    self.last_status=status
+
+    self.update_pickle()
 
   #------------------------------------------------
+  @stepping
   def update_queueid(self,qid):
     ''' If a bundler handles the submission, it can update the queue info with this.'''
     self.runner.queueid.append(qid)
-    # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.update_pickle()
     self._runready=False # After running, we won't run again without more analysis.
       
   #------------------------------------------------
+  @stepping
   def export_qwalk(self):
     ''' Export QWalk input files into current directory.
     Returns:
       bool: whether it was successful.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self._reload()
 
     if len(self.qwfiles['slater'])==0:
       self.nextstep()
       if not self.completed:
         return False
       print(self.logname,": %s generating QWalk files."%self.name)
-      cwd=os.getcwd()
-      os.chdir(self.path)
-      self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.chkfile)
-      os.chdir(cwd)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+      # The converter writes its files to the working directory.
+      with working_directory(self.path):
+        self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.chkfile)
+    self.update_pickle()
     return True
 
+  #----------------------------------------
+  def task_sentinels(self):
+    return [self.path+self.outfile]
+
   #----------------------------------------
   def status(self):
     ''' Determine the course of action based on info from reader and runner.'''
-    current_status = resolve_status(self.runner,self.reader,self.outfile,qstat=qstat)
+    current_status = resolve_status(self.runner,self.reader,self.path+self.outfile,sentinel=self.path+self.outfile)
     if current_status == 'done':
       return 'ok'
     elif current_status == 'retry':
@@ -1,15 +1,16 @@
-from autogenv2.manager import resolve_status, update_attributes, Manager
+from autogenv2.manager import resolve_status, update_attributes, stepping, Manager
 from autogenv2.autorunner import RunnerPBS
 from autogenv2.autopaths import paths
+from autogenv2.resultcache import referenced_files
+from autogenv2.prerun import prerun_command
 from qwalk_objects.trialfunc import export_qwalk_trialfunc,separate_jastrow,Jastrow
 from json.decoder import JSONDecodeError
 import os
-import pickle as pkl
 
 #######################################################################
 class QWalkManager(Manager):
   def __init__(self,writer,reader,runner=None,trialfunc=None,
-      name='qw_run',path=None,bundle=False):
+      name='qw_run',path=None,bundle=False,store=None,cache=None):
     ''' QWalkManager managers the writing of a QWalk input files, it's running, and keeping track of the results.
     Args:
       writer (qwalk writer): writer for input.
@@ -19,15 +20,18 @@ class QWalkManager(Manager):
       path (str): directory where this manager is free to store information.
       bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
       qwalk (str): absolute path to qwalk executible.
+      store (StateStore): where to save the manager (None implies its own pickle file in path).
+      cache (ResultCache): reuse results of runs with identical input (None implies always run).
     '''
     self.name=name
     self.pickle="%s.pkl"%(self.name)
+    self.store=store
 
     # Ensure path is set up correctly.
     if path is None:
       path=os.getcwd()
-    if path[-1]!='/': path+='/'
-    self.path=path
+    # Absolute, so the manager's files don't depend on the working directory.
+    self.path=os.path.abspath(path)+'/'
 
     self.logname="%s@%s"%(self.__class__.__name__,self.path+self.name)
 
@@ -35,25 +39,22 @@ class QWalkManager(Manager):
 
     self.writer=writer
     self.reader=reader
+    self.trialfunc=trialfunc
     if runner is not None: self.runner=runner
     else: self.runner=RunnerPBS()
     self.bundle=bundle
+    self.cache=cache
+    self.cache_key=None
+    self.recorded_tasks={}
 
     self.completed=False
+    self.last_status=None
     self.infile=name
     self.outfile="%s.o"%self.infile
     self.stdout="%s.out"%self.infile
 
-    # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
-      print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
-      self.recover(old)
-
-    # Update the file.
-    if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    # Handle old results if present, and save.
+    self._boot()
 
   #------------------------------------------------
   def recover(self,other):
@@ -63,8 +64,8 @@ class QWalkManager(Manager):
 
     #TODO this forbids all changes to trialfunc's managers even their runners (for instance). Should allows safe changes.
     update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','reader','path','logname','name','bundle'],
-        take_keys=['restarts','completed'])
+        skip_keys=['writer','runner','reader','trialfunc','path','logname','name','bundle','store','cache'],
+        take_keys=['restarts','completed','last_status','cache_key','recorded_tasks'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
@@ -82,74 +83,142 @@ class QWalkManager(Manager):
       self.writer.completed=False
 
   #------------------------------------------------
+  @stepping
   def nextstep(self,qstat=None):
     ''' Perform next step in calculation. trialfunc managers are updated if they aren't completed yet.
     Args: 
-      qstat (str): result of qstat call. Used to avoid calling qstat over and over for each manager.
+      qstat (str): result of qstat call (default: the process-wide submitter.QstatCache).
     '''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self._reload()
+    if self.terminal_state() is not None:
+      return
 
     print(self.logname,": next step.")
+    self.record_runtimes()
 
-    # Check dependency is completed first.
-    if self.writer.trialfunc=='':
-      print(self.logname,": checking trial function.")
-      self.writer.trialfunc = export_qwalk_trialfunc(self.trialfunc)
-
-    # Work on this job.
-    cwd=os.getcwd()
-    os.chdir(self.path)
-
-    # Write the input file.
-    if not self.writer.completed:
-      self.writer.qwalk_input(self.infile)
+    self.prepare_inputs()
     
-    status=resolve_status(self.runner,self.reader,self.outfile,qstat=qstat)
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,qstat=qstat,sentinel=self.path+self.outfile)
     print(self.logname,": %s status= %s"%(self.name,status))
+    if status=="not_started" and self.writer.completed and \
+        self._fetch_cached([self.infile]+referenced_files(self.path,self.infile),paths['qwalk']):
+      status="ready_for_analysis"
+
     if status=="not_started" and self.writer.completed:
       exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
-      self.runner.add_task(exestr)
+      self.runner.add_task(exestr,sentinel=self.path+self.outfile)
       print(self.logname,": %s status= submitted"%(self.name))
     elif status=="ready_for_analysis":
       #This is where we (eventually) do error correction and resubmits
       try:
-        status=self.reader.collect(self.outfile)
+        status=self.reader.collect(self.path+self.outfile)
       except JSONDecodeError:
         status='error'
       if status=='ok':
         print(self.logname,": %s status= %s, task complete."%(self.name,status))
         self.completed=True
+        self._store_cached()
       elif status=='error':
         print(self.logname,": %s status= %s, json read error implies corruption or input error."%(self.name,status))
       else:
         print(self.logname,": %s status= %s, attempting rerun."%(self.name,status))
         exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
-        self.runner.add_task(exestr)
+        self.runner.add_task(exestr,sentinel=self.path+self.outfile)
     elif status=='done':
       self.completed=True
 
     # Ready for bundler or else just submit the jobs as needed.
     if not self.bundle:
-      qsubfile=self.runner.submit()
+      qsubfile=self._submit(self.runner)
+    self.last_status=status
 
-    # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.update_pickle()
 
-    os.chdir(cwd)
+  #------------------------------------------------
+  def prepare_inputs(self):
+    ''' Write the input file, once the trial function can be exported.
+    Returns:
+      bool: whether the input file is written.
+    '''
+    # Check dependency is completed first.
+    if self.writer.trialfunc=='':
+      print(self.logname,": checking trial function.")
+      self.writer.trialfunc = export_qwalk_trialfunc(self.trialfunc)
+
+    # Write the input file.
+    if not self.writer.completed:
+      self.writer.qwalk_input(self.path+self.infile)
+    return self.writer.completed
+
+  #------------------------------------------------
+  def prerun_results(self):
+    ''' The trial function and input the prerun hook of this manager's job wrote (see Manager.prerun_results).'''
+    return {'trialfunc':self.writer.trialfunc,'completed':self.writer.completed}
+
+  #------------------------------------------------
+  def apply_prerun(self,results):
+    self.writer.trialfunc=results['trialfunc']
+    self.writer.completed=results['completed']
+
+  #------------------------------------------------
+  @stepping
+  def chain(self,depend):
+    ''' Queue this run behind the jobs making its trial function, instead of waiting for them to finish.
+    The job starts with the prerun hook (see autogenv2.prerun), which collects the results of those jobs
+    and writes the input file. If one of those jobs fails, the queue never starts this one; delete it from the queue
+    and it will be run normally once its trial function is ready.
+    Args:
+      depend (list): queue ids of the jobs to wait for.
+    Returns:
+      bool: whether the run was queued.
+    '''
+    self._reload()
+    if self.terminal_state() is not None or self.writer.completed or len(depend)==0:
+      return False
+    # Only queues can hold a job until others finish.
+    if not hasattr(self.runner,'dependency') or self.runner.check_status()=='running':
+      return False
+
+    print(self.logname,": chaining after %s."%', '.join(depend))
+    self.runner.add_command(prerun_command(self.path,self.name,self.store))
+    self.runner.add_task("%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout),sentinel=self.path+self.outfile)
+    if not self.bundle:
+      self._submit(self.runner,depend=depend)
+    self.last_status='chained'
+    self.update_pickle()
+    return True
 
   #----------------------------------------
+  def cache_outputs(self):
+    ''' Outputs of the QWalk run kept by the result cache.'''
+    return dict((suffix,self.infile+suffix) for suffix in ('.o','.out','.log','.json','.wfout','.config'))
+
+  #----------------------------------------
+  @stepping
   def collect(self):
     ''' Call the collect routine for readers.'''
     print(self.logname,": collecting results.")
     self.reader.collect(self.path+self.outfile)
 
-    # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.update_pickle()
 
   #----------------------------------------
+  def collect_finished(self):
+    ''' Read the output of a finished run into memory, without rerunning or saving (see Manager.collect_finished).'''
+    if self.completed:
+      return True
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,sentinel=self.path+self.outfile)
+    if status=='ready_for_analysis':
+      try:
+        status=self.reader.collect(self.path+self.outfile)
+      except JSONDecodeError:
+        status='error'
+    self.completed=status in ('ok','done')
+    return self.completed
+
+  #----------------------------------------
+  @stepping
   def export_jastrow(self,optimizebasis=True,freezeall=False):
     ''' Make a Jastrow function from any resulting trial function optimization.
     Returns:
@@ -157,7 +226,7 @@ class QWalkManager(Manager):
     # Theoretically more than just Jastrow can be provided, but practically that's the only type of wavefunction we tend to export.
 
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self._reload()
 
     wfout = self.path+self.outfile.replace('.o','.wfout')
     if not self.completed or not os.path.exists(wfout):
@@ -165,6 +234,16 @@ class QWalkManager(Manager):
 
     return Jastrow(separate_jastrow(wfout,optimizebasis=optimizebasis,freezeall=freezeall))
   
+  def energy(self):
+    ''' Total energy and its error from the QWalk output, if it's been read.'''
+    output=getattr(self.reader,'output',{})
+    if 'total_energy' in output.get('properties',{}):
+      return output['properties']['total_energy']['value'][0],output['properties']['total_energy']['error'][0]
+    return output.get('total_energy'),output.get('total_energy_err')
+
+  def task_sentinels(self):
+    return [self.path+self.outfile]
+
   def export_record(self,obdmfunc=None,tbdmfunc=None,obdmerrfunc=None,tbdmerrfunc=None):
     ''' Combine input and output into convenient run record.'''
     if obdmfunc is None: obdmfunc       = lambda x: x
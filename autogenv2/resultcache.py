@@ -0,0 +1,120 @@
+''' Project-level cache of finished runs, keyed by their input.
+
+When two managers generate byte-identical input files for the same executable, the second manager
+can copy in the outputs of the first instead of submitting the same calculation again.
+The copies share their blocks with the cache where the filesystem supports it (reflinks), but are files of their own,
+so a rerun or writer changing them never changes the cache.
+'''
+import os
+import re
+import shutil as sh
+import hashlib
+
+# ioctl cloning a file on Linux filesystems that support reflinks (btrfs, xfs, ...).
+FICLONE=0x40049409
+
+######################################################################
+def clone(src,dest):
+  ''' Copy a file as a reflink where the filesystem can, or else byte by byte. The copy is writable.'''
+  with open(src,'rb') as inpf, open(dest,'wb') as outf:
+    try:
+      import fcntl
+      fcntl.ioctl(outf.fileno(),FICLONE,inpf.fileno())
+      return
+    except (ImportError,OSError):
+      pass
+    sh.copyfileobj(inpf,outf)
+
+######################################################################
+class ResultCache:
+  ''' Directory of outputs of finished runs, one entry per input hash.'''
+  def __init__(self,root='autogen_cache'):
+    '''
+    Args:
+      root (str): directory for the cache, usually one per project.
+    '''
+    self.root=os.path.abspath(root)
+
+  #------------------------------------------------
+  def input_key(self,path,inputs,exe):
+    ''' Hash of the input files of a run and the executable that runs them.
+    Args:
+      path (str): directory of the run.
+      inputs (list): input file names, relative to path.
+      exe (str): path to the executable.
+    Returns:
+      str: key of the run in the cache.
+    '''
+    digest=hashlib.blake2b(digest_size=20)
+    digest.update(("%d:%s"%(len(exe),exe)).encode())
+    for fn in inputs:
+      with open(os.path.join(path,fn),'rb') as inpf:
+        contents=inpf.read()
+      digest.update(("%d:"%len(contents)).encode())
+      digest.update(contents)
+    return digest.hexdigest()
+
+  #------------------------------------------------
+  def fetch(self,key,path,outputs):
+    ''' Copy the outputs of a cached run into a directory.
+    Args:
+      key (str): key of the run (see input_key).
+      path (str): directory to copy outputs into.
+      outputs (dict): file name to use in path for each kind of output.
+    Returns:
+      bool: whether the run was found in the cache.
+    '''
+    entry=os.path.join(self.root,key)
+    if not os.path.exists(os.path.join(entry,'complete')):
+      return False
+    for role,fn in outputs.items():
+      src=os.path.join(entry,role)
+      if not os.path.exists(src):
+        continue
+      dest=os.path.join(path,fn)
+      # Removed rather than overwritten, in case it's a hard link into the cache from an older version.
+      if os.path.exists(dest): os.remove(dest)
+      clone(src,dest)
+    return True
+
+  #------------------------------------------------
+  def store(self,key,path,outputs):
+    ''' Copy the outputs of a finished run into the cache, unless the run is cached already.
+    Args:
+      key (str): key of the run (see input_key).
+      path (str): directory of the run.
+      outputs (dict): file name in path for each kind of output.
+    '''
+    entry=os.path.join(self.root,key)
+    if os.path.exists(os.path.join(entry,'complete')):
+      return
+    if not os.path.exists(entry): os.makedirs(entry)
+    for role,fn in outputs.items():
+      src=os.path.join(path,fn)
+      if os.path.exists(src):
+        cached=os.path.join(entry,role)
+        # Left read-only by an earlier store that didn't finish.
+        if os.path.exists(cached): os.remove(cached)
+        clone(src,cached)
+        # Every run using the entry gets a copy, so the entry itself is never rewritten.
+        os.chmod(cached,0o444)
+    # Written last, so a partial entry is never used.
+    with open(os.path.join(entry,'complete'),'w') as outf:
+      outf.write(os.path.abspath(path))
+
+######################################################################
+def referenced_files(path,fn):
+  ''' Files in path that are named in a text input file, like the files a QWalk input includes.
+  Args:
+    path (str): directory of the input file.
+    fn (str): input file name.
+  Returns:
+    list: names of existing files mentioned in the input, in order of appearance.
+  '''
+  with open(os.path.join(path,fn),'r') as inpf:
+    tokens=re.split(r'[\s{}]+',inpf.read())
+  found=[]
+  for token in tokens:
+    if token and token!=fn and token not in found and os.path.isfile(os.path.join(path,token)):
+      found.append(token)
+  return found
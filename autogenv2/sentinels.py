@@ -0,0 +1,123 @@
+''' Files marking the start and end of a task, written by the job script itself.
+
+A task with a sentinel writes `[sentinel].start` when it starts, and `[sentinel].end` with its exit code when it ends:
+  .start: {"host": "nid01234", "start": 1700000000}
+  .end:   {"exit_code": 0, "host": "nid01234", "end": 1700003600}
+The runner also writes `[sentinel].queued` when the task is added to a job script, with the nodes and cores it asks for
+(see queued), and adds the time the job script reaches the queue when it's submitted (see submitted).
+So whether a task has finished, and how, is known without asking the queue.
+Managers use their output file as the sentinel (e.g. `qw_run.o.start`).
+'''
+import os
+import re
+import json
+import time
+import shlex
+
+START='.start'
+END='.end'
+QUEUED='.queued'
+
+######################################################################
+def wrap(line,sentinel):
+  ''' Shell line running `line` between the writing of the start and end files of sentinel.
+  The line stays a single line, so it can be moved between scripts (e.g. by a Bundler).
+  It exits with the status of `line`, so the job script, bundles, and afterok dependencies still see failures.
+  '''
+  start=shlex.quote(sentinel+START)
+  end=shlex.quote(sentinel+END)
+  return ''.join([
+      "printf '{\"host\": \"%%s\", \"start\": %%s}\\n' \"$(hostname)\" \"$(date +%%s)\" > %s; "%start,
+      "%s; "%line,
+      "ag_exit=$?; ",
+      "printf '{\"exit_code\": %%d, \"host\": \"%%s\", \"end\": %%s}\\n' $ag_exit \"$(hostname)\" \"$(date +%%s)\" > %s; "%end,
+      "(exit $ag_exit)",
+    ])
+
+# Where wrap writes the start file: the first redirection of the line.
+_WRAPPED=re.compile(r"printf .*? > ((?:'[^']*'|[^\s;'])+); ")
+
+######################################################################
+def in_line(line):
+  ''' Sentinel prefix of a line made by wrap, or None for other lines.'''
+  match=_WRAPPED.match(line.strip())
+  if match is None:
+    return None
+  fn=shlex.split(match.group(1))[0]
+  if not fn.endswith(START):
+    return None
+  return fn[:-len(START)]
+
+######################################################################
+def clear(sentinel):
+  ''' Remove the sentinel files of an earlier run, before the task runs again.'''
+  for ext in (START,END,QUEUED):
+    try:
+      os.remove(sentinel+ext)
+    except FileNotFoundError:
+      pass
+
+######################################################################
+def queued(sentinel,nodes=None,cores=None):
+  ''' Write the queued file of a task added to a job script.
+  Args:
+    sentinel (str): sentinel prefix of the task.
+    nodes (int): nodes the task runs on.
+    cores (int): cores the task runs on (None if it takes all of them).
+  '''
+  with open(sentinel+QUEUED,'w') as outf:
+    json.dump({'nodes':nodes,'cores':cores},outf)
+
+######################################################################
+def submitted(lines,when=None):
+  ''' Add the time their job reached the queue to the queued files of the tasks in some job script lines.
+  Call when the job is submitted (or queued for a pilot, or run directly), not when the tasks are added to the runner,
+  which can be much earlier for bundled managers.
+  Args:
+    lines (list): lines of the job script; those made by wrap are tasks.
+    when (float): time of submission (default: now).
+  '''
+  if when is None:
+    when=time.time()
+  for line in lines:
+    sentinel=in_line(line)
+    if sentinel is None:
+      continue
+    info=_load(sentinel+QUEUED) or {}
+    info['submitted']=when
+    with open(sentinel+QUEUED,'w') as outf:
+      json.dump(info,outf)
+
+######################################################################
+def _load(fn):
+  try:
+    with open(fn,'r') as inpf:
+      return json.load(inpf)
+  except (FileNotFoundError,ValueError):
+    # A file still being written counts as not there yet.
+    return None
+
+######################################################################
+def read(sentinel):
+  ''' What the sentinel files say about the task.
+  Returns:
+    dict: 'host', 'start', and, once finished, 'exit_code' and 'end'; None if the task hasn't started.
+      Also 'submitted', 'nodes' and 'cores' if the runner wrote them.
+  '''
+  info=_load(sentinel+START)
+  if info is None:
+    return None
+  info.update(_load(sentinel+QUEUED) or {})
+  end=_load(sentinel+END)
+  if end is not None:
+    info.update(end)
+  return info
+
+######################################################################
+def state(sentinel):
+  ''' 'finished', 'started', or None if the task hasn't started (or has no sentinel).'''
+  if _load(sentinel+END) is not None:
+    return 'finished'
+  if os.path.exists(sentinel+START):
+    return 'started'
+  return None
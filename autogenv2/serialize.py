@@ -0,0 +1,426 @@
+''' Versioned, pickle-free format for saving managers.
+
+A manager (with its runner, reader, writer, ...) is saved as a JSON document:
+  {"format": "autogenv2", "version": 2, "root": ...}
+Objects are recorded by the name of their class and their state, and large arrays go to `.npy` sidecar files (see sidecar).
+Classes in CLASSES are saved by a short name rather than where they are defined, so moving one only means updating the table;
+RENAMED maps the class paths of other classes that have moved. Loading only imports the classes that actually appear
+in the document. Documents saved with an older version are brought up to date by the functions in UPGRADES.
+
+Classes can control what is saved by defining `to_state()` (returning a dict) and a classmethod `from_state(state)`.
+Runners, readers, and writers, which don't, are saved through hooks (see register and component_from_state).
+Otherwise the instance `__dict__` (or `__getstate__`/`__setstate__`) is used.
+'''
+import os
+import json
+import base64
+import importlib
+from collections import OrderedDict, Counter, defaultdict
+from autogenv2 import sidecar
+
+FORMAT_NAME='autogenv2'
+SCHEMA_VERSION=2
+
+# Format used for managers that haven't been saved yet: 'pickle' or 'json'.
+DEFAULT_FORMAT='pickle'
+
+_tags=('__object__','__global__','__ref__','__tuple__','__set__','__items__','__mapping__','__ndarray__','__scalar__',
+    '__complex__','__bytes__')
+_mappings={'OrderedDict':OrderedDict,'Counter':Counter,'defaultdict':defaultdict}
+
+######################################################################
+def component_state(obj):
+  ''' State of a runner, reader, or writer: its attributes.'''
+  return dict(obj.__dict__)
+
+def component_from_state(cls,state):
+  ''' Rebuild a runner, reader, or writer from component_state.
+  It's made with the defaults of its constructor, then given its saved attributes,
+  so attributes added to the class since the state was saved get their defaults.'''
+  try:
+    obj=cls()
+  except TypeError:
+    obj=cls.__new__(cls)
+  obj.__dict__.update(state)
+  return obj
+
+COMPONENT=(component_state,component_from_state)
+
+# Name -> class path of the classes saved by name.
+CLASSES={}
+# Name -> (to_state(obj), from_state(cls,state)) for the classes saved through hooks.
+HOOKS={}
+# Class paths saved by earlier versions of classes that have moved: old class path -> new class path.
+RENAMED={}
+_names={}
+
+def register(name,path,hooks=None):
+  ''' Save a class by name, so saved state doesn't depend on where the class is defined.
+  Args:
+    name (str): name the class is saved by. Keep it when the class moves, and change path instead.
+    path (str): where the class is, as 'module:qualified name'.
+    hooks (tuple): (to_state, from_state) for classes that can't define them, like COMPONENT for runners,
+      readers, and writers (None implies the class's own).
+  '''
+  CLASSES[name]=path
+  _names[path]=name
+  if hooks is None:
+    HOOKS.pop(name,None)
+  else:
+    HOOKS[name]=hooks
+
+for _name in ('Manager','ManagerStub'):
+  register(_name,'autogenv2.manager:'+_name)
+for _module,_name in (('crystalmanager','CrystalManager'),('qwalkmanager','QWalkManager'),
+    ('pyscfmanager','PySCFManager'),('convertermanager','ConverterManager')):
+  register(_name,'autogenv2.%s:%s'%(_module,_name))
+for _name in ('RunnerLocal','RunnerPBS','RunnerBW','RunnerSlurm','FakeRunner','PySCFRunnerLocal','PySCFRunnerPBS'):
+  register(_name,'autogenv2.autorunner:'+_name,COMPONENT)
+for _module,_name in (('crystal','CrystalReader'),('crystal','CrystalWriter'),('propertiesreader','PropertiesReader'),
+    ('autopyscf','PySCFReader'),('autopyscf','PySCFWriter'),('autopyscf','PySCFPBCWriter')):
+  register(_name,'qwalk_objects.%s:%s'%(_module,_name),COMPONENT)
+
+######################################################################
+def dumps(obj,arraydir):
+  ''' Encode obj in the versioned format.
+  Args:
+    obj: object to save.
+    arraydir (str): directory for large arrays.
+  Returns:
+    bytes: JSON document.
+  '''
+  encoder=_Encoder(arraydir)
+  doc={'format':FORMAT_NAME,'version':SCHEMA_VERSION,'root':encoder.encode(obj)}
+  return json.dumps(doc).encode()
+
+######################################################################
+def loads(data,arraydir):
+  ''' Decode an object saved with dumps.'''
+  doc=json.loads(data.decode())
+  if doc.get('format')!=FORMAT_NAME:
+    raise ValueError("Not an autogenv2 state document.")
+  if doc['version']>SCHEMA_VERSION:
+    raise ValueError("State was saved with a newer schema (version %d) than this autogenv2 supports (%d)."%(
+      doc['version'],SCHEMA_VERSION))
+  return _Decoder(arraydir).decode(upgrade(doc)['root'])
+
+######################################################################
+def _upgrade_1(root):
+  ''' Version 1 saved every class by its class path. Classes that have a name are saved by it since version 2.'''
+  def visit(data):
+    if type(data)==list:
+      return [visit(item) for item in data]
+    if type(data)!=dict:
+      return data
+    data=dict((key,visit(value)) for key,value in data.items())
+    for tag in ('__object__','__global__'):
+      if tag in data:
+        path=RENAMED.get(data[tag],data[tag])
+        data[tag]=_names.get(path,path)
+    return data
+  return visit(root)
+
+# Version -> function upgrading the root of a document of that version to the next one.
+UPGRADES={1:_upgrade_1}
+
+def upgrade(doc):
+  ''' Bring a decoded document up to SCHEMA_VERSION.'''
+  root=doc['root']
+  for version in range(doc['version'],SCHEMA_VERSION):
+    root=UPGRADES[version](root)
+  return {'format':FORMAT_NAME,'version':SCHEMA_VERSION,'root':root}
+
+######################################################################
+def is_versioned(data):
+  ''' Whether saved data is in the versioned format (rather than a pickle).'''
+  return data[:1]==b'{'
+
+######################################################################
+def dump_state(obj,outf,arraydir,fmt):
+  ''' Write obj to a binary file in the given format ('pickle' or 'json').'''
+  if fmt=='json':
+    outf.write(dumps(obj,arraydir))
+  else:
+    sidecar.dump(obj,outf,arraydir)
+
+######################################################################
+def load_state(inpf,arraydir):
+  ''' Read an object from a binary file saved in either format.'''
+  data=inpf.read()
+  if is_versioned(data):
+    return loads(data,arraydir)
+  return sidecar.loads(data,arraydir)
+
+######################################################################
+def class_path(cls):
+  ''' Name of a class (or function) that can be imported by find_class: its registered name, or else where it is.'''
+  path="%s:%s"%(cls.__module__,cls.__qualname__)
+  return _names.get(path,path)
+
+def find_class(path):
+  ''' Import a class (or function) named by class_path.'''
+  path=CLASSES.get(path,path)
+  path=RENAMED.get(path,path)
+  module,qualname=path.split(':')
+  obj=importlib.import_module(module)
+  for name in qualname.split('.'):
+    obj=getattr(obj,name)
+  return obj
+
+######################################################################
+def object_state(obj):
+  ''' State an object is saved with: from its hooks, to_state, __getstate__, or else its attributes.'''
+  name=class_path(type(obj))
+  if name in HOOKS:
+    return HOOKS[name][0](obj)
+  if hasattr(obj,'to_state'):
+    return obj.to_state()
+  if getattr(type(obj),'__getstate__',None) not in (None,getattr(object,'__getstate__',None)):
+    return obj.__getstate__()
+  if hasattr(obj,'__dict__'):
+    return obj.__dict__
+  raise TypeError("Can't save %r in the versioned format."%obj)
+
+######################################################################
+class _Encoder:
+  def __init__(self,arraydir):
+    self.arraydir=arraydir
+    # Objects already encoded, so shared references stay shared: id -> (obj,index).
+    self.seen={}
+
+  def encode(self,obj):
+    np=sidecar.loaded_numpy()
+    if obj is None or isinstance(obj,(bool,str)):
+      return obj
+    if type(obj) in (int,float):
+      return obj
+    if isinstance(obj,complex):
+      return {'__complex__':[obj.real,obj.imag]}
+    if np is not None and isinstance(obj,np.generic):
+      return {'__scalar__':obj.dtype.str,'value':self.encode(obj.item())}
+    if isinstance(obj,bytes):
+      return {'__bytes__':base64.b64encode(obj).decode()}
+    if type(obj)==list:
+      return [self.encode(item) for item in obj]
+    if type(obj)==tuple:
+      return {'__tuple__':[self.encode(item) for item in obj]}
+    if type(obj)==set:
+      return {'__set__':[self.encode(item) for item in obj]}
+    if type(obj)==dict:
+      if all(type(key)==str and key not in _tags for key in obj):
+        return dict((key,self.encode(value)) for key,value in obj.items())
+      return {'__items__':self.encode_items(obj)}
+    if type(obj) in _mappings.values():
+      mapping={'__mapping__':type(obj).__name__,'items':self.encode_items(obj)}
+      if type(obj)==defaultdict:
+        mapping['factory']=self.encode(obj.default_factory)
+      return mapping
+    if np is not None and isinstance(obj,np.ndarray):
+      return self.encode_array(obj)
+    return self.encode_object(obj)
+
+  def encode_items(self,mapping):
+    return [[self.encode(key),self.encode(value)] for key,value in mapping.items()]
+
+  def encode_array(self,arr):
+    if arr.dtype.hasobject:
+      return {'__ndarray__':'object','shape':list(arr.shape),'items':self.encode(arr.ravel().tolist())}
+    if sidecar.is_large(arr):
+      return {'__ndarray__':'sidecar','key':sidecar.save_array(arr,self.arraydir)}
+    import numpy as np
+    data=np.ascontiguousarray(arr)
+    return {'__ndarray__':'inline','dtype':data.dtype.str,'shape':list(data.shape),
+        'data':base64.b64encode(data.tobytes()).decode()}
+
+  def encode_object(self,obj):
+    if id(obj) in self.seen:
+      return {'__ref__':self.seen[id(obj)][1]}
+    if isinstance(obj,type) or callable(obj) and hasattr(obj,'__qualname__'):
+      # Functions and classes are saved by name.
+      if '<' in obj.__qualname__:
+        raise TypeError("Can't save %r in the versioned format, only module-level functions can be saved."%obj)
+      return {'__global__':class_path(obj)}
+    name=class_path(type(obj))
+    if name not in HOOKS and not hasattr(obj,'to_state') and isinstance(obj,(dict,list,tuple,set)):
+      # Their contents aren't in their attributes, and would be lost.
+      raise TypeError("Can't save %r in the versioned format: containers other than dict, list, tuple, set, "
+          "OrderedDict, Counter and defaultdict need to_state and from_state."%type(obj))
+    index=len(self.seen)
+    self.seen[id(obj)]=(obj,index)
+    state=object_state(obj)
+
+    return {'__object__':name,'id':index,'state':self.encode(state)}
+
+######################################################################
+class _Decoder:
+  def __init__(self,arraydir):
+    self.arraydir=arraydir
+    self.objects={}
+
+  def decode(self,data):
+    if type(data)==list:
+      return [self.decode(item) for item in data]
+    if type(data)!=dict:
+      return data
+    if '__object__' in data:
+      return self.decode_object(data)
+    if '__ref__' in data:
+      return self.objects[data['__ref__']]
+    if '__global__' in data:
+      return find_class(data['__global__'])
+    if '__tuple__' in data:
+      return tuple(self.decode(item) for item in data['__tuple__'])
+    if '__set__' in data:
+      return set(self.decode(item) for item in data['__set__'])
+    if '__items__' in data:
+      return dict(self.decode_items(data['__items__']))
+    if '__mapping__' in data:
+      if data['__mapping__']=='defaultdict':
+        return defaultdict(self.decode(data['factory']),self.decode_items(data['items']))
+      return _mappings[data['__mapping__']](dict(self.decode_items(data['items'])))
+    if '__complex__' in data:
+      return complex(*data['__complex__'])
+    if '__scalar__' in data:
+      import numpy as np
+      return np.dtype(data['__scalar__']).type(self.decode(data['value']))
+    if '__bytes__' in data:
+      return base64.b64decode(data['__bytes__'])
+    if '__ndarray__' in data:
+      return self.decode_array(data)
+    return dict((key,self.decode(value)) for key,value in data.items())
+
+  def decode_items(self,items):
+    return [(self.decode(key),self.decode(value)) for key,value in items]
+
+  def decode_array(self,data):
+    kind=data['__ndarray__']
+    if kind=='sidecar':
+      return sidecar.load_array(data['key'],self.arraydir)
+    import numpy as np
+    if kind=='object':
+      arr=np.empty(len(data['items']),dtype=object)
+      arr[:]=self.decode(data['items'])
+      return arr.reshape(data['shape'])
+    return np.frombuffer(base64.b64decode(data['data']),dtype=np.dtype(data['dtype'])).reshape(data['shape']).copy()
+
+  def decode_object(self,data):
+    cls=find_class(data['__object__'])
+    if data['__object__'] in HOOKS:
+      obj=HOOKS[data['__object__']][1](cls,self.decode(data['state']))
+      self.objects[data['id']]=obj
+      return obj
+    if hasattr(cls,'from_state'):
+      # from_state builds the object from its state, so references to it from inside its own state aren't possible.
+      obj=cls.from_state(self.decode(data['state']))
+      self.objects[data['id']]=obj
+      return obj
+    obj=cls.__new__(cls)
+    self.objects[data['id']]=obj
+    state=self.decode(data['state'])
+    if hasattr(obj,'__setstate__') and getattr(type(obj),'__setstate__',None) is not getattr(object,'__setstate__',None):
+      obj.__setstate__(state)
+    else:
+      obj.__dict__.update(state)
+    return obj
+
+######################################################################
+def migrate(root='./'):
+  ''' Convert all the manager pickles under a directory to the versioned format.
+  Each converted state is loaded back and compared with the pickle before the pickle is retired; the old pickles are kept
+  as [name].pkl.bak. Pickles whose state doesn't survive the conversion are left as they are.
+  Args:
+    root (str): directory to search (recursively).
+  Returns:
+    list: state files written.
+  '''
+  written=[]
+  for dirpath,dirnames,filenames in os.walk(root):
+    for fn in filenames:
+      if not fn.endswith('.pkl'):
+        continue
+      arraydir=os.path.join(dirpath,'autogen_arrays/')
+      try:
+        with open(os.path.join(dirpath,fn),'rb') as inpf:
+          mgr=load_state(inpf,arraydir)
+      except Exception as err:
+        print("Skipping %s, couldn't load it: %s"%(os.path.join(dirpath,fn),err))
+        continue
+      # Only managers know which pickle they are saved in.
+      if getattr(mgr,'pickle',None)!=fn:
+        continue
+      statefile=os.path.join(dirpath,mgr.name+'.state.json')
+      data=dumps(mgr,arraydir)
+      if not same_state(loads(data,arraydir),mgr):
+        print("Skipping %s, its state changes when converted."%os.path.join(dirpath,fn))
+        continue
+      with open(statefile+'.tmp','wb') as outf:
+        outf.write(data)
+      os.replace(statefile+'.tmp',statefile)
+      os.replace(os.path.join(dirpath,fn),os.path.join(dirpath,fn+'.bak'))
+      written.append(statefile)
+  return written
+
+######################################################################
+def same_state(converted,original,_seen=None):
+  ''' Whether everything in an object survived its conversion to the versioned format and back.
+  Objects are compared by the state pickling saves (__getstate__ or __dict__), which hooks and to_state may leave out.
+  The converted objects may have attributes the original doesn't, from the defaults of component_from_state.'''
+  if _seen is None:
+    _seen=set()
+  np=sidecar.loaded_numpy()
+  if np is not None and isinstance(original,np.ndarray):
+    return isinstance(converted,np.ndarray) and original.dtype==converted.dtype and \
+        (np.array_equal(original,converted,equal_nan=original.dtype.kind in 'fc') if not original.dtype.hasobject
+         else original.shape==converted.shape and same_state(converted.tolist(),original.tolist(),_seen))
+  if type(converted)!=type(original):
+    return False
+  if original is None or isinstance(original,(bool,int,float,complex,str,bytes)) or \
+      np is not None and isinstance(original,np.generic):
+    return original==converted or original!=original and converted!=converted
+  if isinstance(original,type) or callable(original) and hasattr(original,'__qualname__'):
+    return original is converted
+  if (id(converted),id(original)) in _seen:
+    return True
+  _seen.add((id(converted),id(original)))
+  if isinstance(original,(list,tuple)):
+    return len(original)==len(converted) and all(same_state(c,o,_seen) for c,o in zip(converted,original))
+  if isinstance(original,set):
+    return original==converted
+  if isinstance(original,dict):
+    if list(original.keys())!=list(converted.keys()):
+      return False
+    if type(original)==defaultdict and original.default_factory is not converted.default_factory:
+      return False
+    return all(same_state(converted[key],original[key],_seen) for key in original)
+  cstate,ostate=_pickled_state(converted),_pickled_state(original)
+  if isinstance(ostate,dict) and isinstance(cstate,dict):
+    return all(key in cstate and same_state(cstate[key],ostate[key],_seen) for key in ostate)
+  return same_state(cstate,ostate,_seen)
+
+def _pickled_state(obj):
+  if hasattr(obj,'__getstate__'):
+    return obj.__getstate__()
+  return getattr(obj,'__dict__',None)
+
+######################################################################
+def migrate_store(store):
+  ''' Convert all the managers in a StateStore to the versioned format.
+  Returns:
+    int: number of managers converted.
+  '''
+  import uuid
+  store.flush()
+  rows=store.conn.execute("select path,name,state from managers").fetchall()
+  converted=[]
+  for path,name,state in rows:
+    if is_versioned(state):
+      continue
+    mgr=sidecar.loads(state,store.arraydir)
+    data=dumps(mgr,store.arraydir)
+    if not same_state(loads(data,store.arraydir),mgr):
+      raise ValueError("State of %s%s changes when converted; the store is left as it was."%(path,name))
+    converted.append((data,uuid.uuid4().hex,path,name))
+  with store.conn:
+    store.conn.executemany("update managers set state=?, stamp=? where path=? and name=?",converted)
+  store.format='json'
+  return len(converted)
@@ -0,0 +1,144 @@
+''' Storage of large arrays outside of manager pickles.
+
+Large NumPy arrays (density matrices, orbital coefficients, ...) are written once to `.npy` files named by a hash of their contents.
+The pickle only keeps a reference to the file, and loading maps the file in read-only with `np.load(mmap_mode='r')`.
+Re-pickling a manager whose arrays haven't changed doesn't touch the arrays at all.
+'''
+import os
+import io
+import sys
+import hashlib
+import weakref
+import pickle as pkl
+
+# Arrays smaller than this many bytes stay in the pickle.
+MIN_BYTES=1<<16
+
+# Hashes of read-only arrays, like those loaded from sidecar files: id -> (weakref to array, key).
+_loaded={}
+
+######################################################################
+def array_key(arr):
+  ''' Content hash naming the sidecar file of an array. 
+  The hash of an array whose contents can't change (see _frozen) is kept.'''
+  known=_loaded.get(id(arr))
+  if known is not None and known[0]() is arr:
+    return known[1]
+  import numpy as np
+  data=np.ascontiguousarray(arr)
+  digest=hashlib.blake2b(digest_size=16)
+  digest.update(("%s%s"%(data.dtype.str,data.shape)).encode())
+  digest.update(data.data)
+  key=digest.hexdigest()
+  if _frozen(arr):
+    _remember(arr,key)
+  return key
+
+######################################################################
+def _frozen(arr):
+  ''' Whether the contents of an array can't change: neither it nor any array it's a view of is writeable.'''
+  import numpy as np
+  while isinstance(arr,np.ndarray):
+    if arr.flags.writeable:
+      return False
+    arr=arr.base
+  return True
+
+######################################################################
+def frozen_key(arr):
+  ''' Content hash of an array whose contents can't change, computed once and kept; None for other arrays.
+  Comparing arrays that can change by hashing them would cost more than comparing them directly.'''
+  known=_loaded.get(id(arr))
+  if known is not None and known[0]() is arr:
+    return known[1]
+  if arr.dtype.hasobject or not _frozen(arr):
+    return None
+  return array_key(arr)
+
+######################################################################
+def _remember(arr,key):
+  ref=weakref.ref(arr,lambda ref,idx=id(arr): _loaded.pop(idx,None))
+  _loaded[id(arr)]=(ref,key)
+
+######################################################################
+def loaded_numpy():
+  ''' NumPy, if something has imported it already, else None.
+  No arrays can exist before NumPy is imported, so checking for them doesn't need to import it.'''
+  return sys.modules.get('numpy')
+
+######################################################################
+def is_large(obj):
+  ''' Whether obj is an array that should be kept in a sidecar file.'''
+  np=loaded_numpy()
+  return np is not None and isinstance(obj,np.ndarray) and not obj.dtype.hasobject and obj.nbytes>=MIN_BYTES
+
+######################################################################
+def save_array(arr,arraydir):
+  ''' Write an array to its sidecar file, unless it's there already.
+  Returns:
+    str: key of the array.
+  '''
+  key=array_key(arr)
+  fn=os.path.join(arraydir,key+'.npy')
+  if not os.path.exists(fn):
+    import numpy as np
+    if not os.path.exists(arraydir): os.makedirs(arraydir)
+    with open(fn+'.tmp','wb') as outf:
+      np.save(outf,np.ascontiguousarray(arr))
+    os.replace(fn+'.tmp',fn)
+  return key
+
+######################################################################
+def load_array(key,arraydir):
+  ''' Map in an array from its sidecar file (read-only).'''
+  import numpy as np
+  arr=np.load(os.path.join(arraydir,key+'.npy'),mmap_mode='r')
+  _remember(arr,key)
+  return arr
+
+######################################################################
+class _Pickler(pkl.Pickler):
+  ''' Pickler that sends large arrays to sidecar files.'''
+  def __init__(self,file,arraydir):
+    pkl.Pickler.__init__(self,file)
+    self.arraydir=arraydir
+
+  def persistent_id(self,obj):
+    if not is_large(obj):
+      return None
+    return ('npy',save_array(obj,self.arraydir))
+
+######################################################################
+class _Unpickler(pkl.Unpickler):
+  ''' Unpickler that maps in arrays from sidecar files.'''
+  def __init__(self,file,arraydir):
+    pkl.Unpickler.__init__(self,file)
+    self.arraydir=arraydir
+
+  def persistent_load(self,pid):
+    kind,key=pid
+    if kind!='npy':
+      raise pkl.UnpicklingError("Unknown sidecar type %s."%kind)
+    return load_array(key,self.arraydir)
+
+######################################################################
+def dump(obj,outf,arraydir):
+  ''' Pickle obj into outf, writing its large arrays into arraydir.'''
+  _Pickler(outf,arraydir).dump(obj)
+
+######################################################################
+def load(inpf,arraydir):
+  ''' Unpickle from inpf, mapping large arrays in from arraydir.'''
+  return _Unpickler(inpf,arraydir).load()
+
+######################################################################
+def dumps(obj,arraydir):
+  ''' Pickle obj to bytes, writing its large arrays into arraydir.'''
+  outf=io.BytesIO()
+  dump(obj,outf,arraydir)
+  return outf.getvalue()
+
+######################################################################
+def loads(data,arraydir):
+  ''' Unpickle from bytes, mapping large arrays in from arraydir.'''
+  return load(io.BytesIO(data),arraydir)
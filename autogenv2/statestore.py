@@ -0,0 +1,300 @@
+''' Transactional storage of manager states.
+
+By default each manager saves itself to its own pickle file.
+A StateStore instead keeps every manager of a project in one SQLite database, indexed by path and name.
+Saves made inside `StateStore.sweep()` are committed together when the sweep ends.
+A store can be shared by threads stepping managers concurrently.
+'''
+import os
+import sqlite3
+import time
+import uuid
+import json
+import threading
+from contextlib import contextmanager
+from autogenv2 import sidecar
+from autogenv2 import serialize
+
+_stores={}
+
+######################################################################
+def open_store(dbfile='autogen.db'):
+  ''' Get the StateStore for a database file, reusing it if it's already open in this process.
+  Args:
+    dbfile (str): database file.
+  Returns:
+    StateStore: store for that file.
+  '''
+  dbfile=os.path.abspath(dbfile)
+  if dbfile not in _stores:
+    _stores[dbfile]=StateStore(dbfile)
+  return _stores[dbfile]
+
+######################################################################
+class StateStore:
+  ''' SQLite database holding the saved state of many managers.'''
+  def __init__(self,dbfile='autogen.db',format=None):
+    '''
+    Args:
+      dbfile (str): database file, usually one per project.
+      format (str): 'pickle' or 'json' (see serialize) for saving managers (default: serialize.DEFAULT_FORMAT).
+    '''
+    self.dbfile=os.path.abspath(dbfile)
+    self.format=format
+    self.arraydir=self.dbfile+'.arrays/'
+    # One connection shared by all threads, so every use of it holds the lock.
+    self.conn=sqlite3.connect(self.dbfile,check_same_thread=False)
+    self._lock=threading.RLock()
+    with self.conn:
+      self.conn.execute('''create table if not exists managers (
+          path text not null,
+          name text not null,
+          manager text,
+          completed integer,
+          updated real,
+          state blob,
+          stamp text,
+          terminal text,
+          restarts integer,
+          queueid text,
+          pqueueid text,
+          last_status text,
+          energy real,
+          energy_err real,
+          changed real,
+          primary key (path,name)
+        )''')
+      # Databases from before these columns were added.
+      columns=[row[1] for row in self.conn.execute("pragma table_info(managers)")]
+      for column,kind in (('stamp','text'),('terminal','text'),('restarts','integer'),
+          ('queueid','text'),('pqueueid','text'),('last_status','text'),('energy','real'),('energy_err','real'),('changed','real')):
+        if column not in columns:
+          self.conn.execute("alter table managers add column %s %s"%(column,kind))
+      self.conn.execute("create index if not exists managers_completed on managers (completed)")
+      self.conn.execute("create index if not exists managers_terminal on managers (terminal)")
+
+    # Saves waiting for the end of the sweep.
+    self._pending={}
+    self._depth=0
+    _stores.setdefault(self.dbfile,self)
+
+  #------------------------------------------------
+  def key(self,mgr):
+    ''' Database key for a manager.'''
+    return (os.path.abspath(mgr.path),mgr.name)
+
+  #------------------------------------------------
+  def save(self,mgr,record=None):
+    ''' Save the state of a manager. Inside a sweep, this is committed when the sweep ends.
+    Args:
+      mgr (Manager): manager to save.
+      record (dict): new status record of the manager (None if unchanged).
+    Returns:
+      str: new stamp of the saved state.
+    '''
+    key=self.key(mgr)
+    stamp=uuid.uuid4().hex
+    if record is None:
+      record=mgr.status_record()
+      changed=None
+    else:
+      changed=record['changed']
+    row=key+(
+        mgr.__class__.__name__,
+        int(bool(getattr(mgr,'completed',False))),
+        time.time(),
+        self._dumps(mgr),
+        stamp,
+        record['terminal'],
+        record['restarts'],
+        json.dumps(record['queueid']),
+        json.dumps(record.get('pqueueid')),
+        record['last_status'],
+        record.get('energy'),
+        record.get('energy_err'),
+        changed
+      )
+    with self._lock:
+      self._pending[key]=row
+      if self._depth==0:
+        self.flush()
+    return stamp
+
+  #------------------------------------------------
+  def load(self,mgr):
+    ''' Load the saved state of a manager.
+    Returns:
+      Manager: saved version of mgr, or None if it was never saved.
+    '''
+    key=self.key(mgr)
+    with self._lock:
+      if key in self._pending:
+        row=(self._pending[key][5],)
+      else:
+        row=self.conn.execute("select state from managers where path=? and name=?",key).fetchone()
+    if row is None:
+      return None
+    return self._loads(row[0])
+
+  #------------------------------------------------
+  def _dumps(self,mgr):
+    fmt=self.format or serialize.DEFAULT_FORMAT
+    if fmt=='json':
+      return serialize.dumps(mgr,self.arraydir)
+    return sidecar.dumps(mgr,self.arraydir)
+
+  #------------------------------------------------
+  def _loads(self,data):
+    if serialize.is_versioned(data):
+      return serialize.loads(data,self.arraydir)
+    return sidecar.loads(data,self.arraydir)
+
+  #------------------------------------------------
+  def stamp(self,mgr):
+    ''' Stamp of the saved state of a manager, which changes with every save.
+    Returns:
+      str: stamp, or None if the manager was never saved.
+    '''
+    key=self.key(mgr)
+    with self._lock:
+      if key in self._pending:
+        return self._pending[key][6]
+      row=self.conn.execute("select stamp from managers where path=? and name=?",key).fetchone()
+    if row is None:
+      return None
+    return row[0]
+
+  #------------------------------------------------
+  def flush(self):
+    ''' Commit all pending saves in one transaction.'''
+    with self._lock:
+      self._flush()
+
+  def _flush(self):
+    if len(self._pending)==0:
+      return
+    with self.conn:
+      self._write_pending()
+    self._pending={}
+
+  def _write_pending(self):
+    ''' Write the pending saves into the current transaction, without committing it.'''
+    if len(self._pending)>0:
+      self.conn.executemany('''insert into managers
+          (path,name,manager,completed,updated,state,stamp,terminal,restarts,queueid,pqueueid,last_status,energy,energy_err,
+            changed)
+          values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,coalesce(?,?))
+          on conflict (path,name) do update set
+            manager=excluded.manager, completed=excluded.completed, updated=excluded.updated,
+            state=excluded.state, stamp=excluded.stamp, terminal=excluded.terminal,
+            restarts=excluded.restarts, queueid=excluded.queueid, pqueueid=excluded.pqueueid,
+            last_status=excluded.last_status,
+            energy=excluded.energy, energy_err=excluded.energy_err,
+            changed=coalesce(?,managers.changed)''',
+          [row+(row[4],row[-1]) for row in self._pending.values()])
+
+  #------------------------------------------------
+  @contextmanager
+  def _reading(self):
+    ''' Hold the store for a query that sees the pending saves.
+    Inside a sweep, the pending saves are written for the query and rolled back after,
+    so reading doesn't commit part of the sweep.'''
+    with self._lock:
+      if self._depth==0:
+        self._flush()
+        yield
+        return
+      self._write_pending()
+      try:
+        yield
+      finally:
+        self.conn.rollback()
+
+  #------------------------------------------------
+  @contextmanager
+  def sweep(self):
+    ''' Group the saves of many managers into one commit.
+    Reads of the store inside the sweep see its saves, without committing them.
+
+    Usage:
+      with store.sweep():
+        for mgr in managers:
+          mgr.nextstep()
+    '''
+    with self._lock:
+      self._depth+=1
+    try:
+      yield self
+    finally:
+      with self._lock:
+        self._depth-=1
+        if self._depth==0:
+          self.flush()
+
+  #------------------------------------------------
+  def status(self,completed=None):
+    ''' Summarize the managers in the store without loading them.
+    Args:
+      completed (bool): only list managers with this completion (default: all).
+    Returns:
+      list: (path,name,manager,completed) for each manager.
+    '''
+    with self._reading():
+      if completed is None:
+        rows=self.conn.execute("select path,name,manager,completed from managers").fetchall()
+      else:
+        rows=self.conn.execute("select path,name,manager,completed from managers where completed=?",
+            (int(completed),)).fetchall()
+    return [(path,name,manager,bool(done)) for path,name,manager,done in rows]
+
+  #------------------------------------------------
+  def records(self,path=None,name=None):
+    ''' Status records of managers in the store, read without loading the managers.
+    Args:
+      path (str): only managers in this directory (default: all).
+      name (str): only managers with this name (default: all).
+    Returns:
+      list: status record (dict) for each manager. See manager.ManagerStub.
+    '''
+    query=("select manager,name,path,completed,restarts,queueid,pqueueid,last_status,terminal,energy,energy_err,changed"
+        " from managers")
+    conditions=[]
+    args=[]
+    if path is not None:
+      conditions.append("path=?")
+      args.append(os.path.abspath(path))
+    if name is not None:
+      conditions.append("name=?")
+      args.append(name)
+    if len(conditions)>0:
+      query+=" where "+" and ".join(conditions)
+    with self._reading():
+      rows=self.conn.execute(query,args).fetchall()
+    records=[]
+    for row in rows:
+      record=dict(zip(('manager','name','path','completed','restarts','queueid','pqueueid','last_status','terminal',
+        'energy','energy_err','changed'),row))
+      record['path']+='/'
+      record['completed']=bool(record['completed'])
+      record['queueid']=json.loads(record['queueid'] or '[]')
+      record['pqueueid']=json.loads(record['pqueueid'] or 'null')
+      records.append(record)
+    return records
+
+  #------------------------------------------------
+  def active(self):
+    ''' Managers that haven't reached a terminal state, i.e. the ones worth stepping.
+    Returns:
+      list: (path,name) for each manager.
+    '''
+    with self._reading():
+      return self.conn.execute("select path,name from managers where terminal is null").fetchall()
+
+  #------------------------------------------------
+  def count(self,completed=None):
+    ''' Number of managers in the store (with given completion, if set).'''
+    with self._reading():
+      if completed is None:
+        return self.conn.execute("select count(*) from managers").fetchone()[0]
+      return self.conn.execute("select count(*) from managers where completed=?",
+          (int(completed),)).fetchone()[0]
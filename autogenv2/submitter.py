@@ -4,6 +4,9 @@ import os
 import shutil
 import sys
 import time
+import threading
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
 
 #####################################################################################
 class LocalSubmitter:
@@ -21,48 +24,472 @@ class LocalSubmitter:
             returns a list of queue ids (list of strings)
   """
 #-------------------------------------------------------
+class QstatCache:
+  """Queue listing shared by every runner in the process.
+  The queue is fetched at most once every `ttl` seconds, so a sweep over many managers only queries the scheduler once.
+  Jobs submitted since the last fetch are counted as queued, so they aren't submitted again before the next fetch.
+  """
+  def __init__(self,command="qstat",ttl=30):
+    """
+    Args:
+      command (str): command listing the queue.
+      ttl (float): seconds before the listing is fetched again.
+    """
+    self.command=command
+    self.ttl=ttl
+    self.fetched=None
+    self.text=None
+    # Parsed listing for each state column (see parse_qstat): column -> QueueIndex.
+    self._indexes={}
+    # Jobs submitted through this process: job id -> time of submission.
+    self._submitted={}
+    # Depth of sweeps holding the listing (see sweep).
+    self._holding=0
+    # Fetch in flight from arefresh.
+    self._afetch=None
+    self._lock=threading.Lock()
+
+  #-------------------------------------------------------
+  def snapshot(self):
+    """Output of the queue command, fetched again if it's older than ttl. 
+    Returns:
+      str: queue listing, or None if the command failed.
+    """
+    with self._lock:
+      if self._stale():
+        self._fetch()
+      return self.text
+
+  #-------------------------------------------------------
+  async def arefresh(self):
+    """Fetch the listing if it's stale, without blocking the asyncio event loop.
+    Concurrent calls share the same fetch.
+    Returns:
+      str: queue listing, or None if the command failed.
+    """
+    import asyncio
+    with self._lock:
+      stale=self._stale()
+    if stale:
+      if self._afetch is None or self._afetch.done():
+        self._afetch=asyncio.ensure_future(self._afetch_listing())
+      await asyncio.shield(self._afetch)
+    return self.text
+
+  #-------------------------------------------------------
+  def _stale(self):
+    return self.fetched is None or self._holding==0 and time.time()-self.fetched>self.ttl
+
+  #-------------------------------------------------------
+  def _commands(self):
+    """Shell commands to try in turn; the first one that succeeds gives the listing."""
+    return [self.command]
+
+  #-------------------------------------------------------
+  def _fetch(self):
+    start=time.time()
+    commands=self._commands()
+    text='' if len(commands)==0 else None
+    for command in commands:
+      try:
+        text=sub.check_output(command,stderr=sub.DEVNULL,shell=True).decode()
+        break
+      except (sub.CalledProcessError,OSError):
+        pass
+    self._store(text,start)
+
+  #-------------------------------------------------------
+  async def _afetch_listing(self):
+    import asyncio
+    start=time.time()
+    commands=self._commands()
+    text='' if len(commands)==0 else None
+    for command in commands:
+      try:
+        proc=await asyncio.create_subprocess_shell(command,stdout=sub.PIPE,stderr=sub.DEVNULL)
+      except OSError:
+        continue
+      output,_=await proc.communicate()
+      if proc.returncode==0:
+        text=output.decode()
+        break
+    with self._lock:
+      self._store(text,start)
+
+  #-------------------------------------------------------
+  def _store(self,text,start):
+    # Failures are cached too, so a broken scheduler isn't queried by every manager.
+    self.text=text
+    self.fetched=start
+    self._indexes={}
+    self._submitted=dict((qid,when) for qid,when in self._submitted.items() if when>=start)
+
+  #-------------------------------------------------------
+  def index(self,column=4):
+    """Jobs in the queue listing.
+    Args:
+      column (int): column with the state, for plain qstat listings (see parse_qstat).
+    Returns:
+      QueueIndex: jobs by id, or None if the queue couldn't be listed.
+    """
+    text=self.snapshot()
+    if text is None:
+      return None
+    with self._lock:
+      if column not in self._indexes:
+        index=parse_qstat(text,column)
+        for qid in self._submitted:
+          index.add({'id':qid,'state':'Q'},replace=False)
+        self._indexes[column]=index
+      return self._indexes[column]
+
+  #-------------------------------------------------------
+  def submitted(self,qid):
+    """Record a job submitted by this process, so it counts as queued until the listing is fetched again."""
+    with self._lock:
+      self._submitted[qid]=time.time()
+      for index in self._indexes.values():
+        index.add({'id':qid,'state':'Q'},replace=False)
+
+  #-------------------------------------------------------
+  def invalidate(self):
+    """Fetch the listing again at the next lookup."""
+    with self._lock:
+      self.fetched=None
+
+  #-------------------------------------------------------
+  @contextmanager
+  def sweep(self):
+    """Use one fresh listing for all the lookups inside, however long they take.
+
+    Usage:
+      with qstat_cache().sweep():
+        for mgr in managers:
+          mgr.nextstep()
+    """
+    with self._lock:
+      if self._holding==0:
+        self.fetched=None
+      self._holding+=1
+    try:
+      yield self
+    finally:
+      with self._lock:
+        self._holding-=1
+
+# Command used to list the queue. 'qstat -x' or 'qstat -f' also give exit statuses of finished jobs.
+QSTAT_COMMAND="qstat"
+
+_qstat_caches={}
+# Held while a shared cache is made, so threads starting at the same time get the same one.
+_caches_lock=threading.Lock()
+
+#-------------------------------------------------------
+def qstat_cache(command=None):
+  """The QstatCache for a queue command (default: QSTAT_COMMAND) shared by the whole process."""
+  if command is None: command=QSTAT_COMMAND
+  with _caches_lock:
+    if command not in _qstat_caches:
+      _qstat_caches[command]=QstatCache(command)
+    return _qstat_caches[command]
+
+#-------------------------------------------------------
+# PBS/Torque job states.
+JOB_STATES={
+    'Q':'queued',
+    'R':'running',
+    'H':'held',
+    'W':'waiting',
+    'T':'transit',
+    'S':'suspended',
+    'B':'array running',
+    'E':'exiting',
+    'C':'completed',
+    'F':'finished',
+    'X':'subjob finished',
+    'M':'moved'
+  }
+
+# States of jobs that still hold a place in the queue, so they shouldn't be resubmitted.
+ACTIVE_STATES=set('QRHWTSBE')
+# States of jobs that haven't started yet.
+WAITING_STATES=set('QHW')
+
+#-------------------------------------------------------
+class QueueIndex:
+  """Jobs in a queue listing, indexed by exact job id.
+  Each job is a dict with 'id', 'state' (see JOB_STATES), and if the listing has them, 'name', 'queue', and 'exit_status'.
+  Jobs can be looked up by full id (e.g. '4819103.bw') or by number ('4819103').
+  """
+  def __init__(self,jobs=(),active=ACTIVE_STATES,waiting=WAITING_STATES):
+    """
+    Args:
+      jobs (iterable): jobs to index.
+      active (set): states of jobs still holding a place in the queue.
+      waiting (set): states of jobs that haven't started.
+    """
+    self.active=active
+    self.waiting=waiting
+    self.jobs={}
+    self._positions=None
+    for job in jobs:
+      self.add(job)
+
+  def add(self,job,replace=True):
+    """Add a job to the index (replace=False keeps a job already listed under that id)."""
+    qid=job['id']
+    if replace or qid not in self.jobs:
+      self.jobs[qid]=job
+    self.jobs.setdefault(qid.split('.')[0],job)
+    self._positions=None
+
+  def __len__(self):
+    return len(set(id(job) for job in self.jobs.values()))
+
+  def __contains__(self,qid):
+    return qid in self.jobs
+
+  def job(self,qid):
+    """Job with this id, or None if it's not listed."""
+    return self.jobs.get(qid)
+
+  def get(self,qid,default=None):
+    """State of a job, or default if it's not listed."""
+    job=self.jobs.get(qid)
+    if job is None:
+      return default
+    return job['state']
+
+  def lookup(self,queueids):
+    """Look up many jobs at once.
+    Returns:
+      dict: job (or None if not listed) for each id.
+    """
+    return dict((qid,self.jobs.get(qid)) for qid in queueids)
+
+  def any_active(self,queueids):
+    """Whether any of the jobs is still in the queue (see ACTIVE_STATES)."""
+    return any(self.get(qid) in self.active for qid in queueids)
+
+  def position(self,qid):
+    """Number of waiting jobs listed before this one, or None if it isn't waiting.
+    Schedulers list jobs about in submission order, so this roughly tells how far the job is from starting.
+    """
+    if self._positions is None:
+      self._positions={}
+      for job in self.jobs.values():
+        if job['state'] in self.waiting and id(job) not in self._positions:
+          self._positions[id(job)]=len(self._positions)
+    job=self.jobs.get(qid)
+    if job is None:
+      return None
+    return self._positions.get(id(job))
+
+#-------------------------------------------------------
+def parse_qstat(qstat,column=4):
+  """Index the jobs in qstat output. Handles `qstat -x` (XML), `qstat -f`, and plain `qstat` listings.
+  Args:
+    qstat (str): output of qstat.
+    column (int): column with the state in plain listings (-2 on Blue Waters).
+  Returns:
+    QueueIndex: jobs by id.
+  """
+  start=qstat.lstrip()[:8]
+  if start.startswith('<'):
+    return QueueIndex(_parse_qstat_xml(qstat))
+  if start.startswith('Job Id:'):
+    return QueueIndex(_parse_qstat_full(qstat))
+  return QueueIndex(_parse_qstat_table(qstat,column))
 
+def _exit_status(value):
+  try:
+    return int(value)
+  except (TypeError,ValueError):
+    return None
+
+def _parse_qstat_table(qstat,column):
+  for line in qstat.split('\n'):
+    spl=line.split()
+    # Headers and separators don't start with a job number.
+    if len(spl) > 4 and spl[0][:1].isdigit():
+      yield {'id':spl[0],'name':spl[1],'state':spl[column],'queue':spl[-1]}
+
+def _parse_qstat_full(qstat):
+  job=None
+  for line in qstat.split('\n'):
+    if line.startswith('Job Id:'):
+      if job is not None: yield job
+      job={'id':line[7:].strip(),'state':None,'exit_status':None}
+    elif job is not None and ' = ' in line and not line.startswith('\t'):
+      key,value=line.split(' = ',1)
+      key=key.strip().lower()
+      if key=='job_state':     job['state']=value.strip()
+      elif key=='job_name':    job['name']=value.strip()
+      elif key=='queue':       job['queue']=value.strip()
+      elif key=='exit_status': job['exit_status']=_exit_status(value)
+  if job is not None: yield job
+
+def _parse_qstat_xml(qstat):
+  for elem in ET.fromstring(qstat.strip()).iter('Job'):
+    yield {
+        'id':elem.findtext('Job_Id'),
+        'name':elem.findtext('Job_Name'),
+        'state':elem.findtext('job_state'),
+        'queue':elem.findtext('queue'),
+        'exit_status':_exit_status(elem.findtext('exit_status',elem.findtext('Exit_status')))
+      }
+
+#-------------------------------------------------------
+def _running(queueids,index):
+  if index is not None and index.any_active(queueids):
+    return "running"
+  return 'unknown'
+
+#-------------------------------------------------------
 def check_BW_stati(queueids,qstat=None):
   """Utility function to determine the status of a set Blue Waters job.
   Args: 
     queueids (list): list of queueids as string representation of int, e.g. ['4819103','4819104'].
+    qstat (str): output of qstat (default: the process-wide QstatCache).
   """
-  try:
-    qstat = sub.check_output(
-        "qstat ", stderr=sub.STDOUT, shell=True
-      ).decode()
-  except sub.CalledProcessError:
-    return "unknown"
-  qstat=qstat.split('\n')
-  for qid in queueids:
-    for line in qstat:
-      spl=line.split()
-      if qid in line and len(spl) > 4:
-        stat=line.split()[-2]
-        if stat == "R" or stat == "Q":
-          return "running"
-  return 'unknown'
+  if qstat is None:
+    return _running(queueids,qstat_cache().index(column=-2))
+  return _running(queueids,parse_qstat(qstat,column=-2))
 
 #-------------------------------------------------------
 def check_PBS_stati(queueids,qstat=None):
   """Utility function to determine the status of a set PBS job.
   Args: 
     queueids (list): list of queueids as string representation of int, e.g. ['4819103','4819104'].
+    qstat (str): output of qstat (default: the process-wide QstatCache).
   """
   if qstat is None:
-    try:
-      qstat = sub.check_output(
-          "qstat ", stderr=sub.STDOUT, shell=True
-        ).decode()
-    except sub.CalledProcessError:
-      return "unknown"
-  qstat=qstat.split('\n')
-  for qid in queueids:
-    for line in qstat:
-      spl=line.split()
-      if qid in line and len(spl) > 4:
-        stat=line.split()[4]
-        if stat == "R" or stat == "Q":
-          return "running"
-  return 'unknown'
+    return _running(queueids,qstat_cache().index(column=4))
+  return _running(queueids,parse_qstat(qstat,column=4))
 
+#-------------------------------------------------------
+# States of Slurm jobs that are still in the queue. Other states (COMPLETED, FAILED, TIMEOUT, ...) are final.
+SLURM_ACTIVE_STATES=set(['PENDING','RUNNING','CONFIGURING','COMPLETING','SUSPENDED','REQUEUED','REQUEUE_HOLD',
+    'REQUEUE_FED','RESIZING','SIGNALING','STAGE_OUT','STOPPED','RESV_DEL_HOLD'])
+# States of Slurm jobs that haven't started yet.
+SLURM_WAITING_STATES=set(['PENDING','REQUEUE_HOLD','REQUEUED'])
+
+# Fields asked of sacct and squeue, in the same order, so one parser reads both.
+SACCT_COMMAND="sacct -X -n -P --format=JobID,JobName,Partition,State,ExitCode"
+SQUEUE_COMMAND="squeue -h -o '%i|%j|%P|%T'"
+
+#-------------------------------------------------------
+class SlurmCache(QstatCache):
+  """Slurm version of QstatCache.
+  It lists all the jobs it tracks in one `sacct --jobs=<list>` call (`squeue` if accounting isn't available),
+  so finished jobs show their final state and exit code.
+  Jobs are tracked when they are submitted or looked up; tracking all of a sweep's jobs first (see track) 
+  means the sweep only queries Slurm once.
+  Jobs that have finished aren't queried again: their last listing is kept, so the query only grows with the jobs in the queue.
+  """
+  def __init__(self,ttl=30):
+    QstatCache.__init__(self,command=SACCT_COMMAND,ttl=ttl)
+    self.tracked=set()
+    # Jobs no longer tracked, because they finished: job id -> their last listing (None if they weren't listed).
+    self.finished={}
+
+  #-------------------------------------------------------
+  def track(self,queueids):
+    """Include these jobs in the next listing. The listing is fetched again if any of them are new."""
+    with self._lock:
+      new=set(queueids)-self.tracked-set(self.finished)
+      if len(new)>0:
+        self.tracked|=new
+        self.fetched=None
+
+  #-------------------------------------------------------
+  def _commands(self):
+    if len(self.tracked)==0:
+      return []
+    jobs=' --jobs=%s'%','.join(sorted(self.tracked))
+    return [SACCT_COMMAND+jobs,SQUEUE_COMMAND+jobs,SQUEUE_COMMAND+' -u $USER']
+
+  #-------------------------------------------------------
+  def index(self,queueids=()):
+    """Jobs in the listing.
+    Args:
+      queueids (list): jobs to track (see track).
+    Returns:
+      QueueIndex: jobs by id, or None if Slurm couldn't be queried.
+    """
+    self.track(queueids)
+    text=self.snapshot()
+    if text is None:
+      return None
+    with self._lock:
+      if 'slurm' not in self._indexes:
+        index=parse_slurm(text)
+        self._retire(index)
+        for job in self.finished.values():
+          if job is not None:
+            index.add(job,replace=False)
+        for qid in self._submitted:
+          index.add({'id':qid,'state':'PENDING'},replace=False)
+        self._indexes['slurm']=index
+      return self._indexes['slurm']
+
+  #-------------------------------------------------------
+  def _retire(self,index):
+    """Stop tracking the jobs of a fresh listing that are in a final state, or no longer listed at all.
+    Jobs submitted since the listing was fetched are kept."""
+    for qid in list(self.tracked):
+      if qid in self._submitted:
+        continue
+      job=index.job(qid)
+      if job is None or job['state'] not in index.active:
+        self.tracked.discard(qid)
+        self.finished[qid]=job
+
+  #-------------------------------------------------------
+  def submitted(self,qid):
+    """Record a job submitted by this process, so it counts as pending until the listing is fetched again."""
+    with self._lock:
+      self.tracked.add(qid)
+      self._submitted[qid]=time.time()
+      for index in self._indexes.values():
+        index.add({'id':qid,'state':'PENDING'},replace=False)
+
+_slurm_cache=None
+
+#-------------------------------------------------------
+def slurm_cache():
+  """The SlurmCache shared by the whole process."""
+  global _slurm_cache
+  with _caches_lock:
+    if _slurm_cache is None:
+      _slurm_cache=SlurmCache()
+    return _slurm_cache
+
+#-------------------------------------------------------
+def parse_slurm(listing):
+  """Index the jobs in `sacct -P` or `squeue` output with fields JobID|JobName|Partition|State[|ExitCode].
+  Returns:
+    QueueIndex: jobs by id.
+  """
+  index=QueueIndex(active=SLURM_ACTIVE_STATES,waiting=SLURM_WAITING_STATES)
+  for line in listing.split('\n'):
+    spl=line.strip().split('|')
+    if len(spl)<4 or not spl[0][:1].isdigit():
+      continue
+    # sacct writes states like 'CANCELLED by 1234'.
+    job={'id':spl[0],'name':spl[1],'queue':spl[2],'state':spl[3].split()[0].rstrip('+') if spl[3] else None}
+    if len(spl)>4:
+      job['exit_status']=_exit_status(spl[4].split(':')[0])
+    index.add(job)
+  return index
+
+#-------------------------------------------------------
+def check_slurm_stati(queueids,qstat=None):
+  """Utility function to determine the status of a set of Slurm jobs.
+  Args: 
+    queueids (list): list of job ids, e.g. ['4819103','4819104'].
+    qstat (str): output of sacct or squeue (see parse_slurm) (default: the process-wide SlurmCache).
+  """
+  if qstat is None:
+    return _running(queueids,slurm_cache().index(queueids))
+  return _running(queueids,parse_slurm(qstat))
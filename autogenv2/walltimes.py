@@ -0,0 +1,159 @@
+''' Walltimes predicted from past runs.
+
+Asking for much more walltime than a job needs keeps it out of the backfill windows of the queue.
+A runner or Bundler with walltime='auto' asks for a walltime predicted from the runs in the runtime ledger (see ledger).
+For each kind of task (manager class, writer class, and which task of the manager it is), the log of the run time
+is fitted by least squares to the logs of the system size, the nodes, the number of k-points, the supercell size,
+the number of blocks, and one over the timestep.
+The walltime asked for is SIGMAS standard deviations of the fit above the prediction, times SAFETY, rounded up to minutes.
+With too few runs to fit, the longest run of the kind times SAFETY is asked for, or FALLBACK with no runs at all.
+
+The ledger in $AUTOGEN_LEDGER collects the runs of every manager, so it makes the best predictions.
+
+Usage:
+  runner=RunnerBW(nn=4,walltime='auto')
+'''
+import os
+import math
+import threading
+from contextlib import contextmanager
+from autogenv2 import ledger
+from autogenv2.autorunner import walltime_seconds, format_walltime
+
+AUTO='auto'
+# Walltime asked for when there are no runs to learn from, which is also the most ever asked for.
+FALLBACK='48:00:00'
+SAFETY=1.25
+SIGMAS=2.0
+# Shortest walltime asked for, in seconds.
+MIN_SECONDS=600
+
+######################################################################
+def task_kind(record):
+  ''' Runs that are fitted together: manager class, writer class, and which task of the manager.'''
+  return (record.get('manager'),(record.get('settings') or {}).get('writer'),record.get('task',0))
+
+######################################################################
+def features(record):
+  ''' Logs of the quantities a run time is fitted to; missing quantities count as 1.'''
+  settings=record.get('settings') or {}
+  kpoints=settings.get('kmesh')
+  if isinstance(kpoints,list):
+    kpoints=math.prod(kpoints)
+  timestep=settings.get('timestep')
+  values=[
+      record.get('system_size'),
+      record.get('nodes'),
+      kpoints,
+      ledger.supercell_cells(settings.get('supercell')),
+      settings.get('nblock'),
+      None if not timestep else 1./timestep,
+    ]
+  return [math.log(value) if isinstance(value,(int,float)) and value>0 else 0.0 for value in values]
+
+######################################################################
+class WalltimeEstimator:
+  ''' Fits of the run times of the tasks in a ledger.'''
+  def __init__(self,records):
+    '''
+    Args:
+      records (list): ledger records (see ledger.read_ledger). Only tasks that exited successfully are used.
+    '''
+    runs={}
+    for record in records:
+      if record.get('exit_code')==0 and record.get('end') is not None and record['end']>record['start']:
+        runs.setdefault(task_kind(record),[]).append(record)
+    self.fits={}
+    for kind,kindruns in runs.items():
+      self.fits[kind]=self._fit(kindruns)
+
+  #------------------------------------------------
+  def _fit(self,runs):
+    ''' Least squares fit of log(run time) for one kind of task.
+    Returns:
+      dict: 'columns' of features used, 'coef', 'sigma', and 'longest' run time.
+    '''
+    import numpy as np
+    X=np.array([features(record) for record in runs])
+    y=np.log([record['end']-record['start'] for record in runs])
+    fit={'longest':float(np.exp(y.max())),'coef':None}
+    # Features that don't change between the runs can't be fitted.
+    columns=[col for col in range(X.shape[1]) if X[:,col].std()>0]
+    A=np.hstack([np.ones((len(runs),1)),X[:,columns]])
+    if len(runs)<A.shape[1]+2:
+      return fit
+    coef,_,rank,_=np.linalg.lstsq(A,y,rcond=None)
+    residuals=y-A.dot(coef)
+    fit.update({
+        'columns':columns,
+        'coef':coef,
+        'sigma':float(np.sqrt((residuals**2).sum()/max(len(runs)-rank,1))),
+      })
+    return fit
+
+  #------------------------------------------------
+  def predict(self,record):
+    ''' Seconds to ask for a task described like a ledger record (without times).'''
+    fit=self.fits.get(task_kind(record))
+    if fit is None:
+      return walltime_seconds(FALLBACK)
+    if fit['coef'] is None:
+      seconds=fit['longest']*SAFETY
+    else:
+      x=[1.0]+[features(record)[col] for col in fit['columns']]
+      seconds=math.exp(sum(c*v for c,v in zip(fit['coef'],x))+SIGMAS*fit['sigma'])*SAFETY
+    seconds=60*math.ceil(max(seconds,MIN_SECONDS)/60.)
+    return min(seconds,walltime_seconds(FALLBACK))
+
+######################################################################
+_estimators={}
+_estimators_lock=threading.Lock()
+
+def estimator(sources):
+  ''' Estimator for some ledger files, fitted again only when they change.'''
+  sources=tuple(sorted(sources))
+  stamps=tuple(os.stat(fn).st_mtime if os.path.exists(fn) else None for fn in sources)
+  with _estimators_lock:
+    if sources not in _estimators or _estimators[sources][0]!=stamps:
+      records=ledger.read_ledger([fn for fn,stamp in zip(sources,stamps) if stamp is not None])
+      _estimators[sources]=(stamps,WalltimeEstimator(records))
+    return _estimators[sources][1]
+
+######################################################################
+def predicted_seconds(mgr,runner=None):
+  ''' Seconds predicted for the next task of a manager on a runner (default: mgr.runner).'''
+  if runner is None:
+    runner=mgr.runner
+  prunner=mgr.__dict__.get('prunner')
+  record={
+      'manager':mgr.__class__.__name__,
+      # A separate properties runner runs the second task of a CrystalManager.
+      'task':1 if prunner is runner and prunner is not mgr.runner else 0,
+      'system_size':ledger.system_size(mgr),
+      'settings':ledger.writer_settings(mgr.__dict__.get('writer')),
+      'nodes':runner.nn,
+    }
+  return estimator([ledger.ledger_file(mgr)]).predict(record)
+
+######################################################################
+def requested_seconds(mgr,runner=None):
+  ''' Seconds a manager's runner asks for: its walltime, or the predicted one if it's 'auto'.'''
+  if runner is None:
+    runner=mgr.runner
+  if runner.walltime==AUTO:
+    return predicted_seconds(mgr,runner)
+  return walltime_seconds(runner.walltime)
+
+######################################################################
+@contextmanager
+def requested(mgr,runner):
+  ''' Give a runner with walltime='auto' the predicted walltime while its job script is written.
+  The runner goes back to 'auto' after, so the next job is predicted again.'''
+  if getattr(runner,'walltime',None)!=AUTO:
+    yield
+    return
+  runner.walltime=format_walltime(predicted_seconds(mgr,runner))
+  try:
+    yield
+  finally:
+    runner.walltime=AUTO
@@ -0,0 +1,47 @@
+'''
+Benchmarks deep_compare, as update_attributes runs it on a reader's output at every step.
+The output holds density-matrix-sized arrays, either mapped in from sidecar files (as loaded managers have them)
+or in writeable memory (as freshly collected ones have them), and is compared with an equal copy.
+
+Usage: python bench_compare.py [matrix size]
+'''
+import sys
+import time
+import tempfile
+import numpy as np
+import testing
+from autogenv2 import sidecar
+from autogenv2.manager import deep_compare
+
+SIZE=1000
+REPEAT=20
+
+###################################################################################################################
+def array_equal_compare(d1,d2):
+  ''' Comparison by np.array_equal of every array, as deep_compare did before, for comparison.'''
+  if type(d1)==dict:
+    return d1.keys()==d2.keys() and all(array_equal_compare(d1[key],d2[key]) for key in d1)
+  return np.array_equal(d1,d2)
+
+def output(size,arraydir=None):
+  rng=np.random.RandomState(0)
+  out={'obdm':{'up':rng.rand(size,size),'down':rng.rand(size,size)},'energy':-1.5}
+  if arraydir is not None:
+    for spin in ('up','down'):
+      out['obdm'][spin]=sidecar.load_array(sidecar.save_array(out['obdm'][spin],arraydir),arraydir)
+  return out
+
+def timed(compare,d1,d2):
+  start=time.perf_counter()
+  for rep in range(REPEAT):
+    assert compare(d1,d2)
+  return (time.perf_counter()-start)/REPEAT
+
+###################################################################################################################
+if __name__=='__main__':
+  size=int(sys.argv[1]) if len(sys.argv)>1 else SIZE
+  arraydir=tempfile.mkdtemp()
+  for kind,(d1,d2) in (('sidecar',(output(size,arraydir),output(size,arraydir))),('writeable',(output(size),output(size)))):
+    full=timed(array_equal_compare,d1,d2)
+    fast=timed(deep_compare,d1,d2)
+    print("%-9s %dx%d: np.array_equal %8.3f ms, deep_compare %8.3f ms (%.1fx)"%(kind,size,size,1e3*full,1e3*fast,full/fast))
@@ -0,0 +1,103 @@
+'''
+Benchmarks parsing of large qstat listings, and checks the parsers agree with each other.
+Synthetic listings of about 50k lines are generated in the plain, `qstat -f`, and `qstat -x` (XML) formats.
+
+Usage: python bench_qstat.py [number of lines]
+'''
+import sys
+import time
+import random
+import testing
+from autogenv2 import submitter
+
+LINES=50000
+STATES='QRHECW'
+
+###################################################################################################################
+def make_jobs(njobs):
+  random.seed(0)
+  return [{'id':'%d.bw'%(4000000+i),'name':'job%d'%(4000000+i+7),'state':random.choice(STATES),
+      'queue':'normal','exit_status':random.choice((None,0,1,271))} for i in range(njobs)]
+
+def plain_listing(jobs):
+  lines=["Job ID                    Name             User            Time Use S Queue",
+      "------------------------- ---------------- --------------- -------- - -----"]
+  for job in jobs:
+    lines.append("%-25s %-16s %-15s %8s %s %s"%(job['id'],job['name'],'user','00:00:00',job['state'],job['queue']))
+  return '\n'.join(lines)
+
+def full_listing(jobs):
+  lines=[]
+  for job in jobs:
+    lines+=["Job Id: %s"%job['id'],
+        "    Job_Name = %s"%job['name'],
+        "    Job_Owner = user@login1",
+        "    job_state = %s"%job['state'],
+        "    queue = %s"%job['queue'],
+        "    Resource_List.nodes = 1:ppn=32",
+        "    Resource_List.walltime = 48:00:00",
+        "    Variable_List = PBS_O_HOME=/home/user,PBS_O_PATH=/usr/bin:/bin,",
+        "\tPBS_O_WORKDIR=/home/user/run"]
+    if job['exit_status'] is not None:
+      lines.append("    exit_status = %d"%job['exit_status'])
+    lines.append("")
+  return '\n'.join(lines)
+
+def xml_listing(jobs):
+  parts=['<Data>']
+  for job in jobs:
+    parts.append("<Job><Job_Id>%s</Job_Id><Job_Name>%s</Job_Name><job_state>%s</job_state><queue>%s</queue>%s</Job>"%(
+      job['id'],job['name'],job['state'],job['queue'],
+      "" if job['exit_status'] is None else "<exit_status>%d</exit_status>"%job['exit_status']))
+  parts.append('</Data>')
+  # Torque prints the whole document on one line; count lines as if each job were a line of the plain listing.
+  return '\n'.join(parts)
+
+###################################################################################################################
+def substring_check(queueids,qstat):
+  ''' The old check_PBS_stati, for comparison.'''
+  qstat=qstat.split('\n')
+  for qid in queueids:
+    for line in qstat:
+      spl=line.split()
+      if qid in line and len(spl) > 4:
+        stat=line.split()[4]
+        if stat == "R" or stat == "Q":
+          return "running"
+  return 'unknown'
+
+def timed(func,*args):
+  start=time.perf_counter()
+  result=func(*args)
+  return result,time.perf_counter()-start
+
+###################################################################################################################
+def bench(lines=LINES):
+  plain_jobs=make_jobs(lines)
+  full_jobs=make_jobs(lines//10)
+  listings=[
+      ('plain',plain_listing(plain_jobs),plain_jobs),
+      ('qstat -f',full_listing(full_jobs),full_jobs),
+      ('qstat -x',xml_listing(plain_jobs),plain_jobs),
+    ]
+  for label,text,jobs in listings:
+    index,elapsed=timed(submitter.parse_qstat,text)
+    assert len(index)==len(jobs), (label,len(index))
+    queueids=[job['id'].split('.')[0] for job in jobs]
+    found,lookup_time=timed(index.lookup,queueids)
+    assert all(found[qid]['state']==job['state'] for qid,job in zip(queueids,jobs))
+    if label!='plain':
+      assert all(found[qid]['exit_status']==job['exit_status'] for qid,job in zip(queueids,jobs))
+    print("{:<10} {:>7} lines {:>7} jobs: parse {:7.1f} ms, look up all jobs {:6.1f} ms".format(
+      label,text.count('\n')+1,len(jobs),elapsed*1e3,lookup_time*1e3))
+
+  # One manager's check against the old way, for a job near the end of the listing.
+  text=listings[0][1]
+  qid=plain_jobs[-1]['id'].split('.')[0]
+  old,old_time=timed(substring_check,[qid],text)
+  index=submitter.parse_qstat(text)
+  new,new_time=timed(submitter._running,[qid],index)
+  print("one check: substring scan {:.1f} ms, indexed {:.4f} ms".format(old_time*1e3,new_time*1e3))
+
+if __name__=='__main__':
+  bench(LINES if len(sys.argv)<2 else int(sys.argv[1]))
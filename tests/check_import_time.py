@@ -0,0 +1,68 @@
+'''
+Checks that importing autogenv2 stays cheap, since short-lived commands (like autoutil.py) pay for it every time.
+Each import is timed in a fresh interpreter, against the startup time of an empty interpreter.
+
+Usage: python check_import_time.py [budget in ms]
+Exits with status 1 if an import goes over budget or pulls in a heavy dependency.
+'''
+import os
+import sys
+import time
+import subprocess as sub
+
+# Added time allowed for each import, in seconds.
+BUDGET=0.1
+
+# Imports to check, with dependencies they shouldn't load.
+CHECKS=[
+    ('autogenv2',['numpy','sqlite3','qwalk_objects','pyscf']),
+    ('autogenv2.autoutil',['numpy','qwalk_objects','pyscf']),
+    ('autogenv2.manager',['numpy','qwalk_objects','pyscf']),
+  ]
+
+REPEATS=7
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+###################################################################################################################
+def cold_time(code):
+  ''' Best wall time of running code in a fresh interpreter.'''
+  env=dict(os.environ)
+  env['PYTHONPATH']=ROOT+os.pathsep+env.get('PYTHONPATH','')
+  best=None
+  for rep in range(REPEATS):
+    start=time.perf_counter()
+    sub.check_call([sys.executable,'-c',code],env=env)
+    elapsed=time.perf_counter()-start
+    if best is None or elapsed<best:
+      best=elapsed
+  return best
+
+###################################################################################################################
+def loaded_modules(module,heavy):
+  ''' Which of the heavy modules are loaded after importing module.'''
+  code="import sys,%s; print(' '.join(m for m in %r if m in sys.modules))"%(module,heavy)
+  env=dict(os.environ)
+  env['PYTHONPATH']=ROOT+os.pathsep+env.get('PYTHONPATH','')
+  return sub.check_output([sys.executable,'-c',code],env=env).decode().split()
+
+###################################################################################################################
+def check_import_time(budget=BUDGET):
+  ''' Time each import in CHECKS.
+  Returns:
+    bool: whether all the imports are within budget.
+  '''
+  base=cold_time('pass')
+  ok=True
+  for module,heavy in CHECKS:
+    cost=cold_time('import %s'%module)-base
+    loaded=loaded_modules(module,heavy)
+    passed=cost<=budget and len(loaded)==0
+    print("{:<22} {:7.1f} ms (budget {:.1f} ms) {}{}".format(
+      module,cost*1e3,budget*1e3,"ok" if passed else "FAILED",
+      "" if len(loaded)==0 else ", loaded "+" ".join(loaded)))
+    ok=ok and passed
+  return ok
+
+if __name__=='__main__':
+  budget=BUDGET if len(sys.argv)<2 else float(sys.argv[1])/1e3
+  sys.exit(0 if check_import_time(budget) else 1)
@@ -0,0 +1,100 @@
+'''
+Tests of the bulk status scanner (autogenv2.autoutil scan).
+'''
+import os
+import time
+import testing
+from autogenv2 import autoutil
+from autogenv2.autorunner import RunnerPBS
+
+def campaign(root):
+  ''' Saved managers in nested directories: a and b/c still to run, d done.'''
+  mgrs={}
+  os.mkdir(os.path.join(root,'b'))
+  for name in ('a','b/c','d'):
+    mgrs[name]=testing.TaskManager('true',os.path.join(root,name))
+  mgrs['d'].completed=True
+  mgrs['d'].update_pickle()
+  return mgrs
+
+###################################################################################################################
+def test_scan_finds_nested_managers():
+  root=testing.scratch()
+  campaign(root)
+  records=autoutil.scan([root],jobs=2)
+  assert [os.path.relpath(record['path'],root) for record in records]==['a','b/c','d'], records
+  assert [record['terminal'] for record in records]==[None,None,'done'], records
+  table=autoutil.format_scan(records)
+  assert len(table.split('\n'))==4 and 'TaskManager' in table, table
+
+def test_scan_filters():
+  root=testing.scratch()
+  campaign(root)
+  active=autoutil.scan([root],only_active=True,jobs=1)
+  assert [os.path.relpath(record['path'],root) for record in active]==['a','b/c'], active
+  assert autoutil.scan([root],changed_since=time.time()+60,jobs=1)==[]
+  # Globs pick the directories to search.
+  globbed=autoutil.scan([os.path.join(root,'[ab]*')],jobs=1)
+  assert [os.path.relpath(record['path'],root) for record in globbed]==['a','b/c'], globbed
+
+def test_scan_loads_managers_without_status():
+  ''' Managers saved before status records existed are unpickled instead.'''
+  root=testing.scratch()
+  mgrs=campaign(root)
+  os.remove(os.path.join(mgrs['d'].path,'task.status'))
+  records=autoutil.scan([root],jobs=1)
+  done=[record for record in records if record['terminal']=='done']
+  assert len(done)==1 and done[0]['path']==mgrs['d'].path, records
+
+def test_info_after_set_queueid():
+  ''' Changing a saved manager with autoutil updates its status record too.'''
+  root=testing.scratch()
+  mgr=testing.TaskManager('true',root)
+  pickle=os.path.join(mgr.path,'task.pkl')
+  autoutil.set_queueid(pickle,'12345')
+  assert autoutil.load_manager(pickle).runner.queueid==['12345']
+  with testing.captured_output() as output:
+    autoutil.get_info(pickle)
+  assert "Queue id: ['12345']" in output.getvalue(), output.getvalue()
+  assert autoutil.scan([root],jobs=1)[0]['queueid']==['12345']
+
+def test_info_lists_properties_jobs():
+  root=testing.scratch()
+  mgr=testing.TaskManager('true',root)
+  mgr.prunner=RunnerPBS()
+  mgr.runner.queueid.append('100')
+  mgr.prunner.queueid.append('200')
+  mgr.update_pickle()
+  with testing.captured_output() as output:
+    autoutil.get_info(os.path.join(mgr.path,'task.pkl'))
+  assert "Queue id: ['100']" in output.getvalue() and "Properties queue id: ['200']" in output.getvalue(), output.getvalue()
+
+def test_info_loads_manager_saved_elsewhere():
+  ''' A state file newer than its status record (e.g. saved by an older autogenv2) is read instead of the record.'''
+  root=testing.scratch()
+  mgr=testing.TaskManager('true',root)
+  pickle=os.path.join(mgr.path,'task.pkl')
+  mgr.runner.queueid.append('777')
+  with open(pickle,'wb') as outf:
+    autoutil.serialize.dump_state(mgr,outf,os.path.join(root,'autogen_arrays/'),'pickle')
+  later=os.stat(pickle).st_mtime+10
+  os.utime(pickle,(later,later))
+  with testing.captured_output() as output:
+    autoutil.get_info(pickle)
+  assert "Queue id: ['777']" in output.getvalue(), output.getvalue()
+  assert autoutil.scan([root],jobs=1)[0]['queueid']==['777']
+
+def test_parse_time():
+  now=time.time()
+  assert abs(autoutil.parse_time('6h')-(now-6*3600))<5
+  assert autoutil.parse_time('1700000000')==1700000000.
+  assert autoutil.parse_time('2024-05-01')==time.mktime((2024,5,1,0,0,0,0,0,-1))
+  try:
+    autoutil.parse_time('yesterday')
+  except ValueError:
+    pass
+  else:
+    assert False, "parsed 'yesterday'"
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,75 @@
+'''
+Tests of bundling managers into shared allocations (autogenv2.bundler).
+'''
+import os
+import subprocess as sub
+import testing
+from autogenv2.bundler import Bundler, Bundle, pack_bundles, packing_report
+from autogenv2.autorunner import RunnerPBS
+
+def run_bundle(script,bindir,nodes):
+  ''' Run a bundle script as the queue would, on fake nodes.'''
+  nodefile=os.path.join(bindir,'nodefile')
+  with open(nodefile,'w') as outf:
+    outf.write('\n'.join(nodes)+'\n')
+  with testing.environment(path=bindir,PBS_NODEFILE=nodefile):
+    return sub.call(['bash',script],stdout=sub.DEVNULL)
+
+###################################################################################################################
+def test_failed_task_in_exit_file():
+  path=testing.scratch()
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    mgrs=[testing.TaskManager(command,os.path.join(path,name)) for name,command in (('good','true'),('bad','false'))]
+    for mgr in mgrs:
+      mgr.nextstep()
+    Bundler(npb=2,walltime='1:00:00',jobname='bundle').submit(mgrs)
+  jobs=os.listdir(os.path.join(bindir,'jobs'))
+  assert jobs==['1000'], jobs
+  status=run_bundle(os.path.join(bindir,'jobs','1000'),bindir,['node1','node2'])
+  with open(os.path.join(path,'bundle_0.exit')) as inpf:
+    codes=dict(reversed(line.split()) for line in inpf)
+  assert codes=={mgrs[0].logname:'0',mgrs[1].logname:'1'}, codes
+  # So afterok dependencies on the bundle don't start.
+  assert status!=0
+
+def test_first_fit_decreasing_layout():
+  items=[('a',2,3000),('b',1,3600),('c',1,1800),('d',1,1800),('e',2,600),('f',1,7200)]
+  bundles,left_out=pack_bundles(items,3,3600)
+  layout=[[(column.width,column.mgrs) for column in bundle.columns] for bundle in bundles]
+  # Widest first: e follows a on its nodes, b takes the last node, and c and d share a second bundle.
+  assert layout==[[(2,['a','e']),(1,['b'])],[(1,['c','d'])]], layout
+  assert [bundle.walltime() for bundle in bundles]==[3600,3600]
+  assert bundles[0].utilization()==1.0
+  assert left_out==['f'], left_out
+
+def test_empty_bundles_report():
+  assert Bundle(3,3600).utilization()==0.0
+  # Managers expected to take no time at all ask for no walltime.
+  bundles,left_out=pack_bundles([('a',1,0),('b',2,0)],3,3600)
+  assert [bundle.walltime() for bundle in bundles]==[0] and bundles[0].utilization()==0.0
+  report=packing_report(bundles+[Bundle(3,3600)])
+  assert '0%' in report and 'node-hours' not in report, report
+
+def test_too_long_for_bundle_submitted_alone():
+  path=testing.scratch()
+  bindir=testing.fake_qsub(os.path.join(path,'bin'))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    short=testing.TaskManager('true',os.path.join(path,'short'))
+    long=testing.TaskManager('sleep 1',os.path.join(path,'long'),runner=RunnerPBS(walltime='2:00:00'))
+    for mgr in (short,long):
+      mgr.nextstep()
+    left_out=Bundler(npb=2,walltime='1:00:00',jobname='bundle').submit([short,long])
+  assert left_out==[long], left_out
+  scripts={}
+  for job in os.listdir(os.path.join(bindir,'jobs')):
+    with open(os.path.join(bindir,'jobs',job)) as inpf:
+      scripts[job]=inpf.read()
+  assert len(scripts)==2, scripts
+  alone=scripts[long.runner.queueid[-1]]
+  assert 'walltime=2:00:00' in alone and 'sleep 1' in alone, alone
+  assert short.runner.queueid[-1]!=long.runner.queueid[-1]
+  assert 'sleep 1' not in scripts[short.runner.queueid[-1]]
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,115 @@
+'''
+Tests of stepping many managers at once, from threads (autogenv2.campaign) or asyncio (Manager.astep, Campaign.asweep).
+'''
+import os
+import asyncio
+import threading
+import subprocess as sub
+import testing
+from autogenv2 import submitter
+from autogenv2.manager import Manager
+from autogenv2.campaign import Campaign
+from autogenv2.statestore import StateStore
+
+class BrokenManager(testing.TaskManager):
+  def nextstep(self,qstat=None):
+    raise RuntimeError("broken")
+
+class CountingManager(testing.TaskManager):
+  ''' TaskManager counting its steps, and noting which of the watched stores were in a sweep during them.'''
+  watched=()
+  def nextstep(self,qstat=None):
+    self.steps=self.__dict__.get('steps',0)+1
+    self.stores_held=[store._depth>0 for store in self.watched]
+    testing.TaskManager.nextstep(self,qstat)
+
+def run_job(bindir,qid):
+  sub.check_call(['bash',os.path.join(bindir,'jobs',qid)],stdout=sub.DEVNULL)
+
+###################################################################################################################
+def test_sweep_steps_each_manager_once():
+  path=testing.scratch()
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    submitter._qstat_caches.clear()
+    mgrs=[CountingManager('true',os.path.join(path,'m%d'%idx),bundle=False) for idx in range(12)]
+    broken=BrokenManager('true',os.path.join(path,'broken'))
+    report=Campaign(mgrs+[broken],workers=4).sweep()
+  assert [mgr.steps for mgr in mgrs]==[1]*12
+  assert report.transitions=={('new','not_started'):12,('new','error'):1}, report.transitions
+  assert report.active==13 and len(report.errors)==1
+  # Every manager submitted its own job, and all of them registered with the same queue listing.
+  assert len(os.listdir(os.path.join(bindir,'jobs')))==12
+  assert list(submitter._qstat_caches)==['qstat']
+  listing=submitter.qstat_cache().index()
+  assert all(mgr.runner.queueid[-1] in listing for mgr in mgrs)
+
+def test_sweep_of_some_managers_holds_their_stores():
+  path=testing.scratch()
+  stores=[StateStore(os.path.join(path,'%s.db'%name)) for name in ('stepped','other')]
+  mgrs=[]
+  for store in stores:
+    mgr=CountingManager('true',os.path.join(path,os.path.basename(store.dbfile)[:-3]))
+    mgr.store=store
+    mgr.update_pickle()
+    mgrs.append(mgr)
+  CountingManager.watched=stores
+  try:
+    Campaign(mgrs).sweep(managers=mgrs[:1])
+  finally:
+    CountingManager.watched=()
+  assert mgrs[0].steps==1 and mgrs[0].stores_held==[True,False]
+  assert 'steps' not in mgrs[1].__dict__
+
+def test_shared_caches_made_once():
+  submitter._qstat_caches.clear()
+  submitter._slurm_cache=None
+  barrier=threading.Barrier(8)
+  caches=[]
+  def get():
+    barrier.wait()
+    caches.append((submitter.qstat_cache(),submitter.slurm_cache()))
+  threads=[threading.Thread(target=get) for idx in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(set(qstat for qstat,slurm in caches))==1 and len(set(slurm for qstat,slurm in caches))==1
+
+def test_astep_submits_and_saves():
+  path=testing.scratch()
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    submitter.qstat_cache().invalidate()
+    mgr=testing.TaskManager('true',os.path.join(path,'task'),bundle=False)
+    asyncio.run(mgr.astep())
+    assert mgr.runner.queueid==['1000'], mgr.runner.queueid
+    assert mgr._deferred is None
+    assert Manager.load(mgr.path,'task').runner.queueid==['1000']
+    # Submitted jobs count as queued, so the next step doesn't submit again.
+    asyncio.run(mgr.astep())
+    assert os.listdir(os.path.join(bindir,'jobs'))==['1000']
+    run_job(bindir,'1000')
+    asyncio.run(mgr.astep())
+  assert mgr.completed and mgr.last_status=='done'
+
+def test_asweep_reports_each_manager():
+  path=testing.scratch()
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    submitter.qstat_cache().invalidate()
+    mgrs=[testing.TaskManager('true',os.path.join(path,name),bundle=False) for name in ('a','b')]
+    broken=BrokenManager('true',os.path.join(path,'broken'))
+    campaign=Campaign(mgrs+[broken],workers=2)
+    report=asyncio.run(campaign.asweep())
+    assert report.transitions=={('new','not_started'):2,('new','error'):1}, report.transitions
+    assert [logname for logname,error,trace in report.errors]==[broken.logname], report.errors
+    assert sorted(os.listdir(os.path.join(bindir,'jobs')))==['1000','1001']
+    for qid in ('1000','1001'):
+      run_job(bindir,qid)
+    report=asyncio.run(Campaign(mgrs).asweep())
+  assert report.transitions=={('not_started','done'):2}, report.transitions
+  assert report.active==0
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,94 @@
+'''
+Tests of the daemon planning when managers are checked (autogenv2.daemon).
+'''
+import os
+import json
+import time
+import testing
+from autogenv2 import sentinels, submitter
+from autogenv2.daemon import Daemon, QUEUE_STEP
+from autogenv2.campaign import Campaign
+from autogenv2.dag import Scheduler, node_key
+
+def daemon(mgrs,campaign=Campaign,heartbeat=None):
+  return Daemon(campaign(mgrs),heartbeat=heartbeat,min_interval=10,max_interval=100)
+
+###################################################################################################################
+def test_unchanged_managers_back_off():
+  mgr=testing.TaskManager('true',testing.scratch())
+  mgr.last_status='running'
+  farm=daemon([mgr])
+  intervals=[]
+  for check in range(5):
+    farm.plan(mgr,False,0)
+    intervals.append(farm.interval[node_key(mgr)])
+  assert intervals==[20,40,80,100,100], intervals
+  farm.plan(mgr,True,0)
+  assert farm.interval[node_key(mgr)]==10
+  assert farm.due_managers(now=5)==[] and farm.due_managers(now=10)==[mgr]
+
+def test_stuck_managers_back_off():
+  ''' A manager stuck in any state, e.g. one whose submission keeps failing, isn't checked at the fastest rate forever.'''
+  mgr=testing.TaskManager('true',testing.scratch())
+  mgr.last_status='not_started'
+  farm=daemon([mgr])
+  intervals=[]
+  for check in range(4):
+    farm.plan(mgr,False,0)
+    intervals.append(farm.interval[node_key(mgr)])
+  assert intervals==[20,40,80,100], intervals
+
+def test_running_task_checked_by_its_walltime():
+  mgr=testing.TaskManager('true',testing.scratch())
+  mgr.last_status='running'
+  farm=daemon([mgr])
+  farm.interval[node_key(mgr)]=100
+  # Started 570 s into its 10 minute walltime.
+  with open(mgr.path+mgr.outfile+sentinels.START,'w') as outf:
+    json.dump({'host':'node1','start':1000},outf)
+  farm.plan(mgr,False,1570)
+  assert farm.interval[node_key(mgr)]==30, farm.interval
+
+def test_far_back_in_queue_checked_less():
+  path=testing.scratch()
+  ahead=3*QUEUE_STEP
+  qstat=testing.write_commands(os.path.join(path,'bin'),qstat='\n'.join(
+    ["echo '%d.fake job user 00:00:00 Q batch'"%(1000+n) for n in range(ahead)]+["echo '2000.fake job user 00:00:00 Q batch'"]))
+  mgr=testing.TaskManager('true',path)
+  mgr.runner.queueid=['2000']
+  mgr.last_status='not_started'
+  farm=daemon([mgr])
+  with testing.environment(path=qstat):
+    submitter.qstat_cache().invalidate()
+    farm.plan(mgr,False,0)
+    submitter.qstat_cache().invalidate()
+  assert farm.interval[node_key(mgr)]==10*(1+ahead//QUEUE_STEP), farm.interval
+
+def test_finished_upstream_wakes_downstream():
+  path=testing.scratch()
+  up=testing.TaskManager('true',os.path.join(path,'up'))
+  down=testing.TaskManager('true',os.path.join(path,'down'))
+  down.trialfunc=up
+  farm=daemon([down],campaign=Scheduler)
+  farm.plan(down,False,0)
+  # Waiting managers sleep until what they wait for is done.
+  assert farm.due[node_key(down)]==100
+  up.completed=True
+  farm.plan(up,True,50)
+  assert node_key(up) not in farm.due
+  assert farm.due[node_key(down)]==50 and farm.interval[node_key(down)]==10
+
+def test_run_writes_heartbeat():
+  path=testing.scratch()
+  heartbeat=os.path.join(path,'autogen_daemon.json')
+  mgrs=[testing.TaskManager('true',os.path.join(path,name)) for name in ('a','b')]
+  farm=daemon(mgrs,heartbeat=heartbeat)
+  start=time.time()
+  farm.run(max_wakes=1)
+  with open(heartbeat) as inpf:
+    beat=json.load(inpf)
+  assert (beat['wakes'],beat['managers'],beat['active'],beat['states'])==(1,2,2,{'not_started':2}), beat
+  assert beat['next_wake']>=start+10 and beat['errors']==[], beat
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,78 @@
+'''
+Tests of the dependency graph of managers and the Scheduler stepping it (autogenv2.dag).
+'''
+import os
+import subprocess as sub
+import testing
+from autogenv2 import submitter
+from autogenv2.dag import ManagerGraph, Scheduler, node_key
+
+class GivingUpManager(testing.TaskManager):
+  ''' TaskManager out of restarts as soon as its command fails.'''
+  def nextstep(self,qstat=None):
+    testing.TaskManager.nextstep(self,qstat)
+    if self.last_status=='failed':
+      self.last_status='exhausted'
+      self.update_pickle()
+
+def diamond(path):
+  ''' a and b have no dependencies, c needs a, d needs b (which fails), and e needs c and d.'''
+  mgrs={}
+  for name,command,upstream in (('a','true',[]),('b','false',[]),('c','true',['a']),('d','true',['b']),('e','true',['c','d'])):
+    mgrs[name]=GivingUpManager(command,os.path.join(path,name),bundle=False)
+    mgrs[name].max_restarts=0
+    # Managers a manager depends on are found in its trial function.
+    mgrs[name].trialfunc=[mgrs[up] for up in upstream]
+  return mgrs
+
+def run_job(bindir,mgr):
+  sub.call(['bash',os.path.join(bindir,'jobs',mgr.runner.queueid[-1])],stdout=sub.DEVNULL)
+
+###################################################################################################################
+def test_order_and_critical_path():
+  mgrs=diamond(testing.scratch())
+  graph=ManagerGraph([mgrs['e']])
+  assert len(graph.nodes)==5
+  order=graph.order()
+  for name,mgr in mgrs.items():
+    for up in mgr.trialfunc:
+      assert order.index(node_key(up))<order.index(node_key(mgr)), (up.logname,mgr.logname)
+  length=graph.critical_path()
+  assert [length[node_key(mgrs[name])] for name in 'abcde']==[3,3,2,2,1], length
+
+def test_cycle_raises():
+  path=testing.scratch()
+  x=testing.TaskManager('true',os.path.join(path,'x'))
+  y=testing.TaskManager('true',os.path.join(path,'y'))
+  x.trialfunc=y
+  y.trialfunc=x
+  try:
+    ManagerGraph([x]).order()
+  except ValueError:
+    pass
+  else:
+    assert False, "no error for a cycle"
+
+def test_failed_upstream_blocks_downstream():
+  path=testing.scratch()
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    submitter.qstat_cache().invalidate()
+    mgrs=diamond(path)
+    scheduler=Scheduler(mgrs.values(),workers=2)
+    report=scheduler.sweep()
+    # Only the managers without dependencies start.
+    assert [mgrs[name].last_status for name in 'abcde']==['not_started','not_started',None,None,None]
+    assert report.transitions[('waiting','waiting')]==3, report.transitions
+    run_job(bindir,mgrs['a'])
+    run_job(bindir,mgrs['b'])
+    report=scheduler.sweep()
+  # a finishing lets c start in the same sweep; b failing for good blocks d and e.
+  assert [mgrs[name].terminal_state() for name in 'ab']==['done','exhausted']
+  assert mgrs['c'].last_status=='not_started' and len(mgrs['c'].runner.queueid)==1
+  assert mgrs['d'].runner.queueid==[] and mgrs['e'].runner.queueid==[]
+  assert report.blocked=={mgrs['b'].logname:sorted([mgrs['d'].logname,mgrs['e'].logname])}, report.blocked
+  assert 'blocked by %s'%mgrs['b'].logname in str(report)
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,63 @@
+'''
+Tests of the runtime ledger (autogenv2.ledger) and the submission times it records.
+'''
+import os
+import json
+import subprocess as sub
+import testing
+from autogenv2 import ledger, sentinels
+from autogenv2.bundler import Bundler
+
+def queued_info(mgr):
+  with open(mgr.path+mgr.outfile+sentinels.QUEUED) as inpf:
+    return json.load(inpf)
+
+###################################################################################################################
+def test_submitted_when_bundle_is_queued():
+  ''' A bundled task is submitted when its bundle is, not when it's added to its runner.'''
+  path=testing.scratch()
+  bindir=testing.fake_qsub(os.path.join(path,'bin'))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    mgr=testing.TaskManager('true',os.path.join(path,'task'))
+    mgr.nextstep()
+    assert 'submitted' not in queued_info(mgr)
+    Bundler(npb=1,walltime='1:00:00',jobname='bundle').submit([mgr])
+  info=queued_info(mgr)
+  assert info['submitted']>0 and info['nodes']==1, info
+
+def test_submitted_when_pilot_task_is_queued():
+  path=testing.scratch()
+  bindir=testing.fake_qsub(os.path.join(path,'bin'))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    mgr=testing.TaskManager('true',os.path.join(path,'task'))
+    mgr.nextstep()
+    assert 'submitted' not in queued_info(mgr)
+    Bundler(npb=1,walltime='1:00:00',jobname='farm',pilot=os.path.join(path,'queue')).submit([mgr])
+  assert queued_info(mgr)['submitted']>0
+
+def test_append_and_reload():
+  ''' A finished task is recorded once, with its times, and read back from the ledger.'''
+  path=testing.scratch()
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    mgr=testing.TaskManager('true',os.path.join(path,'task'),bundle=False)
+    mgr.nextstep()
+    assert queued_info(mgr)['submitted']>0
+    sub.check_call(['bash',os.path.join(bindir,'jobs','1000')],stdout=sub.DEVNULL)
+    mgr.nextstep()
+    assert mgr.completed
+    mgr.record_runtimes()
+  records=ledger.read_ledger([path])
+  assert len(records)==1, records
+  record=records[0]
+  assert (record['manager'],record['stage'],record['exit_code'],record['nodes'])==('TaskManager','task.o',0,1), record
+  # Start and end are whole seconds (date +%s).
+  assert int(record['submitted'])<=record['start']<=record['end'], record
+  summary=ledger.summarize(records)
+  assert summary[('TaskManager',None,0)]['tasks']==1, summary
+  # Appending adds to the file, so records from other processes are kept.
+  ledger.append(ledger.ledger_file(mgr),[dict(record,exit_code=1)])
+  assert [record['exit_code'] for record in ledger.read_ledger([path])]==[0,1]
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,131 @@
+'''
+Tests of saving and reloading managers (autogenv2.manager).
+'''
+import os
+import numpy as np
+import testing
+from autogenv2 import sidecar
+from autogenv2.manager import Manager, deep_compare
+from autogenv2.statestore import StateStore
+from autogenv2.autorunner import RunnerPBS
+
+class SpyRunner(RunnerPBS):
+  ''' RunnerPBS noting what managers ask of it (in calls, shared by all of them).'''
+  calls=[]
+  def check_status(self,qstat=None):
+    SpyRunner.calls.append('check_status')
+    return 'unknown'
+  def add_task(self,exestr,sentinel=None):
+    SpyRunner.calls.append('add_task')
+    RunnerPBS.add_task(self,exestr,sentinel)
+  def submit(self,*args,**kwargs):
+    SpyRunner.calls.append('submit')
+    return RunnerPBS.submit(self,*args,**kwargs)
+
+def spied(path):
+  del SpyRunner.calls[:]
+  return testing.TaskManager('true',path,runner=SpyRunner(walltime='0:10:00'),bundle=False)
+
+###################################################################################################################
+def test_step_after_state_file_removed():
+  path=testing.scratch()
+  mgr=testing.TaskManager('true',path,bundle=True)
+  os.remove(mgr.statefile())
+  mgr.nextstep()
+  assert mgr.last_status=='not_started'
+  assert Manager.load(path,'task').last_status=='not_started'
+
+def test_step_after_store_row_removed():
+  path=testing.scratch()
+  store=StateStore(os.path.join(path,'autogen.db'))
+  mgr=testing.TaskManager('true',path)
+  mgr.store=store
+  mgr.update_pickle()
+  with store.conn:
+    store.conn.execute("delete from managers")
+  mgr.nextstep()
+  assert Manager.load(path,'task',store).last_status=='not_started'
+
+def test_reload_takes_saved_changes():
+  path=testing.scratch()
+  mgr=testing.TaskManager('true',path)
+  other=Manager.load(path,'task')
+  other.restarts=3
+  other.update_pickle()
+  mgr._reload()
+  assert mgr.restarts==3
+
+def test_terminal_managers_return_early():
+  path=testing.scratch()
+  for state in ('done','exhausted'):
+    mgr=spied(path)
+    if state=='done':
+      mgr.completed=True
+    else:
+      mgr.last_status='exhausted'
+      mgr.restarts=mgr.max_restarts=2
+    mgr.update_pickle()
+    assert mgr.terminal_state()==state
+    stamp=mgr.saved_stamp()
+    status=os.stat(mgr.path+'task.status').st_mtime_ns
+    mgr.nextstep()
+    # Not checked in the queue, resubmitted, or saved.
+    assert SpyRunner.calls==[], SpyRunner.calls
+    assert mgr.saved_stamp()==stamp and os.stat(mgr.path+'task.status').st_mtime_ns==status
+    mgr.completed=False
+    mgr.update_pickle()
+
+def test_more_restarts_reopen_exhausted_manager():
+  path=testing.scratch()
+  bindir=testing.fake_qsub(os.path.join(path,'bin'))
+  mgr=spied(path)
+  mgr.last_status='exhausted'
+  mgr.restarts=mgr.max_restarts=2
+  mgr.update_pickle()
+  mgr.max_restarts=3
+  assert mgr.terminal_state() is None
+  with testing.environment(path=bindir):
+    mgr.nextstep()
+  assert SpyRunner.calls==['check_status','add_task','submit'], SpyRunner.calls
+  assert Manager.load(path,'task').last_status=='not_started'
+
+def test_loaded_manager_not_loaded_again():
+  path=testing.scratch()
+  testing.TaskManager('true',path)
+  mgr=Manager.load(path,'task')
+  assert mgr._stamp==mgr.saved_stamp()
+  # Nothing saved it since it was loaded, so its first step keeps what's in memory.
+  mgr.restarts=5
+  mgr._reload()
+  assert mgr.restarts==5
+  other=Manager.load(path,'task')
+  other.restarts=7
+  other.update_pickle()
+  mgr._reload()
+  assert mgr.restarts==7
+
+def test_deep_compare():
+  a=np.arange(12.).reshape(3,4)
+  assert deep_compare({'x':a,'y':[1,2]},{'x':a.copy(),'y':[1,2]})
+  assert not deep_compare({'x':a},{'x':a+1})
+  assert not deep_compare({'x':a},{'z':a})
+  assert not deep_compare({'x':a},{'x':a.tolist()})
+  assert deep_compare(np.arange(3),np.arange(3.))
+
+def test_deep_compare_hashes_only_frozen_arrays():
+  arraydir=testing.scratch()
+  big=np.random.RandomState(0).rand(200,200)
+  mapped=sidecar.load_array(sidecar.save_array(big,arraydir),arraydir)
+  again=sidecar.load_array(sidecar.save_array(big,arraydir),arraydir)
+  assert sidecar.frozen_key(mapped) is not None
+  assert deep_compare({'dm':mapped},{'dm':again})
+  # Writeable arrays, and read-only views of them, can change, so they are compared directly and never hashed.
+  view=big.view()
+  view.flags.writeable=False
+  assert sidecar.frozen_key(big) is None and sidecar.frozen_key(view) is None
+  assert deep_compare({'dm':view},{'dm':big.copy()})
+  big[0,0]+=1
+  assert not deep_compare({'dm':view},{'dm':mapped})
+
+if __name__=='__main__':
+  testing.run_tests(globals())
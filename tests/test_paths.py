@@ -0,0 +1,69 @@
+'''
+Tests of managers working in their own paths without changing the working directory (autogenv2.manager, autorunner).
+'''
+import os
+import glob
+import threading
+import testing
+from autogenv2 import manager, sentinels
+from autogenv2.autorunner import RunnerLocal, RunnerPBS
+
+def step_in_threads(mgrs):
+  threads=[threading.Thread(target=mgr.nextstep) for mgr in mgrs]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+###################################################################################################################
+def test_threads_keep_working_directory():
+  path=testing.scratch()
+  driver=os.path.join(path,'driver')
+  os.mkdir(driver)
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(driver):
+    local=[testing.TaskManager('echo local',os.path.join(path,'local%d'%idx),runner=RunnerLocal(),bundle=False)
+        for idx in range(6)]
+    queued=[testing.TaskManager('echo queued',os.path.join(path,'queued%d'%idx),bundle=False) for idx in range(6)]
+    step_in_threads(local+queued)
+    assert os.getcwd()==driver
+    step_in_threads(local)
+    assert os.getcwd()==driver
+  assert os.listdir(driver)==[]
+  for mgr in local:
+    # The command ran in the manager's path, and its output landed there.
+    assert mgr.completed, mgr.logname
+    with open(mgr.path+'task.o') as inpf:
+      assert inpf.read()=='local\n'
+    assert sentinels.read(mgr.path+'task.o')['exit_code']==0
+  for mgr in queued:
+    assert len(mgr.runner.queueid)==1
+    scripts=glob.glob(mgr.path+'*.qsub')
+    assert len(scripts)==1, os.listdir(mgr.path)
+    with open(scripts[0]) as inpf:
+      assert "cd %s"%mgr.path in inpf.read()
+  for mgr in local+queued:
+    assert os.path.exists(mgr.path+'task.pkl') and os.path.exists(mgr.path+'task.status')
+
+def test_working_directory_restored_after_error():
+  path=testing.scratch()
+  cwd=os.getcwd()
+  try:
+    with manager.working_directory(path):
+      assert os.getcwd()==os.path.realpath(path)
+      raise ValueError("converter failed")
+  except ValueError:
+    pass
+  assert os.getcwd()==cwd
+  # Another thread can take the working directory after the error.
+  acquired=[]
+  def other():
+    acquired.append(manager._cwd_lock.acquire(timeout=5))
+    manager._cwd_lock.release()
+  thread=threading.Thread(target=other)
+  thread.start()
+  thread.join()
+  assert acquired==[True]
+
+if __name__=='__main__':
+  testing.run_tests(globals())
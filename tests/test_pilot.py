@@ -0,0 +1,77 @@
+'''
+Tests of pilot jobs running tasks from a queue directory (autogenv2.pilot).
+'''
+import os
+import time
+import testing
+from autogenv2 import pilot
+from autogenv2.bundler import Bundler
+
+def queue_tasks(path,bindir,commands):
+  ''' Managers running commands, queued for pilots by a Bundler; the pilot job goes to the fake qsub.'''
+  mgrs=[testing.TaskManager(command,os.path.join(path,name)) for name,command in commands]
+  for mgr in mgrs:
+    mgr.nextstep()
+  Bundler(npb=2,walltime='1:00:00',jobname='farm',pilot=os.path.join(path,'queue')).submit(mgrs)
+  return mgrs
+
+def farm(path,nodes,seconds=3600):
+  return pilot.TaskFarm(os.path.join(path,'queue'),nodes,time.time()+seconds,margin=0,poll=0.05)
+
+###################################################################################################################
+def test_done_records_exit_codes():
+  path=testing.scratch()
+  bindir=testing.fake_mpirun(testing.fake_qsub(os.path.join(path,'bin')))
+  with testing.environment(path=bindir),testing.working_directory(path):
+    mgrs=queue_tasks(path,bindir,[('good','true'),('bad','false')])
+    assert farm(path,['node1']).run()==2
+  done={}
+  for mgr in mgrs:
+    done[os.path.basename(mgr.path.rstrip('/'))]=pilot._read_json(os.path.join(path,'queue','done',pilot.task_id(mgr)+'.json'))['exit_code']
+  assert done=={'good':0,'bad':1}, done
+
+def test_claimed_by_one_pilot():
+  path=testing.scratch()
+  mgr=testing.TaskManager('true',os.path.join(path,'task'))
+  pilot.enqueue(os.path.join(path,'queue'),mgr,['true'],60)
+  task=pilot.ready_tasks(os.path.join(path,'queue'))[0]
+  first,second=farm(path,['node1']),farm(path,['node2'])
+  assert first.claim(task) and not second.claim(task)
+  assert pilot.ready_tasks(os.path.join(path,'queue'))==[]
+
+def test_fits_nodes_and_deadline():
+  path=testing.scratch()
+  agent=pilot.TaskFarm(os.path.join(path,'queue'),['node1','node2'],deadline=1000,margin=100)
+  assert agent.fits({'nodes':2,'seconds':800},now=100)
+  assert not agent.fits({'nodes':3,'seconds':60},now=100)
+  # It would run into the margin at the end of the allocation.
+  assert not agent.fits({'nodes':1,'seconds':801},now=100)
+
+def test_drains_queue_and_leaves_what_doesnt_fit():
+  path=testing.scratch()
+  queuedir=os.path.join(path,'queue')
+  mgrs=[testing.TaskManager('true',os.path.join(path,name)) for name in ('a','b','c','long')]
+  for mgr in mgrs[:3]:
+    pilot.enqueue(queuedir,mgr,['sleep 0.1'],60)
+  pilot.enqueue(queuedir,mgrs[3],['true'],7200)
+  agent=pilot.TaskFarm(queuedir,['node1','node2'],time.time()+3600,margin=0,poll=0.05,queueid='1000')
+  open(os.path.join(queuedir,'pilots','1000'),'w').close()
+  assert agent.run()==3
+  assert [task['task'] for task in pilot.ready_tasks(queuedir)]==[pilot.task_id(mgrs[3])]
+  assert sorted(os.listdir(os.path.join(queuedir,'claimed')))==[]
+  assert all(pilot._read_json(os.path.join(queuedir,'done',pilot.task_id(mgr)+'.json'))['pilot']=='1000' for mgr in mgrs[:3])
+  # The pilot takes itself off the list when it's done.
+  assert pilot.pilots(queuedir)==[]
+
+def test_enqueue_again_replaces_task():
+  path=testing.scratch()
+  queuedir=os.path.join(path,'queue')
+  mgr=testing.TaskManager('true',os.path.join(path,'task'))
+  pilot.enqueue(queuedir,mgr,['false'],60)
+  assert farm(path,['node1']).run()==1
+  pilot.enqueue(queuedir,mgr,['true'],60)
+  assert not os.path.exists(os.path.join(queuedir,'done',pilot.task_id(mgr)+'.json'))
+  assert [task['commands'] for task in pilot.ready_tasks(queuedir)]==[['true']]
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,116 @@
+'''
+Tests of the hook starting chained jobs (autogenv2.prerun): it only reads the managers upstream.
+'''
+import os
+import subprocess as sub
+import testing
+from autogenv2 import sentinels
+from autogenv2.manager import Manager, update_attributes
+from autogenv2.prerun import prerun
+
+class Upstream(Manager):
+  ''' Manager whose one task is done when its sentinel says it exited successfully.'''
+  def __init__(self,path):
+    Manager.__init__(self,name='up',path=path)
+
+  def recover(self,other):
+    update_attributes(copyto=self,copyfrom=other,take_keys=['completed','restarts','last_status'])
+
+  def nextstep(self,qstat=None):
+    # A rerun, which prerun must never start.
+    sentinels.clear(self.path+'up.o')
+    self.restarts+=1
+    self.update_pickle()
+
+  def collect_finished(self):
+    info=sentinels.read(self.path+'up.o')
+    self.completed=self.completed or (info is not None and info.get('exit_code')==0)
+    return self.completed
+
+class Downstream(Manager):
+  ''' Manager whose input needs the upstream one.'''
+  def __init__(self,path,upstream):
+    self.trialfunc=[upstream]
+    self.written=False
+    Manager.__init__(self,name='down',path=path)
+
+  def recover(self,other):
+    update_attributes(copyto=self,copyfrom=other,take_keys=['completed','restarts','last_status','written'])
+
+  def prepare_inputs(self):
+    with open(self.path+'down.inp','w') as outf:
+      outf.write("from %s\n"%self.trialfunc[0].name)
+    self.written=True
+    return True
+
+  def prerun_results(self):
+    return {'written':self.written}
+
+  def apply_prerun(self,results):
+    self.written=results['written']
+
+def pipeline(line=None):
+  ''' Saved upstream and downstream managers; the upstream task runs line, if any.'''
+  path=testing.scratch()
+  up=Upstream(os.path.join(path,'up'))
+  down=Downstream(os.path.join(path,'down'),up)
+  if line is not None:
+    sub.call(sentinels.wrap(line,up.path+'up.o'),shell=True,cwd=up.path,executable='/bin/bash')
+  return up,down
+
+def saved(mgr):
+  with open(mgr.statefile(),'rb') as inpf:
+    return inpf.read()
+
+###################################################################################################################
+@testing.requires('qwalk_objects')
+def test_unfinished_upstream_fails():
+  up,down=pipeline()
+  before=saved(up)
+  assert not prerun(down.path,down.name)
+  assert saved(up)==before
+  assert Manager.load(up.path,up.name).restarts==0
+  assert not os.path.exists(down.path+'down.inp')
+
+@testing.requires('qwalk_objects')
+def test_failed_upstream_fails():
+  up,down=pipeline('false')
+  before=saved(up)
+  assert not prerun(down.path,down.name)
+  assert saved(up)==before
+  # The failed run is left for the driver to see and restart.
+  assert sentinels.read(up.path+'up.o')['exit_code']==1
+
+@testing.requires('qwalk_objects')
+def test_finished_upstream_writes_input():
+  up,down=pipeline('true')
+  before=saved(up),saved(down)
+  assert prerun(down.path,down.name)
+  assert os.path.exists(down.path+'down.inp')
+  # The upstream manager is collected by the driver, not by the job, and the downstream one is left for it to merge.
+  assert (saved(up),saved(down))==before
+  assert not Manager.load(up.path,up.name).completed
+  assert os.path.exists(down.prerun_file())
+
+@testing.requires('qwalk_objects')
+def test_driver_merges_what_prerun_wrote():
+  up,down=pipeline('true')
+  # The driver saves its copy of the manager while the job writes the input, and doesn't lose what the job did.
+  driver=Manager.load(down.path,down.name)
+  assert prerun(down.path,down.name)
+  driver.restarts+=1
+  driver.update_pickle()
+  assert not Manager.load(down.path,down.name).written
+  driver._reload()
+  assert driver.written and driver.restarts==1
+  driver.update_pickle()
+  assert not os.path.exists(down.prerun_file())
+  saved_down=Manager.load(down.path,down.name)
+  assert saved_down.written and saved_down.restarts==1
+  # Merged once: a later step starts from the saved state.
+  saved_down.written=False
+  saved_down._reload()
+  assert not saved_down.written
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,52 @@
+'''
+Tests of the cache of finished runs (autogenv2.resultcache).
+'''
+import os
+import stat
+import testing
+from autogenv2.resultcache import ResultCache
+
+def write(fn,text):
+  with open(fn,'w') as outf:
+    outf.write(text)
+
+def read(fn):
+  with open(fn) as inpf:
+    return inpf.read()
+
+###################################################################################################################
+def test_fetched_outputs_are_own_writable_files():
+  root=testing.scratch()
+  first,second=os.path.join(root,'first'),os.path.join(root,'second')
+  for path in (first,second):
+    os.makedirs(path)
+    write(os.path.join(path,'run.inp'),'same input')
+  write(os.path.join(first,'run.out'),'energy -1.0')
+  cache=ResultCache(os.path.join(root,'cache'))
+  key=cache.input_key(first,['run.inp'],'/bin/exe')
+  cache.store(key,first,{'output':'run.out'})
+
+  assert cache.input_key(second,['run.inp'],'/bin/exe')==key
+  write(os.path.join(second,'old.out'),'stale')
+  assert cache.fetch(key,second,{'output':'old.out'})
+  fetched=os.path.join(second,'old.out')
+  assert read(fetched)=='energy -1.0'
+  assert os.stat(fetched).st_nlink==1
+  assert os.stat(fetched).st_mode&stat.S_IWUSR
+  # A rerun writing its output doesn't change the cache, or other runs using it.
+  write(fetched,'energy -2.0')
+  assert read(os.path.join(root,'cache',key,'output'))=='energy -1.0'
+  assert read(os.path.join(first,'run.out'))=='energy -1.0'
+  third=os.path.join(root,'third')
+  os.makedirs(third)
+  assert cache.fetch(key,third,{'output':'run.out'})
+  assert read(os.path.join(third,'run.out'))=='energy -1.0'
+
+def test_missing_entry():
+  root=testing.scratch()
+  cache=ResultCache(os.path.join(root,'cache'))
+  assert not cache.fetch('0'*40,root,{'output':'run.out'})
+  assert not os.path.exists(os.path.join(root,'run.out'))
+
+if __name__=='__main__':
+  testing.run_tests(globals())
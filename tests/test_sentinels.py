@@ -0,0 +1,53 @@
+'''
+Tests of the sentinel files written by job scripts (autogenv2.sentinels).
+'''
+import os
+import subprocess as sub
+import testing
+from autogenv2 import sentinels
+from autogenv2.autorunner import task_line
+
+def run(line,cwd):
+  return sub.call(line,shell=True,cwd=cwd,executable='/bin/bash')
+
+###################################################################################################################
+def test_failed_task_exits_nonzero():
+  path=testing.scratch()
+  sentinel=os.path.join(path,'task.o')
+  status=run(sentinels.wrap("false",sentinel),path)
+  assert status!=0, status
+  info=sentinels.read(sentinel)
+  assert info['exit_code']==1, info
+  assert sentinels.state(sentinel)=='finished'
+
+def test_exit_status_passes_through():
+  path=testing.scratch()
+  sentinel=os.path.join(path,'task.o')
+  assert run(sentinels.wrap("sh -c 'exit 3'",sentinel),path)==3
+  assert sentinels.read(sentinel)['exit_code']==3
+  assert run(sentinels.wrap("true",sentinel),path)==0
+  assert sentinels.read(sentinel)['exit_code']==0
+
+def test_job_script_fails_with_task():
+  ''' The job script, whose status afterok dependencies follow, fails when its last task does.'''
+  path=testing.scratch()
+  script=os.path.join(path,'job.sh')
+  with open(script,'w') as outf:
+    outf.write("cd %s\n"%path+sentinels.wrap("false",os.path.join(path,'task.o'))+"\n")
+  assert sub.call(['bash',script])!=0
+
+def test_states():
+  path=testing.scratch()
+  sentinel=os.path.join(path,'task.o')
+  assert sentinels.state(sentinel) is None
+  assert sentinels.read(sentinel) is None
+  line=task_line("true",sentinel,nodes=2,cores=64)
+  assert os.path.exists(sentinel+sentinels.QUEUED)
+  run(line,path)
+  info=sentinels.read(sentinel)
+  assert (info['nodes'],info['cores'])==(2,64), info
+  sentinels.clear(sentinel)
+  assert sentinels.state(sentinel) is None
+
+if __name__=='__main__':
+  testing.run_tests(globals())
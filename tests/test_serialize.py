@@ -0,0 +1,117 @@
+'''
+Tests of the versioned state format (autogenv2.serialize).
+'''
+import os
+import json
+import pickle
+from collections import OrderedDict, Counter, defaultdict
+import numpy as np
+import testing
+from autogenv2 import serialize
+from autogenv2.autorunner import RunnerPBS
+from autogenv2.manager import Manager
+
+class Holder:
+  ''' Plain object saved by its attributes.'''
+  def __init__(self,**attributes):
+    self.__dict__.update(attributes)
+
+def round_trip(obj,arraydir=None):
+  arraydir=arraydir or testing.scratch()
+  return serialize.loads(serialize.dumps(obj,arraydir),arraydir)
+
+###################################################################################################################
+def test_mappings_keep_their_type_and_items():
+  counts=Counter('abracadabra')
+  ordered=OrderedDict([('z',1),('a',2),('m',3)])
+  grouped=defaultdict(list,{'x':[1,2]})
+  back=round_trip(Holder(counts=counts,ordered=ordered,grouped=grouped))
+  assert type(back.counts)==Counter and back.counts==counts
+  assert type(back.ordered)==OrderedDict and list(back.ordered.items())==list(ordered.items())
+  assert type(back.grouped)==defaultdict and back.grouped.default_factory is list and back.grouped==grouped
+  back.grouped['y'].append(3)
+  assert back.grouped['y']==[3]
+
+def test_unknown_containers_refused():
+  class Tagged(dict):
+    pass
+  try:
+    serialize.dumps(Holder(tags=Tagged(a=1)),testing.scratch())
+  except TypeError:
+    pass
+  else:
+    raise AssertionError("A dict subclass was saved without its items.")
+
+def test_arrays_and_shared_references():
+  arraydir=testing.scratch()
+  shared=[1,2]
+  big=np.arange(100000,dtype=float)
+  back=round_trip(Holder(a=shared,b=shared,big=big,small=np.eye(2),scalar=np.float32(1.5),key={(1,2):'x'}),arraydir)
+  assert np.array_equal(back.big,big) and np.array_equal(back.small,np.eye(2))
+  assert back.scalar.dtype==np.float32 and back.key=={(1,2):'x'}
+  assert os.listdir(arraydir)!=[]
+
+def test_runner_saved_by_name_with_defaults():
+  runner=RunnerPBS(nn=4,walltime='1:00:00')
+  runner.queueid=['123']
+  doc=json.loads(serialize.dumps(runner,testing.scratch()).decode())
+  assert doc['version']==serialize.SCHEMA_VERSION
+  assert doc['root']['__object__']=='RunnerPBS', doc['root']['__object__']
+  # A runner saved before the class had some attribute gets its default.
+  del doc['root']['state']['prefix']
+  back=serialize.loads(json.dumps(doc).encode(),testing.scratch())
+  assert (back.nn,back.walltime,back.queueid,back.prefix)==(4,'1:00:00',['123'],[])
+
+def test_renamed_class():
+  doc={'format':serialize.FORMAT_NAME,'version':serialize.SCHEMA_VERSION,
+      'root':{'__object__':'oldpackage.oldmodule:Holder','id':0,'state':{'x':1}}}
+  serialize.RENAMED['oldpackage.oldmodule:Holder']=__name__+':Holder'
+  try:
+    back=serialize.loads(json.dumps(doc).encode(),testing.scratch())
+  finally:
+    del serialize.RENAMED['oldpackage.oldmodule:Holder']
+  assert isinstance(back,Holder) and back.x==1
+
+def test_upgrade_from_version_1():
+  ''' Version 1 documents saved classes by where they were defined.'''
+  doc={'format':serialize.FORMAT_NAME,'version':1,
+      'root':{'__object__':'autogenv2.autorunner:RunnerPBS','id':0,'state':{'nn':2,'queueid':[]}}}
+  assert serialize.upgrade(doc)['root']['__object__']=='RunnerPBS'
+  back=serialize.loads(json.dumps(doc).encode(),testing.scratch())
+  assert isinstance(back,RunnerPBS) and back.nn==2 and back.walltime=='48:00:00'
+
+def test_migrate_checks_before_retiring_pickle():
+  path=testing.scratch()
+  mgr=testing.TaskManager('true',path)
+  mgr.counts=Counter({'restarts':2})
+  mgr.update_pickle()
+  written=serialize.migrate(path)
+  assert written==[os.path.join(path,'task.state.json')], written
+  assert os.path.exists(os.path.join(path,'task.pkl.bak')) and not os.path.exists(os.path.join(path,'task.pkl'))
+  back=Manager.load(path,'task')
+  assert back.counts==mgr.counts and back.runner.nn==mgr.runner.nn and back.command=='true'
+
+def test_migrate_keeps_pickle_that_would_change():
+  path=testing.scratch()
+  mgr=testing.TaskManager('true',path)
+  mgr.lossy=Lossy()
+  mgr.update_pickle()
+  assert serialize.migrate(path)==[]
+  assert os.path.exists(os.path.join(path,'task.pkl'))
+  assert not os.path.exists(os.path.join(path,'task.state.json'))
+
+class Lossy:
+  ''' Object whose hooks drop part of its state.'''
+  def __init__(self):
+    self.kept=1
+    self.dropped=2
+  def to_state(self):
+    return {'kept':self.kept}
+  @classmethod
+  def from_state(cls,state):
+    obj=cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
+
+if __name__=='__main__':
+  testing.run_tests(globals())
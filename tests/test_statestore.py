@@ -0,0 +1,55 @@
+'''
+Tests of keeping managers in one SQLite database (autogenv2.statestore).
+'''
+import os
+import sqlite3
+import testing
+from autogenv2.statestore import StateStore
+
+def commits(store):
+  ''' List that collects the commits of a store's connection.'''
+  found=[]
+  store.conn.set_trace_callback(lambda statement: found.append(statement) if statement.upper().startswith('COMMIT') else None)
+  return found
+
+def saved_elsewhere(store):
+  ''' Number of managers another connection sees, i.e. committed ones.'''
+  conn=sqlite3.connect(store.dbfile)
+  try:
+    return conn.execute("select count(*) from managers where last_status is not null").fetchone()[0]
+  finally:
+    conn.close()
+
+###################################################################################################################
+def test_one_commit_per_sweep():
+  path=testing.scratch()
+  store=StateStore(os.path.join(path,'autogen.db'))
+  mgrs=[]
+  for name in 'abcde':
+    mgr=testing.TaskManager('true',os.path.join(path,name))
+    mgr.store=store
+    mgr.update_pickle()
+    mgrs.append(mgr)
+  found=commits(store)
+  with store.sweep():
+    for mgr in mgrs:
+      mgr.nextstep()
+      # Reads inside the sweep see its saves, but don't commit them.
+      assert len([record for record in store.records() if record['last_status']=='not_started'])==mgrs.index(mgr)+1
+      assert store.count()==5 and len(store.active())==5 and len(store.status(completed=False))==5
+    assert found==[] and saved_elsewhere(store)==0
+  assert len(found)==1, found
+  assert saved_elsewhere(store)==5
+
+def test_reads_outside_sweep_commit():
+  path=testing.scratch()
+  store=StateStore(os.path.join(path,'autogen.db'))
+  mgr=testing.TaskManager('true',path)
+  mgr.store=store
+  mgr.update_pickle()
+  mgr.nextstep()
+  assert saved_elsewhere(store)==1
+  assert store.records()[0]['last_status']=='not_started'
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,141 @@
+'''
+Tests of the shared queue listings (autogenv2.submitter), against stub qstat, sbatch, sacct, and squeue.
+'''
+import os
+import time
+import testing
+from autogenv2 import submitter
+from autogenv2.autorunner import RunnerSlurm
+
+def calls(directory):
+  fn=os.path.join(directory,'calls')
+  if not os.path.exists(fn):
+    return []
+  with open(fn) as inpf:
+    return inpf.read().strip().split('\n')
+
+def counting_qstat(directory,listing):
+  ''' qstat printing directory/listing and logging its calls to directory/calls; it fails if there's no listing.'''
+  with open(os.path.join(directory,'listing'),'w') as outf:
+    outf.write(listing)
+  testing.write_commands(directory,qstat='''
+echo qstat >> %(dir)s/calls
+cat %(dir)s/listing
+'''%{'dir':directory})
+  return submitter.QstatCache(command=os.path.join(directory,'qstat'),ttl=30)
+
+LISTING='''Job ID                    Name             User            Time Use S Queue
+------------------------- ---------------- --------------- -------- - -----
+12345.bw                  big              user            01:00:00 R normal
+123.bw                    small            user            00:00:00 Q normal
+'''
+
+def submit_jobs(path,count):
+  ''' Submit count jobs through RunnerSlurm with a fresh SlurmCache.'''
+  submitter._slurm_cache=None
+  runners=[]
+  for jidx in range(count):
+    runner=RunnerSlurm()
+    runner.add_command("true")
+    runner.submit(jobname="job%d"%jidx,path=path)
+    runners.append(runner)
+  return runners
+
+###################################################################################################################
+def test_listing_kept_for_ttl():
+  path=testing.scratch()
+  cache=counting_qstat(path,LISTING)
+  assert submitter.check_PBS_stati(['12345'],qstat=cache.snapshot())=='running'
+  for qid in ('12345','123.bw','999'):
+    cache.index().get(qid)
+  assert len(calls(path))==1
+  cache.fetched-=cache.ttl+1
+  cache.index()
+  assert len(calls(path))==2
+
+def test_ids_match_exactly():
+  index=submitter.parse_qstat(LISTING)
+  assert (index.get('12345'),index.get('123'),index.get('123.bw'),index.get('1234'))==('R','Q','Q',None)
+  assert index.position('123')==0 and index.position('12345') is None
+  assert submitter.check_PBS_stati(['1234'],qstat=LISTING)=='unknown'
+
+def test_submitted_jobs_count_as_queued():
+  path=testing.scratch()
+  cache=counting_qstat(path,LISTING)
+  cache.index()
+  cache.submitted('777.bw')
+  assert cache.index().get('777')=='Q'
+  # The next listing says what happened to it.
+  time.sleep(0.01)
+  cache.invalidate()
+  assert cache.index().get('777') is None
+
+def test_failed_listing_cached():
+  path=testing.scratch()
+  cache=counting_qstat(path,LISTING)
+  os.remove(os.path.join(path,'listing'))
+  assert cache.index() is None and cache.index() is None
+  assert len(calls(path))==1
+
+def test_sweep_fetches_once():
+  path=testing.scratch()
+  cache=counting_qstat(path,LISTING)
+  cache.index()
+  with cache.sweep():
+    # A sweep starts from a fresh listing, and keeps it however long it takes.
+    cache.index()
+    cache.fetched-=cache.ttl+1
+    cache.index()
+    with cache.sweep():
+      cache.index()
+  assert len(calls(path))==2, calls(path)
+
+def test_one_query_per_listing():
+  path=testing.scratch()
+  slurm=testing.fake_slurm(os.path.join(path,'bin'))
+  with testing.environment(path=slurm):
+    runners=submit_jobs(path,3)
+    assert [runner.queueid for runner in runners]==[['5000'],['5001'],['5002']]
+    assert all(runner.check_status()=='running' for runner in runners)
+    submitter.slurm_cache().invalidate()
+    assert all(runner.check_status()=='running' for runner in runners)
+  assert len(calls(slurm))==2, calls(slurm)
+  assert all(call.endswith('--jobs=5000,5001,5002') for call in calls(slurm)), calls(slurm)
+
+def test_finished_jobs_dropped_from_query():
+  path=testing.scratch()
+  slurm=testing.fake_slurm(os.path.join(path,'bin'))
+  with testing.environment(path=slurm):
+    runners=submit_jobs(path,3)
+    testing.set_slurm_job(slurm,'5000','COMPLETED')
+    testing.set_slurm_job(slurm,'5001','FAILED',exit_code=2)
+    cache=submitter.slurm_cache()
+    cache._submitted={}
+    cache.invalidate()
+    index=runners[0].queue_index()
+    assert index.get('5000')=='COMPLETED' and index.job('5001')['exit_status']==2
+    assert cache.tracked=={'5002'}, cache.tracked
+    # Looking finished jobs up again doesn't query Slurm, and they keep their final state.
+    assert [runner.check_status() for runner in runners]==['unknown','unknown','running']
+    assert len(calls(slurm))==1
+    cache.invalidate()
+    assert runners[1].queue_index().job('5001')['state']=='FAILED'
+  assert calls(slurm)[-1].endswith('--jobs=5002'), calls(slurm)
+
+def test_squeue_without_accounting():
+  path=testing.scratch()
+  slurm=testing.fake_slurm(os.path.join(path,'bin'))
+  open(os.path.join(slurm,'no_sacct'),'w').close()
+  with testing.environment(path=slurm):
+    runners=submit_jobs(path,2)
+    testing.set_slurm_job(slurm,'5000','RUNNING')
+    testing.set_slurm_job(slurm,'5001','COMPLETED')
+    cache=submitter.slurm_cache()
+    cache._submitted={}
+    cache.invalidate()
+    assert [runner.check_status() for runner in runners]==['running','unknown']
+    assert calls(slurm)[-1].startswith('squeue'), calls(slurm)
+    assert cache.tracked=={'5000'}
+
+if __name__=='__main__':
+  testing.run_tests(globals())
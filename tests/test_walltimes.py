@@ -0,0 +1,56 @@
+'''
+Tests of predicting walltimes from the runtime ledger (autogenv2.walltimes).
+'''
+import math
+import testing
+from autogenv2 import ledger, walltimes
+from autogenv2.autorunner import RunnerPBS, walltime_seconds
+
+def run(size,seconds=None,exit_code=0,manager='QWalkManager',nodes=4):
+  ''' Ledger record of a run, or without seconds, a task to predict.'''
+  record={'manager':manager,'settings':{'writer':'DMCWriter'},'task':0,'system_size':size,'nodes':nodes}
+  if seconds is not None:
+    record.update({'start':1000,'end':1000+seconds,'exit_code':exit_code})
+  return record
+
+def minutes(seconds):
+  return 60*math.ceil(seconds/60.)
+
+###################################################################################################################
+def test_fit_follows_system_size():
+  ''' Run time going as the square of the system size is fitted exactly, so no margin but SAFETY is added.'''
+  records=[run(size,2.*size**2) for size in (8,16,24,32,48)]
+  # Failed runs don't count.
+  records.append(run(16,10,exit_code=1))
+  estimator=walltimes.WalltimeEstimator(records)
+  fit=estimator.fits[('QWalkManager','DMCWriter',0)]
+  assert fit['sigma']<1e-6 and abs(fit['coef'][1]-2)<1e-6, fit
+  assert estimator.predict(run(64))==minutes(2.*64**2*walltimes.SAFETY)
+
+def test_noisy_runs_get_margin():
+  records=[run(size,100.*size*factor) for size in (8,16,32,64) for factor in (0.8,1.25)]
+  estimator=walltimes.WalltimeEstimator(records)
+  assert estimator.predict(run(32))>minutes(100.*32*1.25*walltimes.SAFETY)
+
+def test_fallbacks():
+  estimator=walltimes.WalltimeEstimator([run(8,3000),run(16,5000)])
+  # Too few runs to fit: the longest run times SAFETY.
+  assert estimator.predict(run(32))==minutes(5000*walltimes.SAFETY)
+  # No runs of the kind at all.
+  assert estimator.predict(run(32,manager='CrystalManager'))==walltime_seconds(walltimes.FALLBACK)
+  # Never less than MIN_SECONDS, nor more than FALLBACK.
+  assert walltimes.WalltimeEstimator([run(8,10)]).predict(run(8))==walltimes.MIN_SECONDS
+  assert walltimes.WalltimeEstimator([run(8,1e6)]).predict(run(8))==walltime_seconds(walltimes.FALLBACK)
+
+def test_auto_runner_asks_for_prediction():
+  path=testing.scratch()
+  mgr=testing.TaskManager('true',path,runner=RunnerPBS(walltime=walltimes.AUTO))
+  assert walltimes.requested_seconds(mgr)==walltime_seconds(walltimes.FALLBACK)
+  ledger.append(ledger.ledger_file(mgr),[dict(run(None,2000,manager='TaskManager',nodes=1),settings={})])
+  assert walltimes.requested_seconds(mgr)==minutes(2000*walltimes.SAFETY)
+  with walltimes.requested(mgr,mgr.runner):
+    assert walltime_seconds(mgr.runner.walltime)==minutes(2000*walltimes.SAFETY)
+  assert mgr.runner.walltime==walltimes.AUTO
+
+if __name__=='__main__':
+  testing.run_tests(globals())
@@ -0,0 +1,206 @@
+'''
+Helpers shared by the behavior tests (test_*.py).
+Each test file runs on its own, e.g. `python tests/test_sentinels.py`, or all together with `python -m pytest tests`.
+Queue commands (qsub, sbatch, ...) are replaced by small shell scripts put first on the PATH.
+'''
+import io
+import os
+import sys
+import stat
+import tempfile
+import unittest
+import functools
+import traceback
+import importlib.util
+from contextlib import contextmanager, redirect_stdout
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+  sys.path.insert(0,ROOT)
+
+from autogenv2 import sentinels
+from autogenv2.manager import Manager, update_attributes, stepping
+from autogenv2.autorunner import RunnerPBS
+
+###################################################################################################################
+class TaskManager(Manager):
+  ''' Manager whose one task is a shell command, for tests of what runs managers (bundles, pilots, schedulers).
+  It's done once the command exits successfully.'''
+  def __init__(self,command,path,name='task',runner=None,bundle=True):
+    self.command=command
+    self.runner=RunnerPBS(walltime='0:10:00') if runner is None else runner
+    self.bundle=bundle
+    self.outfile=name+'.o'
+    self.restarts=0
+    Manager.__init__(self,name=name,path=path)
+
+  def recover(self,other):
+    update_attributes(copyto=self,copyfrom=other,take_keys=['completed','restarts','last_status','runner','recorded_tasks'])
+
+  @stepping
+  def nextstep(self,qstat=None):
+    self._reload()
+    if self.terminal_state() is not None:
+      return
+    self.record_runtimes()
+    info=sentinels.read(self.path+self.outfile)
+    if info is None or info.get('exit_code') is None:
+      if self.runner.check_status(qstat=qstat)!='running':
+        self.runner.add_task("%s > %s"%(self.command,self.outfile),sentinel=self.path+self.outfile)
+        self.last_status='not_started'
+      else:
+        self.last_status='running'
+    elif info['exit_code']==0:
+      self.completed=True
+      self.last_status='done'
+    else:
+      self.last_status='failed'
+    if not self.bundle:
+      self._submit(self.runner)
+    self.update_pickle()
+
+  def task_sentinels(self):
+    return [self.path+self.outfile]
+
+###################################################################################################################
+def scratch():
+  ''' New empty directory for a test.'''
+  return tempfile.mkdtemp(prefix='autogen_test_')
+
+###################################################################################################################
+def write_commands(directory,**scripts):
+  ''' Write executable shell scripts named by the keywords into directory.'''
+  os.makedirs(directory,exist_ok=True)
+  for name,body in scripts.items():
+    fn=os.path.join(directory,name)
+    with open(fn,'w') as outf:
+      outf.write("#!/bin/bash\n"+body.strip()+"\n")
+    os.chmod(fn,os.stat(fn).st_mode|stat.S_IXUSR|stat.S_IXGRP|stat.S_IXOTH)
+  return directory
+
+###################################################################################################################
+@contextmanager
+def environment(path=None,**variables):
+  ''' Put a directory first on the PATH and set environment variables, for the duration of a test.'''
+  saved=dict(os.environ)
+  if path is not None:
+    os.environ['PATH']=path+os.pathsep+os.environ['PATH']
+  os.environ.update(variables)
+  try:
+    yield
+  finally:
+    os.environ.clear()
+    os.environ.update(saved)
+
+###################################################################################################################
+@contextmanager
+def working_directory(path):
+  cwd=os.getcwd()
+  os.chdir(path)
+  try:
+    yield
+  finally:
+    os.chdir(cwd)
+
+###################################################################################################################
+def fake_qsub(directory):
+  ''' qsub that numbers the scripts it gets, keeps a copy of them in directory/jobs, and lists them in qstat as queued.
+  Jobs submitted at the same time get different numbers.'''
+  jobs=os.path.join(directory,'jobs')
+  os.makedirs(jobs,exist_ok=True)
+  return write_commands(directory,
+      qsub='''
+n=$(( $(ls %(jobs)s | wc -l) + 1000 ))
+until (set -C; cat "$1" > %(jobs)s/$n) 2>/dev/null; do n=$((n+1)); done
+echo "$n.fake"
+'''%{'jobs':jobs},
+      qstat='''
+echo "Job ID                    Name             User            Time Use S Queue"
+echo "------------------------- ---------------- --------------- -------- - -----"
+for job in $(ls %(jobs)s); do echo "$job.fake  job  user  00:00:00 Q batch"; done
+'''%{'jobs':jobs})
+
+###################################################################################################################
+def requires(*modules):
+  ''' Skip a test when packages it needs (e.g. qwalk_objects) aren't installed.'''
+  missing=[module for module in modules if importlib.util.find_spec(module) is None]
+  def decorate(test):
+    @functools.wraps(test)
+    def checked():
+      if len(missing)>0:
+        raise unittest.SkipTest("needs %s"%', '.join(missing))
+      return test()
+    return checked
+  return decorate
+
+###################################################################################################################
+def fake_slurm(directory):
+  ''' sbatch, sacct, and squeue working from directory/jobs, with one "id|name|partition|STATE|exit" line per job.
+  sbatch adds a pending job; sacct and squeue log their arguments to directory/calls.
+  With directory/no_sacct present, sacct fails as if accounting were off.'''
+  jobs=os.path.join(directory,'jobs')
+  calls=os.path.join(directory,'calls')
+  os.makedirs(directory,exist_ok=True)
+  open(jobs,'a').close()
+  listed='''
+for id in $(echo "$@" | sed -n 's/.*--jobs=\\([^ ]*\\).*/\\1/p' | tr , ' '); do grep "^$id|" %(jobs)s; done
+exit 0
+'''%{'jobs':jobs}
+  return write_commands(directory,
+      sbatch='''
+n=$(( $(wc -l < %(jobs)s) + 5000 ))
+echo "$n|$(basename "${@: -1}")|normal|PENDING|0:0" >> %(jobs)s
+echo "$n"
+'''%{'jobs':jobs},
+      sacct='''
+[ -e %(directory)s/no_sacct ] && exit 1
+echo "sacct $@" >> %(calls)s
+'''%{'directory':directory,'calls':calls}+listed,
+      squeue='''
+echo "squeue $@" >> %(calls)s
+'''%{'calls':calls}+listed.replace("; done","| grep -E '\\|(PENDING|RUNNING)\\|' | cut -d'|' -f1-4; done"))
+
+def set_slurm_job(directory,qid,state,exit_code=0):
+  ''' Change the state of a job of fake_slurm.'''
+  fn=os.path.join(directory,'jobs')
+  with open(fn) as inpf:
+    lines=inpf.read().split('\n')
+  with open(fn,'w') as outf:
+    for line in lines:
+      if line.startswith(qid+'|'):
+        line='|'.join(line.split('|')[:3]+[state,'%d:0'%exit_code])
+      if line:
+        outf.write(line+'\n')
+
+###################################################################################################################
+def fake_mpirun(directory):
+  ''' mpirun that drops its options and runs the command on this machine.'''
+  return write_commands(directory,mpirun='''
+while [ "${1#-}" != "$1" ]; do shift 2; done
+exec "$@"
+''')
+
+###################################################################################################################
+@contextmanager
+def captured_output():
+  ''' Collect what's printed, for tests of command line tools.'''
+  output=io.StringIO()
+  with redirect_stdout(output):
+    yield output
+
+###################################################################################################################
+def run_tests(namespace):
+  ''' Run the test_ functions of a module, as a script.'''
+  failed=0
+  for name,test in sorted(namespace.items()):
+    if name.startswith('test_') and callable(test):
+      try:
+        test()
+        print("ok      %s"%name)
+      except unittest.SkipTest as skip:
+        print("skipped %s (%s)"%(name,skip))
+      except Exception:
+        failed+=1
+        print("FAILED  %s"%name)
+        traceback.print_exc()
+  sys.exit(1 if failed else 0)